@@ -0,0 +1,98 @@
+from collections import OrderedDict, deque
+
+from ClientHealth import percentile
+
+
+MIN_TIMEOUT = 5                 # seconds; never time a fetch out sooner than this
+TIMEOUT_PERCENTILE = 95         # timeout is this percentile of observed latencies ...
+TIMEOUT_FACTOR = 2              # ... times this
+LATENCY_WINDOW = 100            # most recent fetches per client / per domain that percentiles are taken over
+MIN_SAMPLES = 10                # fetches a client or domain needs before its own latencies are trusted
+MAX_DOMAINS = 10000             # domains to keep latencies for, least recently fetched ones are forgotten first
+
+
+class AdaptiveTimeout():
+    """Fetch timeouts derived from the latencies of recent fetches, per tor client and per domain, so a
+       stuck circuit is given up on after a few times what fetches like it usually take instead of after
+       the getter's fixed timeout.
+
+       A fetch's latency estimate is the larger of its client's and its domain's percentile (whichever
+       of them have min_samples), falling back on the whole pool's until neither has. Timeouts only
+       adapt once the domain has min_samples of its own: until then fetches get the full max_timeout,
+       so a slow domain among fast ones isn't timed out by the fast ones' latencies.
+
+       Fetches that timed out are recorded at the time they were given (censored samples: they'd have
+       taken at least that long), so a domain or client whose fetches keep timing out gets longer
+       timeouts, up to max_timeout, instead of never succeeding + never being sampled"""
+
+    def __init__(self,
+                 min_timeout = MIN_TIMEOUT,
+                 percentile = TIMEOUT_PERCENTILE,
+                 factor = TIMEOUT_FACTOR,
+                 window = LATENCY_WINDOW,
+                 min_samples = MIN_SAMPLES,
+                 max_domains = MAX_DOMAINS):
+
+        self.min_timeout = min_timeout
+        self.percentile = percentile
+        self.factor = factor
+        self.window = window
+        self.min_samples = min_samples
+        self.max_domains = max_domains
+
+        self.clients = {}               # {port: deque([seconds, ...])}
+        self.domains = OrderedDict()    # {'domain': deque([seconds, ...])}, least recently fetched first
+        self.pool = deque(maxlen = window)
+        self.sorted = {}                # {('client', port) / ('domain', 'domain') / ('pool',): sorted samples}
+
+    def record(self, socks_port, domain, seconds):
+        """Add the latency of a successful fetch of domain over socks_port"""
+        if socks_port not in self.clients:
+            self.clients[socks_port] = deque(maxlen = self.window)
+        self.clients[socks_port].append(seconds)
+
+        if domain in self.domains:
+            self.domains.move_to_end(domain)
+        else:
+            self.domains[domain] = deque(maxlen = self.window)
+            if len(self.domains) > self.max_domains:
+                forgotten, _ = self.domains.popitem(last = False)
+                self.sorted.pop(('domain', forgotten), None)
+        self.domains[domain].append(seconds)
+
+        self.pool.append(seconds)
+        for key in (('client', socks_port), ('domain', domain), ('pool',)):
+            self.sorted.pop(key, None)
+
+    def recordTimeout(self, socks_port, domain, seconds):
+        """Add a fetch of domain over socks_port that timed out after seconds"""
+        self.record(socks_port, domain, seconds)
+
+    def reset(self, socks_port):
+        """Forget socks_port's latencies, e.g. after its client was replaced"""
+        self.clients.pop(socks_port, None)
+        self.sorted.pop(('client', socks_port), None)
+
+    def _percentile(self, key, samples, p):
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        if key not in self.sorted:
+            self.sorted[key] = sorted(samples)
+        return percentile(self.sorted[key], p)
+
+    def estimate(self, socks_port, domain, p):
+        """p-th percentile latency expected of a fetch of domain over socks_port, None until there's enough data"""
+        estimates = [e for e in (self._percentile(('client', socks_port), self.clients.get(socks_port), p),
+                                 self._percentile(('domain', domain), self.domains.get(domain), p))
+                     if e is not None]
+        if estimates:
+            return max(estimates)
+        return self._percentile(('pool',), self.pool, p)
+
+    def timeout(self, socks_port, domain, max_timeout):
+        """Seconds to give a fetch of domain over socks_port, between min_timeout and max_timeout.
+           max_timeout until domain has min_samples"""
+        if self._percentile(('domain', domain), self.domains.get(domain), self.percentile) is None:
+            return max_timeout
+        estimate = self.estimate(socks_port, domain, self.percentile)
+        return min(max(estimate * self.factor, self.min_timeout), max_timeout)
@@ -0,0 +1,86 @@
+from collections import defaultdict, deque
+
+
+HEALTH_WINDOW = 50              # most recent fetches per client that its health is computed over
+MIN_SAMPLES = 10                # fetches a client needs before it can be judged slow
+SLOW_FACTOR = 3                 # client is slow when its median latency is this many times the pool's
+MAX_ERROR_RATE = 0.5            # ... or when more than this fraction of its fetches fail
+
+
+def percentile(sorted_values, p):
+    """p-th percentile (0-100) of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+class ClientHealth():
+    """Rolling fetch stats per socks port (latency percentiles, error rate, bytes/sec), condensed into
+       a score relative to the rest of the pool: 1.0 is an average client, higher is better"""
+
+    def __init__(self,
+                 window = HEALTH_WINDOW,
+                 min_samples = MIN_SAMPLES,
+                 slow_factor = SLOW_FACTOR,
+                 max_error_rate = MAX_ERROR_RATE):
+
+        self.window = window
+        self.min_samples = min_samples
+        self.slow_factor = slow_factor
+        self.max_error_rate = max_error_rate
+
+        self.samples = defaultdict(lambda: deque(maxlen = self.window))  # {port: deque([(seconds, bytes, ok), ...])}
+        self.stats = {}             # {port: {'p50': ..., 'p90': ..., 'error_rate': ..., 'throughput': ...}}
+        self.pool_stats = None      # medians of the above across ports, recomputed lazily
+
+    def record(self, socks_port, seconds, num_bytes, ok):
+        """Add the outcome of one fetch over socks_port"""
+        samples = self.samples[socks_port]
+        samples.append((seconds, num_bytes, ok))
+
+        latencies = sorted(s[0] for s in samples)
+        total_time = sum(latencies)
+        self.stats[socks_port] = {'samples': len(samples),
+                                  'p50': percentile(latencies, 50),
+                                  'p90': percentile(latencies, 90),
+                                  'error_rate': sum(1 for s in samples if not s[2]) / len(samples),
+                                  'throughput': sum(s[1] for s in samples) / total_time if total_time else 0}
+        self.pool_stats = None
+
+    def reset(self, socks_port):
+        """Forget socks_port's history, e.g. after its client was replaced"""
+        self.samples.pop(socks_port, None)
+        self.stats.pop(socks_port, None)
+        self.pool_stats = None
+
+    def poolStats(self):
+        if self.pool_stats is None:
+            stats = [s for s in self.stats.values() if s['samples'] >= self.min_samples]
+            self.pool_stats = {key: percentile(sorted(s[key] for s in stats), 50) for key in ('p50', 'p90', 'throughput')}
+        return self.pool_stats
+
+    def score(self, socks_port):
+        """How this client compares to the pool, 1.0 until it has min_samples fetches"""
+        stats = self.stats.get(socks_port)
+        pool = self.poolStats()
+        if not stats or stats['samples'] < self.min_samples or not pool['p50']:
+            return 1.0
+
+        speed = (pool['p50'] / max(stats['p50'], 1e-3) + pool['p90'] / max(stats['p90'], 1e-3)) / 2
+        if pool['throughput']:
+            speed *= (stats['throughput'] / pool['throughput']) ** 0.5
+        return (1 - stats['error_rate']) * speed
+
+    def rank(self, ports):
+        """ports sorted best first"""
+        return sorted(ports, key = self.score, reverse = True)
+
+    def isSlow(self, socks_port):
+        """True if socks_port's client is persistently much slower (or flakier) than the rest of the pool"""
+        stats = self.stats.get(socks_port)
+        if not stats or stats['samples'] < self.min_samples:
+            return False
+        if stats['error_rate'] > self.max_error_rate:
+            return True
+        pool = self.poolStats()
+        return bool(pool['p50']) and stats['p50'] > self.slow_factor * pool['p50']
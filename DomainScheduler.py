@@ -0,0 +1,153 @@
+import heapq
+from time import monotonic
+from collections import defaultdict, deque
+
+
+PRUNE_EVERY = 1000              # drop expired rate limit entries after this many releases
+
+
+class DomainScheduler():
+    """Decides which queued url goes to which idle tor client next.
+
+       Enforces a minimum delay between requests to the same domain from the same client
+       (client_delay, counted from when the previous request finished) and from all clients
+       together (domain_delay, counted from when the previous request was sent). Domains sit
+       in a heap keyed on when they may next be sent to, so whichever url is ready goes out
+       first and a slow or rate-limited domain never holds up the others."""
+
+    def __init__(self,
+                 client_delay = 0,          # seconds between requests per client, per domain
+                 domain_delay = 0,          # seconds between requests per domain, across all clients
+                 streams_per_domain = 1):   # max requests in flight per client, per domain
+
+        self.client_delay = client_delay
+        self.domain_delay = domain_delay
+        self.streams_per_domain = streams_per_domain
+
+        self.pending = defaultdict(deque)   # {'domain': deque(['url', ...]), ...}
+        self.heap = []                      # [(ready_time, 'domain'), ...], may hold stale entries
+        self.ready_at = {}                  # {'domain': ready_time of its live heap entry}
+        self.domain_ready = {}              # {'domain': earliest time any client may send to it}
+        self.client_ready = {}              # {(socks_port, 'domain'): earliest time this client may send to it}
+        self.active = {}                    # {(socks_port, 'domain'): requests in flight}
+        self.blocked = set()                # domains that are due, but not on any idle client
+        self.size = 0
+        self.releases = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, url, domain):
+        """Queue url, which belongs to domain"""
+        self.pending[domain].append(url)
+        self.size += 1
+        if domain not in self.ready_at:
+            self._schedule(domain, self.domain_ready.get(domain, 0))
+
+    def _schedule(self, domain, ready_time):
+        self.ready_at[domain] = ready_time
+        heapq.heappush(self.heap, (ready_time, domain))
+
+    def _clientCanSend(self, socks_port, domain, now):
+        key = (socks_port, domain)
+        return (self.active.get(key, 0) < self.streams_per_domain
+                and self.client_ready.get(key, 0) <= now)
+
+    def next(self, idle_ports, now = None):
+        """Returns (url, domain, socks_port) for a url that may be sent right now on one of
+           idle_ports (tried in order), or None if nothing is ready"""
+        if not idle_ports:
+            return None
+        now = monotonic() if now is None else now
+
+        while self.heap and self.heap[0][0] <= now:
+            ready_time, domain = heapq.heappop(self.heap)
+            if self.ready_at.get(domain) != ready_time:
+                continue    # stale entry, domain was rescheduled
+
+            socks_port = next((p for p in idle_ports if self._clientCanSend(p, domain, now)), None)
+            if socks_port is None:
+                # every idle client has hit this domain too recently: come back when the first of
+                # them may send to it again, or sooner if another client frees up (see release())
+                self.blocked.add(domain)
+                del self.ready_at[domain]
+                waits = [self.client_ready.get((p, domain), 0) for p in idle_ports
+                         if self.active.get((p, domain), 0) < self.streams_per_domain]
+                if waits:
+                    self._schedule(domain, max(min(waits), self.domain_ready.get(domain, 0)))
+                continue
+
+            url = self.pending[domain].popleft()
+            self.size -= 1
+            self.blocked.discard(domain)
+            self.active[(socks_port, domain)] = self.active.get((socks_port, domain), 0) + 1
+            self.domain_ready[domain] = now + self.domain_delay
+            if self.pending[domain]:
+                self._schedule(domain, self.domain_ready[domain])
+            else:
+                del self.pending[domain]
+                del self.ready_at[domain]
+            return (url, domain, socks_port)
+
+        return None
+
+    def claim(self, idle_ports, domain, now = None):
+        """Returns the first of idle_ports that may send another request to domain right now, counting
+           that request as in flight (release() it like any other), or None. For sending a url outside
+           the queue, e.g. a duplicate of a slow fetch"""
+        now = monotonic() if now is None else now
+        if self.domain_ready.get(domain, 0) > now:
+            return None
+        socks_port = next((p for p in idle_ports if self._clientCanSend(p, domain, now)), None)
+        if socks_port is None:
+            return None
+
+        self.active[(socks_port, domain)] = self.active.get((socks_port, domain), 0) + 1
+        self.domain_ready[domain] = now + self.domain_delay
+        if domain in self.ready_at and self.ready_at[domain] < self.domain_ready[domain]:
+            self._schedule(domain, self.domain_ready[domain])     # queued urls of domain wait their turn too
+        return socks_port
+
+    def release(self, socks_port, domain, now = None):
+        """A request to domain over socks_port has finished"""
+        now = monotonic() if now is None else now
+        key = (socks_port, domain)
+        self.active[key] -= 1
+        if not self.active[key]:
+            del self.active[key]
+        self.client_ready[key] = now + self.client_delay
+
+        # domains that were waiting on a client may be able to go out on this one
+        for blocked in self.blocked:
+            if blocked in self.pending:
+                self._schedule(blocked, max(self.domain_ready.get(blocked, 0), now))
+        self.blocked.clear()
+
+        self.releases += 1
+        if self.releases % PRUNE_EVERY == 0:
+            self.prune(now)
+
+    def drain(self):
+        """Remove and return every queued url"""
+        urls = [url for queue in self.pending.values() for url in queue]
+        self.pending.clear()
+        self.heap = []
+        self.ready_at = {}
+        self.blocked.clear()
+        self.size = 0
+        return urls
+
+    def prune(self, now = None):
+        """Forget rate limits that have already expired, so long crawls over many domains stay small"""
+        now = monotonic() if now is None else now
+        self.client_ready = {k: t for k, t in self.client_ready.items() if t > now}
+        self.domain_ready = {d: t for d, t in self.domain_ready.items() if t > now or d in self.pending}
+
+    def delay(self, now = None):
+        """Seconds until the next queued url may be ready (0 if one is due now), or None if nothing is queued"""
+        while self.heap and self.ready_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)    # discard stale entries
+        if not self.heap:
+            return None
+        now = monotonic() if now is None else now
+        return max(self.heap[0][0] - now, 0)
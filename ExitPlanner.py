@@ -0,0 +1,281 @@
+import os
+import socket
+import struct
+import logging
+from bisect import bisect_right
+from collections import defaultdict
+from threading import Lock
+
+import stem.descriptor
+from stem.descriptor import DocumentHandler
+
+import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+EXITS_PER_CLIENT = 8            # exits in each tor client's ExitNodes
+TARGET_PORTS = (80, 443)        # ports an exit's policy has to allow for it to be planned
+REQUIRED_FLAGS = ('Exit', 'Fast', 'Running', 'Valid')
+GEOIP_FILE = '/usr/share/tor/geoip'     # tor's ipv4 -> country db
+WEIGHT_SCALE = 10000            # the consensus' bandwidth-weights are fractions of this
+
+# (consensus file, its descriptor type, microdescriptor files) in a tor DataDirectory, in the order they're
+# tried: the full consensus carries each relay's exit policy summary, the microdesc flavored one only points
+# to the microdescriptors that do
+CONSENSUS_FILES = (('cached-consensus', 'network-status-consensus-3 1.0', ()),
+                   ('cached-microdesc-consensus', 'network-status-microdesc-consensus-3 1.0',
+                    ('cached-microdescs', 'cached-microdescs.new')))
+
+
+class GeoIP():
+    """IPv4 address -> two letter country code, from tor's geoip file ('low,high,CC' lines of integer ranges)"""
+
+    def __init__(self, path = GEOIP_FILE):
+        self.starts, self.ends, self.countries = [], [], []
+        try:
+            with open(path) as f:
+                ranges = sorted(line.strip().split(',') for line in f if line.strip() and not line.startswith('#'))
+            for low, high, country in ((int(l), int(h), c) for l, h, c in ranges):
+                self.starts.append(low)
+                self.ends.append(high)
+                self.countries.append(country.lower())
+        except (OSError, ValueError) as e:
+            logger.warning("Can't read tor's geoip file %s, exits won't have countries: %s", path, e)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def country(self, address):
+        try:
+            ip = struct.unpack('>I', socket.inet_aton(address))[0]
+        except (OSError, TypeError):
+            return None
+        i = bisect_right(self.starts, ip) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return self.countries[i]
+        return None
+
+
+def loadPolicies(data_dir, files, digests):
+    """{microdescriptor digest: exit policy} of the microdescriptors in data_dir's files whose digest is in digests"""
+    policies = {}
+    for name in files:
+        path = os.path.join(data_dir, name)
+        if not os.path.isfile(path):
+            continue
+        for desc in stem.descriptor.parse_file(path, 'microdescriptor 1.0', validate = False):
+            digest = desc.digest()
+            if digest in digests:
+                policies[digest] = desc.exit_policy
+    return policies
+
+
+class ExitPlanner():
+    """Index of the exits in a cached consensus, and the plan of which of them each of a pool's tor
+       clients gets as its ExitNodes, so exits are chosen up front instead of only being excluded
+       after they failed.
+
+       Each exit is indexed with its flags, consensus weight as an exit (bandwidth scaled by the
+       consensus' Wee/Wed bandwidth-weights, as tor does when it picks exits), country and which of
+       target_ports its exit policy allows. Candidates have required_flags, allow every one of
+       target_ports, are in one of countries (if given) and aren't excluded.
+
+       plan() deals the best candidates out to a set of clients in snake order (1..n, n..1, ...), so
+       each client gets a disjoint set of about the same total weight. A restarted client is assign()ed
+       a fresh set from the best candidates no client has, before any exits retired from replaced clients.
+       When exits are excluded, topUp() replaces them in the sets they were part of"""
+
+    def __init__(self,
+                 target_ports = TARGET_PORTS,
+                 exits_per_client = EXITS_PER_CLIENT,
+                 countries = None,                  # e.g. {'de', 'nl'}, default any country
+                 required_flags = REQUIRED_FLAGS,
+                 geoip_file = GEOIP_FILE,
+                 metrics = None):                   # MetricsRegistry, default Metrics.REGISTRY
+
+        self.target_ports = frozenset(int(p) for p in target_ports)
+        self.exits_per_client = exits_per_client
+        self.countries = frozenset(c.lower() for c in countries) if countries else None
+        self.required_flags = frozenset(required_flags)
+        self.geoip_file = geoip_file
+        self.geoip = None           # GeoIP, read the first time an index is built
+
+        self.exits = {}             # {'fingerprint': {'nickname': ..., 'address': ..., 'flags': ..., 'bandwidth': ...,
+                                    #                  'weight': ..., 'country': ..., 'ports': frozenset([port, ...])}}
+        self.by_port = {}           # {port: {'fingerprint', ...}} exits whose policy allows port
+        self.by_country = {}        # {'country': {'fingerprint', ...}}
+        self.assigned = {}          # {'socks_port': ['fingerprint', ...]}
+        self.retired = set()        # exits taken off replaced clients, handed out again last
+        self.lock = Lock()
+
+        self.metrics = metrics or Metrics.REGISTRY
+        self.candidate_gauge = self.metrics.gauge('torgetter_exit_candidates', 'Usable exits in the consensus the planner last indexed')
+        self.planned_gauge = self.metrics.gauge('torgetter_planned_exits', 'Exits assigned to tor clients by the planner')
+        self.assignments = self.metrics.counter('torgetter_exit_assignments_total',
+                                                'ExitNodes sets handed to tor clients, by kind', ('kind',))
+
+    def __len__(self):
+        return len(self.exits)
+
+    def load(self, data_dir):
+        """(Re)build the index from the cached consensus in a tor DataDirectory (or a pool's seed directory),
+           keeping the current assignments. Returns the number of exits indexed, 0 if there's nothing to read"""
+        for consensus_file, document_type, microdesc_files in CONSENSUS_FILES:
+            path = os.path.join(data_dir, consensus_file)
+            if not os.path.isfile(path):
+                continue
+            try:
+                document = next(stem.descriptor.parse_file(path, document_type, validate = False,
+                                                           document_handler = DocumentHandler.DOCUMENT))
+                statuses = list(document.routers.values())
+                policies = None
+                if microdesc_files:
+                    digests = {s.microdescriptor_digest for s in statuses if 'Exit' in s.flags}
+                    policies = loadPolicies(data_dir, microdesc_files, digests)
+            except (OSError, ValueError, StopIteration) as e:
+                logger.warning("Failed to read the cached consensus %s: %s", path, e)
+                continue
+            return self.build(statuses, document.bandwidth_weights, policies)
+        return 0
+
+    def build(self, statuses, bandwidth_weights = None, policies = None):
+        """Replace the index with the exits among the router status entries statuses. Exit policies are
+           the entries' own (full consensus) or looked up in policies by microdescriptor digest, relays
+           whose policy isn't known allow none of the target ports. Returns the number of exits indexed"""
+        if self.geoip is None:
+            self.geoip = GeoIP(self.geoip_file)
+        weights = bandwidth_weights or {}
+        exits = {}
+        by_port = defaultdict(set)
+        by_country = defaultdict(set)
+
+        for status in statuses:
+            flags = frozenset(status.flags)
+            if 'Exit' not in flags or 'BadExit' in flags:
+                continue
+            policy = getattr(status, 'exit_policy', None)
+            if policy is None and policies:
+                policy = policies.get(getattr(status, 'microdescriptor_digest', None))
+            ports = frozenset(p for p in self.target_ports if policy is not None and policy.can_exit_to(port = p))
+            # as an exit, a relay that's also a guard only gets Wed of its bandwidth, others Wee
+            weight = (status.bandwidth or 0) * weights.get('Wed' if 'Guard' in flags else 'Wee',
+                                                           WEIGHT_SCALE) / WEIGHT_SCALE
+            country = self.geoip.country(status.address)
+
+            exits[status.fingerprint] = {'nickname': status.nickname,
+                                         'address': status.address,
+                                         'flags': flags,
+                                         'bandwidth': status.bandwidth,
+                                         'weight': weight,
+                                         'country': country,
+                                         'ports': ports}
+            for port in ports:
+                by_port[port].add(status.fingerprint)
+            if country:
+                by_country[country].add(status.fingerprint)
+
+        with self.lock:
+            self.exits = exits
+            self.by_port = dict(by_port)
+            self.by_country = dict(by_country)
+            self.retired &= exits.keys()
+            usable = len(self._candidates())
+        self.candidate_gauge.set(usable)
+        logger.info("Indexed %d exits from the consensus, %d of them usable", len(exits), usable)
+        return len(exits)
+
+    def _candidates(self, excluded = ()):
+        """Usable exits no client has, best first. Call with lock held"""
+        usable = set(self.exits)
+        for port in self.target_ports:
+            usable &= self.by_port.get(port, set())
+        if self.countries:
+            usable &= set().union(*(self.by_country.get(c, ()) for c in self.countries))
+        usable = {fp for fp in usable if self.required_flags <= self.exits[fp]['flags']}
+        usable -= set(excluded)
+        for exits in self.assigned.values():
+            usable.difference_update(exits)
+        return sorted(usable, key = lambda fp: (fp in self.retired, -self.exits[fp]['weight'], fp))
+
+    def candidates(self, excluded = ()):
+        """Fingerprints of the usable exits that aren't excluded or assigned to a client, best first"""
+        with self.lock:
+            return self._candidates(excluded)
+
+    def plan(self, socks_ports, excluded = (), count = None):
+        """Deal count (default exits_per_client) of the best candidates to each of socks_ports, replacing
+           their current sets. Returns {'socks_port': ['fingerprint', ...]}, with fewer exits per client
+           (or none) if there aren't enough candidates to go round"""
+        socks_ports = list(socks_ports)
+        if not socks_ports:
+            return {}
+        count = count or self.exits_per_client
+        with self.lock:
+            for socks_port in socks_ports:
+                self.assigned.pop(socks_port, None)
+            candidates = self._candidates(excluded)[:count * len(socks_ports)]
+            plan = {socks_port: [] for socks_port in socks_ports}
+            for start in range(0, len(candidates), len(socks_ports)):
+                order = socks_ports if (start // len(socks_ports)) % 2 == 0 else reversed(socks_ports)
+                for socks_port, fingerprint in zip(order, candidates[start:start + len(socks_ports)]):
+                    plan[socks_port].append(fingerprint)
+            self.assigned.update((socks_port, exits) for socks_port, exits in plan.items() if exits)
+            self.planned_gauge.set(sum(len(exits) for exits in self.assigned.values()))
+        self.assignments.inc(sum(1 for exits in plan.values() if exits), kind = 'planned')
+
+        if len(candidates) < count * len(socks_ports):
+            logger.warning("Only %d usable exits for %d tor clients, planned %d per client instead of %d",
+                           len(candidates), len(socks_ports), len(candidates) // len(socks_ports), count)
+        return plan
+
+    def assign(self, socks_port, excluded = (), count = None):
+        """Give socks_port a fresh set of count (default exits_per_client) exits, retiring its current
+           one. Returns the new set, empty if there are no candidates left"""
+        count = count or self.exits_per_client
+        with self.lock:
+            self.retired.update(self.assigned.pop(socks_port, ()))
+            exits = self._candidates(excluded)[:count]
+            if exits:
+                self.assigned[socks_port] = exits
+                self.retired.difference_update(exits)
+            self.planned_gauge.set(sum(len(e) for e in self.assigned.values()))
+        if exits:
+            self.assignments.inc(kind = 'assigned')
+            logger.debug("Assigned %d exits to tor client @ port %s", len(exits), socks_port)
+        return exits
+
+    def topUp(self, socks_port, excluded, count = None):
+        """Drop the excluded exits from socks_port's set + refill it to count (default exits_per_client)
+           from the best candidates. Returns the new set, or None if none of its exits were excluded"""
+        count = count or self.exits_per_client
+        excluded = set(excluded)
+        with self.lock:
+            exits = self.assigned.get(socks_port)
+            if not exits or not excluded.intersection(exits):
+                return None
+            kept = [fp for fp in exits if fp not in excluded]
+            # still assigned while the candidates are picked, so the kept exits aren't picked again
+            exits = kept + self._candidates(excluded)[:count - len(kept)]
+            if exits:
+                self.assigned[socks_port] = exits
+            else:
+                del self.assigned[socks_port]
+            self.planned_gauge.set(sum(len(e) for e in self.assigned.values()))
+        self.assignments.inc(kind = 'topped_up')
+        logger.debug("Topped up tor client @ port %s to %d exits", socks_port, len(exits))
+        return exits
+
+    def retire(self, socks_port):
+        """Take socks_port's exits back, e.g. when its client is replaced. They're handed out again
+           only after every other candidate"""
+        with self.lock:
+            exits = self.assigned.pop(socks_port, ())
+            self.retired.update(exits)
+            self.planned_gauge.set(sum(len(e) for e in self.assigned.values()))
+        return exits
+
+    def exitNodes(self, socks_port):
+        """socks_port's exits as an ExitNodes value, or None if it doesn't have any"""
+        exits = self.assigned.get(socks_port)
+        return ','.join(exits) if exits else None
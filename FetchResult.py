@@ -0,0 +1,135 @@
+from time import monotonic
+from datetime import timedelta
+
+
+DEFAULT_ENCODING = 'utf-8'      # for bodies whose response didn't name a charset
+
+
+def decodeBody(body, encoding = None):
+    """bytes -> str, in encoding if python knows it, replacing anything that doesn't decode"""
+    try:
+        return body.decode(encoding or DEFAULT_ENCODING, errors = 'replace')
+    except LookupError:     # bogus charset in the Content-Type header
+        return body.decode(DEFAULT_ENCODING, errors = 'replace')
+
+
+class FetchResult():
+    """Outcome of one fetch. Keeps the raw body bytes (+ the charset its response named) and only
+       decodes them into html the first time that's asked for, so text decoding happens wherever the
+       result is consumed instead of in the fetch threads. Timings are monotonic() clock readings.
+
+       Also reads like the result dicts of old: result['html'], result['time'] (a timedelta), ...,
+       and any other key can be set on it, e.g. result['processed'] by a Pipeline"""
+
+    __slots__ = ('url', 'body', 'encoding', 'port', 'exit_fingerprint', 'error',
+                 'started', 'finished', 'wire_size', '_html', 'extras')
+
+    # keys result dicts have always had + the raw body
+    KEYS = ('url', 'html', 'time', 'port', 'exit_fingerprint', 'error', 'body', 'encoding')
+
+    def __init__(self,
+                 url,
+                 body,                      # bytes, None if the fetch failed
+                 port,
+                 exit_fingerprint = None,
+                 error = None,
+                 encoding = None,           # charset the response named, if any
+                 started = None,            # monotonic() when the fetch started ...
+                 finished = None,           # ... and when it finished, default now
+                 wire_size = None,          # bytes that came over the network (before decompression), if known
+                 html = None):              # the body, already decoded, e.g. a browser's page source
+
+        if body is None and html is not None:
+            body = html.encode(DEFAULT_ENCODING)
+            encoding = DEFAULT_ENCODING
+        self.url = url
+        self.body = body
+        self.encoding = encoding
+        self.port = port
+        self.exit_fingerprint = exit_fingerprint
+        self.error = error
+        self.finished = monotonic() if finished is None else finished
+        self.started = self.finished if started is None else started
+        self.wire_size = wire_size
+        self._html = html
+        self.extras = None          # {key: value} set through result[key] = value
+
+    @property
+    def html(self):
+        if self._html is None and self.body is not None:
+            self._html = decodeBody(self.body, self.encoding)
+        return self._html
+
+    @property
+    def seconds(self):
+        return self.finished - self.started
+
+    @property
+    def time(self):
+        return timedelta(seconds = self.seconds)
+
+    @property
+    def size(self):
+        """Length of the (decompressed) body in bytes"""
+        return len(self.body) if self.body is not None else 0
+
+    @property
+    def ok(self):
+        """Did the fetch get a non-empty body?"""
+        return self.error is None and bool(self.body)
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        if self.extras and key in self.extras:
+            return self.extras[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'html':
+            self._html = value
+        elif key in self.KEYS and key != 'time':
+            setattr(self, key, value)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[key] = value
+
+    def __contains__(self, key):
+        return key in self.KEYS or bool(self.extras and key in self.extras)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.KEYS + tuple(self.extras or ())
+
+    def copy(self, **changes):
+        """Shallow copy, with attributes in changes replaced"""
+        result = FetchResult.__new__(FetchResult)
+        for slot in self.__slots__:
+            setattr(result, slot, getattr(self, slot))
+        if self.extras:
+            result.extras = dict(self.extras)
+        for key, value in changes.items():
+            result[key] = value
+        return result
+
+    def __getstate__(self):
+        # the decoded html is left out whenever it can be decoded again, so the body isn't pickled twice
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        if self.body is not None:
+            state['_html'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return (f"FetchResult(url={self.url!r}, size={self.size}, seconds={self.seconds:.3f}, port={self.port!r}, "
+                f"exit_fingerprint={self.exit_fingerprint!r}, error={self.error!r})")
+
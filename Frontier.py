@@ -0,0 +1,122 @@
+import sqlite3
+from time import time
+from threading import Lock
+
+import tldextract
+
+from ResponseCache import normalizeURL
+
+
+FRONTIER_FILE = './frontier.sqlite'
+MAX_ATTEMPTS = 3                # a url that failed this many times is marked failed for good
+BATCH_SIZE = 500                # urls handed out (+ marked in flight) per database round trip
+COMMIT_EVERY = 100              # done/failed marks per commit; after a crash, uncommitted ones are just fetched again
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def domainFromURL(url):
+    """Registrable domain of url, e.g. 'example.co.uk'"""
+    tld = tldextract.extract(url)
+    return tld.domain + "." + tld.suffix
+
+
+class Frontier():
+    """Durable, deduplicating url queue for a crawl job, stored in sqlite.
+
+       Urls are normalized and deduplicated when they're added, and their registrable domain is
+       worked out once and stored alongside them. Iterating yields (url, domain) pairs, interleaved
+       across domains, which TorGetter.fetchStream() accepts directly; fetchFrontier() records each
+       url as done or failed, so a job that crashed picks up where it stopped."""
+
+    def __init__(self,
+                 path = FRONTIER_FILE,
+                 max_attempts = MAX_ATTEMPTS):
+
+        self.max_attempts = max_attempts
+        self.lock = Lock()
+        self.uncommitted = 0
+
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS urls (
+                               url TEXT PRIMARY KEY,
+                               domain TEXT,
+                               state TEXT,
+                               attempts INTEGER DEFAULT 0,
+                               error TEXT,
+                               updated REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS urls_state_domain ON urls (state, domain)')
+
+        # whatever was in flight when the last run died never finished
+        self.db.execute('UPDATE urls SET state = ? WHERE state = ?', (PENDING, IN_FLIGHT))
+        self.db.commit()
+
+    def add(self, urls):
+        """Queue urls (any iterable), skipping ones already in the frontier. Returns how many were new"""
+        rows = ((url, domainFromURL(url), PENDING, time()) for url in map(normalizeURL, urls))
+        with self.lock:
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO urls (url, domain, state, updated) VALUES (?, ?, ?, ?)', rows)
+            self.db.commit()
+            return self.db.total_changes - before
+
+    def __iter__(self):
+        """Yields pending (url, domain) pairs, marking them in flight a batch at a time.
+           Each batch takes the oldest urls of every domain before the second-oldest of any"""
+        while True:
+            with self.lock:
+                batch = self.db.execute('''SELECT url, domain FROM (
+                                               SELECT url, domain, ROW_NUMBER() OVER (PARTITION BY domain ORDER BY rowid) AS n
+                                               FROM urls WHERE state = ?)
+                                           ORDER BY n LIMIT ?''', (PENDING, BATCH_SIZE)).fetchall()
+                if not batch:
+                    return
+                self.db.executemany('UPDATE urls SET state = ?, updated = ? WHERE url = ?',
+                                    ((IN_FLIGHT, time(), url) for url, _ in batch))
+                self.db.commit()
+            yield from batch
+
+    def _mark(self, sql, args):
+        with self.lock:
+            self.db.execute(sql, args)
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def markDone(self, url):
+        self._mark('UPDATE urls SET state = ?, error = NULL, updated = ? WHERE url = ?', (DONE, time(), url))
+
+    def markFailed(self, url, error = None, retry = True):
+        """Record a failed attempt: url goes back to pending, or to failed once it's used up max_attempts.
+           Without retry (the failure would just happen again, e.g. a rejected Content-Type) it's failed right away"""
+        attempts_left = self.max_attempts if retry else 1
+        self._mark('''UPDATE urls SET attempts = attempts + 1, error = ?, updated = ?,
+                                      state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END
+                      WHERE url = ?''', (str(error) if error else None, time(), attempts_left, FAILED, PENDING, url))
+
+    def counts(self):
+        """{state: number of urls}"""
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM urls GROUP BY state').fetchall())
+
+    def pending(self):
+        """Number of urls waiting to be fetched"""
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM urls WHERE state = ?', (PENDING,)).fetchone()[0]
+
+    def domains(self):
+        """{domain: number of pending urls}"""
+        with self.lock:
+            return dict(self.db.execute('SELECT domain, COUNT(*) FROM urls WHERE state = ? GROUP BY domain',
+                                        (PENDING,)).fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,269 @@
+import bisect
+from time import monotonic
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# seconds; fetches over tor are slow, so the buckets go well past the usual web latencies
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# seconds spent waiting to acquire a lock
+LOCK_WAIT_BUCKETS = (1e-5, 1e-4, 1e-3, 0.01, 0.1, 1, 10)
+MAX_LABEL_SETS = 10000          # label combinations per metric before new ones are folded into OTHER_LABEL
+OTHER_LABEL = 'other'
+
+
+class Metric():
+    """A named family of values, one per combination of label values"""
+    kind = None
+
+    def __init__(self, registry, name, help, labelnames = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}        # {(label values, ...): value}
+        self.lock = Lock()
+
+    def _key(self, labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        if key not in self.values and len(self.values) >= MAX_LABEL_SETS:
+            key = (OTHER_LABEL,) * len(key)    # e.g. one label set per domain of a huge crawl
+        return key
+
+    def labelDict(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def _notify(self, key, value):
+        for hook in self.registry.hooks:
+            hook(self, self.labelDict(key), value)
+
+
+class Counter(Metric):
+    """Monotonically increasing count, e.g. fetches or bytes received"""
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        if self.registry.hooks:
+            self._notify(key, amount)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': self.labelDict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. queue depth"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+        if self.registry.hooks:
+            self._notify(key, value)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels))
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': self.labelDict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets, plus their count + sum"""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            stats = self.values.get(key)
+            if stats is None:
+                # [count per bucket (+ one past the last bucket), count, sum]
+                stats = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            stats[0][index] += 1
+            stats[1] += 1
+            stats[2] += value
+        if self.registry.hooks:
+            self._notify(key, value)
+
+    def time(self, **labels):
+        """Context manager observing how many seconds its body took"""
+        return Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = []
+            for key, (counts, count, total) in self.values.items():
+                cumulative = 0
+                buckets = {}
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    buckets[bound] = cumulative
+                snapshot.append({'labels': self.labelDict(key), 'count': count, 'sum': total, 'buckets': buckets})
+            return snapshot
+
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(monotonic() - self.start, **self.labels)
+
+
+class TimedLock():
+    """threading.Lock that records how long every acquire waited in a histogram, labelled lock=name"""
+
+    def __init__(self, histogram, name):
+        self.lock = Lock()
+        self.histogram = histogram
+        self.name = name
+
+    def acquire(self, blocking = True, timeout = -1):
+        start = monotonic()
+        acquired = self.lock.acquire(blocking, timeout)
+        if blocking:
+            self.histogram.observe(monotonic() - start, lock = self.name)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class MetricsRegistry():
+    """Holds every metric, by name. Metrics are read through snapshot() or prometheusText() (which
+       serve() exposes over HTTP), and/or pushed as they change to hooks added with addHook()"""
+
+    def __init__(self):
+        self.metrics = {}       # {'name': Metric}
+        self.hooks = []         # [callable(metric, {label: value}, value), ...]
+        self.lock = Lock()
+        self.server = None
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(self, name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already exists as a {metric.kind} with labels {metric.labelnames}")
+            return metric
+
+    def counter(self, name, help, labelnames = ()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames = ()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets = buckets)
+
+    def timedLock(self, name):
+        """TimedLock recording its wait times in the torgetter_lock_wait_seconds histogram"""
+        return TimedLock(self.histogram('torgetter_lock_wait_seconds', 'Time spent waiting to acquire a lock',
+                                        ('lock',), buckets = LOCK_WAIT_BUCKETS), name)
+
+    def addHook(self, hook):
+        """Call hook(metric, labels, value) on every update: the amount added for counters,
+           the new value for gauges, the observed value for histograms"""
+        self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        self.hooks.remove(hook)
+
+    def snapshot(self):
+        """{'name': {'type': ..., 'help': ..., 'values': [...]}} of every metric, safe to JSON encode"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {m.name: {'type': m.kind, 'help': m.help, 'values': m.snapshot()} for m in metrics}
+
+    def reset(self):
+        """Zero every metric (they stay registered)"""
+        with self.lock:
+            for metric in self.metrics.values():
+                with metric.lock:
+                    metric.values.clear()
+
+    def prometheusText(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self.snapshot().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for value in metric['values']:
+                if metric['type'] == 'histogram':
+                    for bound, count in value['buckets'].items():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{_labelText(dict(value['labels'], le = le))} {count}")
+                    lines.append(f"{name}_count{_labelText(value['labels'])} {value['count']}")
+                    lines.append(f"{name}_sum{_labelText(value['labels'])} {value['sum']}")
+                else:
+                    lines.append(f"{name}{_labelText(value['labels'])} {value['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port = 9100, address = '127.0.0.1'):
+        """Serve prometheusText() at http://address:port/metrics from a background thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheusText().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target = self.server.serve_forever, daemon = True).start()
+        return self.server
+
+    def stopServing(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _labelText(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+REGISTRY = MetricsRegistry()    # default registry, shared by every pool + getter that isn't given its own
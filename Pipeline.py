@@ -0,0 +1,118 @@
+import os
+import logging
+import multiprocessing
+from time import monotonic
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import Metrics
+from FetchResult import FetchResult
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROCESSES = os.cpu_count() or 1
+PENDING_PER_PROCESS = 4         # results queued for processing per worker process before the fetch loop waits
+# forking a process that has stem's event threads + the fetch threads running can leave the child holding
+# locks that nothing will release, so workers come from a clean forkserver process instead
+START_METHOD = 'forkserver'
+
+
+def processingInput(result):
+    """The part of a fetch result that is shipped to the worker processes: no error, and the body as
+       raw bytes, to be decoded in the worker when a stage asks for 'html'"""
+    return FetchResult(result.url, result.body, result.port, result.exit_fingerprint, encoding = result.encoding)
+
+
+def runStages(stages, item):
+    """Runs in a worker process: feed item through each stage in turn, returns (output, seconds, error)"""
+    start = monotonic()
+    try:
+        for stage in stages:
+            item = stage(item)
+        return (item, monotonic() - start, None)
+    except Exception as e:
+        return (None, monotonic() - start, e)
+
+
+class Pipeline():
+    """Runs fetch results through user-supplied processing stages (parsing, extraction, ...) in a pool of
+       worker processes, so CPU-heavy work scales across cores instead of contending with the fetch threads
+       for the GIL.
+
+       stages are called in order, each with the previous one's return value; the first gets a FetchResult
+       with the result's url, body/html, port and exit_fingerprint. They must be picklable, i.e. module level functions
+       (or functools.partial's of them), as must what they return. process() consumes a result stream as it is
+       produced and yields each result once its stages have run, with the last stage's output in
+       result['processed'] and anything a stage raised in result['process_error']. Failed fetches skip the
+       stages and come out straight away, with result['processed'] = None.
+
+       Backpressure: at most max_pending results are waiting on the workers. Once that many are, process()
+       stops pulling from the result stream, which stops fetchStream() handing out new urls, until the
+       workers catch up. Fetches already in flight carry on meanwhile."""
+
+    def __init__(self,
+                 stages,                    # [callable(item) -> item, ...]
+                 processes = DEFAULT_PROCESSES,
+                 max_pending = None,        # default processes * PENDING_PER_PROCESS
+                 start_method = START_METHOD,
+                 metrics = None):           # MetricsRegistry, default Metrics.REGISTRY
+
+        if not stages:
+            raise ValueError("Pipeline needs at least one stage")
+        self.stages = tuple(stages)
+        self.processes = processes
+        self.max_pending = max_pending or processes * PENDING_PER_PROCESS
+        self.start_method = start_method
+
+        self.metrics = metrics or Metrics.REGISTRY
+        self.process_seconds = self.metrics.histogram('torgetter_process_seconds',
+                                                      'Time spent running the processing stages on a result')
+        self.processed = self.metrics.counter('torgetter_processed_total', 'Results processed, by outcome',
+                                              ('outcome',))
+        self.pending = self.metrics.gauge('torgetter_process_pending', 'Results waiting on the processing workers')
+        self.backpressure_seconds = self.metrics.histogram('torgetter_process_backpressure_seconds',
+                                                           'Time the result stream spent blocked on a full pipeline')
+
+    def _finish(self, future, result):
+        try:
+            output, seconds, error = future.result()
+        except Exception as e:     # the output or exception couldn't be pickled, or a worker died
+            output, seconds, error = None, None, e
+        if seconds is not None:
+            self.process_seconds.observe(seconds)
+        if error:
+            logger.warning("Processing %s failed: %r", result['url'], error)
+        self.processed.inc(outcome = 'error' if error else 'ok')
+        result['processed'] = output
+        result['process_error'] = error
+        return result
+
+    def process(self, results):
+        """Run every successful result of the iterable results through the stages, yielding results
+           as their processing completes (so not necessarily in the order they came in)"""
+        context = multiprocessing.get_context(self.start_method)
+        with ProcessPoolExecutor(max_workers = self.processes, mp_context = context) as executor:
+            pending = {}        # {future: result}
+            for result in results:
+                if not result.ok:
+                    result['processed'] = None
+                    result['process_error'] = None
+                    yield result
+                else:
+                    pending[executor.submit(runStages, self.stages, processingInput(result))] = result
+
+                # hand back whatever has finished, and block while the workers are max_pending behind
+                done = [f for f in pending if f.done()]
+                if len(pending) - len(done) >= self.max_pending:
+                    start = monotonic()
+                    done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                    self.backpressure_seconds.observe(monotonic() - start)
+                for future in done:
+                    yield self._finish(future, pending.pop(future))
+                self.pending.set(len(pending))
+
+            while pending:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    yield self._finish(future, pending.pop(future))
+                self.pending.set(len(pending))
@@ -0,0 +1,105 @@
+import logging
+from threading import Lock
+
+import stem
+from stem.control import EventType
+
+
+logger = logging.getLogger(__name__)
+
+
+class RelayIndex():
+    """In-memory {fingerprint: router status} index shared by a TorClientPool.
+
+       Built once from the consensus of one client's controller, then kept current from its
+       NEWCONSENSUS (full replacement) and NS (incremental) events, so looking up the relays
+       on a circuit is a dict read instead of a control port round trip per hop."""
+
+    def __init__(self):
+        self.relays = {}        # {'fingerprint': {'nickname': ..., 'address': ..., 'flags': ..., 'bandwidth': ..., 'country': ...}}
+        self.controller = None  # controller we're subscribed to for updates
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.relays)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.relays
+
+    def attach(self, controller):
+        """Build the index from controller's consensus + follow its updates from now on.
+           Detaches from the previous controller, if any"""
+        self.detach()
+        self.controller = controller
+        controller.add_event_listener(self._newConsensus, EventType.NEWCONSENSUS)
+        controller.add_event_listener(self._networkStatus, EventType.NS)
+        self.rebuild(controller.get_network_statuses())
+        logger.info("Indexed %d relays from the consensus", len(self.relays))
+
+    def detach(self):
+        """Stop following updates from the current controller"""
+        if not self.controller:
+            return
+        try:
+            self.controller.remove_event_listener(self._newConsensus)
+            self.controller.remove_event_listener(self._networkStatus)
+        except stem.ControllerError:
+            pass    # controller already closed
+        self.controller = None
+
+    @staticmethod
+    def _entry(status, country = None):
+        return {'nickname': status.nickname,
+                'address': status.address,
+                'flags': frozenset(status.flags),
+                'bandwidth': status.bandwidth,
+                'country': country}
+
+    def rebuild(self, statuses):
+        """Replace the whole index with the given router status entries"""
+        relays = {}
+        for status in statuses:
+            old = self.relays.get(status.fingerprint)
+            country = old['country'] if old and old['address'] == status.address else None
+            relays[status.fingerprint] = self._entry(status, country)
+        with self.lock:
+            self.relays = relays
+
+    def update(self, statuses):
+        """Add or replace the given router status entries"""
+        with self.lock:
+            for status in statuses:
+                old = self.relays.get(status.fingerprint)
+                country = old['country'] if old and old['address'] == status.address else None
+                self.relays[status.fingerprint] = self._entry(status, country)
+
+    def _newConsensus(self, event):
+        self.rebuild(event.desc)
+
+    def _networkStatus(self, event):
+        self.update(event.desc)
+
+    def get(self, fingerprint):
+        """Router status dict for fingerprint, or None if it's not in the consensus"""
+        return self.relays.get(fingerprint)
+
+    def address(self, fingerprint):
+        relay = self.relays.get(fingerprint)
+        return relay['address'] if relay else None
+
+    def country(self, fingerprint):
+        """Two letter country code of the relay, looked up from tor's geoip db the first time it's asked for"""
+        relay = self.relays.get(fingerprint)
+        if not relay:
+            return None
+        if relay['country'] is None and self.controller:
+            try:
+                relay['country'] = self.controller.get_info('ip-to-country/' + relay['address'])
+            except stem.ControllerError:
+                return None
+        return relay['country']
+
+    def exits(self):
+        """Fingerprints of relays flagged Exit (and not BadExit)"""
+        return [fingerprint for fingerprint, relay in self.relays.items()
+                if 'Exit' in relay['flags'] and 'BadExit' not in relay['flags']]
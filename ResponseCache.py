@@ -0,0 +1,211 @@
+import os
+import re
+import hashlib
+import sqlite3
+from time import time
+from threading import Lock, get_ident
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+CACHE_DIRECTORY = './.torcache'
+CACHE_MAX_BYTES = 1024 ** 3     # total size of cached bodies before the least recently used get evicted
+EVICT_TO = 0.9                  # evict down to this fraction of max_bytes, so we don't evict on every store
+HEURISTIC_FRACTION = 0.1        # no explicit freshness: fresh for this fraction of the time since Last-Modified (RFC 7234)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalizeURL(url):
+    """Canonical form of url for use as a key: lowercase scheme + host, no default port,
+       no fragment, sorted query parameters, '/' for an empty path"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host += ':' + str(parts.port)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values = True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def _httpDate(value):
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def freshnessLifetime(headers, now = None):
+    """Seconds a response with these headers stays fresh, or None if it mustn't be stored at all"""
+    now = time() if now is None else now
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+
+    age = headers.get('Age', '')
+    age = int(age) if age.isdigit() else 0
+    max_age = re.search(r's-maxage\s*=\s*(\d+)', cache_control) or re.search(r'max-age\s*=\s*(\d+)', cache_control)
+    if max_age:
+        return max(int(max_age.group(1)) - age, 0)
+
+    date = _httpDate(headers.get('Date')) or now
+    expires = _httpDate(headers.get('Expires'))
+    if 'Expires' in headers:
+        return max(expires - date, 0) if expires else 0    # invalid Expires means already expired
+
+    last_modified = _httpDate(headers.get('Last-Modified'))
+    if last_modified:
+        return max((date - last_modified) * HEURISTIC_FRACTION - age, 0)
+    return 0
+
+
+class ResponseCache():
+    """On-disk HTTP response cache, keyed by normalized url.
+
+       Fresh entries are served without touching the network; stale ones with an ETag or
+       Last-Modified are revalidated with If-None-Match/If-Modified-Since, so an unchanged page
+       costs a 304 instead of a full download over tor. Bodies live in files next to a sqlite
+       index, and the least recently used are evicted once they add up to more than max_bytes."""
+
+    def __init__(self,
+                 directory = CACHE_DIRECTORY,
+                 max_bytes = CACHE_MAX_BYTES):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # stale = lookups that found an entry needing revalidation, of which revalidated = the ones that got a 304
+        self.counts = {'hits': 0, 'stale': 0, 'revalidated': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        os.makedirs(directory, exist_ok = True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread = False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                               key TEXT PRIMARY KEY,
+                               etag TEXT,
+                               last_modified TEXT,
+                               expires REAL,
+                               encoding TEXT,
+                               size INTEGER,
+                               accessed REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _bodyPath(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.body')
+
+    def lookup(self, url):
+        """Cached entry for url as a dict (with 'fresh' True if it can be used without revalidating),
+           or None on a miss. Counts the hit/miss"""
+        key = normalizeURL(url)
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified, expires, encoding FROM entries WHERE key = ?',
+                                  (key,)).fetchone()
+            if not row or not os.path.isfile(self._bodyPath(key)):
+                self.counts['misses'] += 1
+                return None
+            entry = {'key': key, 'etag': row[0], 'last_modified': row[1], 'expires': row[2],
+                     'encoding': row[3], 'fresh': row[2] > time()}
+            if entry['fresh']:
+                self.counts['hits'] += 1
+                self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time(), key))
+            elif entry['etag'] or entry['last_modified']:
+                self.counts['stale'] += 1
+            else:
+                self.counts['misses'] += 1
+                return None     # stale, and nothing to revalidate it with
+            return entry
+
+    def conditionalHeaders(self, entry):
+        """Request headers to revalidate a stale entry"""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def body(self, entry):
+        with open(self._bodyPath(entry['key']), 'rb') as f:
+            return f.read()
+
+    def text(self, entry):
+        return self.body(entry).decode(entry['encoding'] or 'utf-8', errors = 'replace')
+
+    def store(self, url, response, content = None):
+        """Cache a requests.Response, if it's a cacheable 200. content: its body, if it was streamed"""
+        if response.status_code != 200:
+            return False
+        lifetime = freshnessLifetime(response.headers)
+        if lifetime is None:
+            return False
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not lifetime and not (etag or last_modified):
+            return False    # would never be usable
+
+        key = normalizeURL(url)
+        path = self._bodyPath(key)
+        encoding = response.encoding
+        if content is None:
+            content = response.content
+            encoding = encoding or response.apparent_encoding
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = f"{path}.{get_ident()}.tmp"   # the same url may be stored from two threads at once
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            old = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, etag, last_modified, time() + lifetime,
+                             encoding, len(content), time()))
+            self.total_bytes += len(content) - (old[0] if old else 0)
+            self.counts['stores'] += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.db.commit()
+        return True
+
+    def refresh(self, entry, response):
+        """A stale entry was revalidated (response is the 304): update its freshness + validators"""
+        lifetime = freshnessLifetime(response.headers) or 0
+        with self.lock:
+            self.db.execute('''UPDATE entries SET expires = ?, accessed = ?,
+                                                  etag = COALESCE(?, etag),
+                                                  last_modified = COALESCE(?, last_modified)
+                               WHERE key = ?''',
+                            (time() + lifetime, time(), response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'), entry['key']))
+            self.db.commit()
+            self.counts['revalidated'] += 1
+
+    def _evict(self):
+        """Drop least recently used entries until we're under EVICT_TO * max_bytes. Called with lock held"""
+        target = self.max_bytes * EVICT_TO
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if self.total_bytes <= target:
+                break
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            try:
+                os.remove(self._bodyPath(key))
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            self.counts['evictions'] += 1
+
+    def stats(self):
+        """Hit/miss counts, hit rate (fresh hits + successful revalidations over all lookups) + size"""
+        stats = dict(self.counts)
+        lookups = stats['hits'] + stats['stale'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['revalidated']) / lookups if lookups else 0
+        stats['bytes'] = self.total_bytes
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
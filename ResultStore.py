@@ -0,0 +1,164 @@
+import os
+import io
+import gzip
+import json
+import mmap
+from abc import ABC, abstractmethod
+from threading import Lock
+
+try:    # optional, for zstd compressed segments
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+SEGMENT_SIZE = 64 * 1024 * 1024     # uncompressed bytes written to a segment file before starting the next one
+COMPRESSION_LEVEL = 6
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+# what reading a segment that was cut off mid-write raises
+TRUNCATION_ERRORS = (EOFError, json.JSONDecodeError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def serializeResult(result):
+    """FetchResult -> JSON-able dict. Output of processing stages is stored as is, so must be JSON-able too"""
+    serialized = {'url': result['url'],
+                  'html': result['html'],
+                  'time': result.seconds,
+                  'port': result['port'],
+                  'exit_fingerprint': result['exit_fingerprint'],
+                  'error': str(result['error']) if result['error'] else None}
+    if 'processed' in result:
+        serialized['processed'] = result['processed']
+        serialized['process_error'] = str(result['process_error']) if result['process_error'] else None
+    return serialized
+
+
+class ResultSink(ABC):
+    """Somewhere for fetch results to go as they arrive, see TorGetter.fetchInto()"""
+
+    @abstractmethod
+    def write(self, result): pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemorySink(ResultSink):
+    """Keeps every result in memory, like fetchConcurrent() does"""
+
+    def __init__(self):
+        self.results = []
+
+    def write(self, result):
+        self.results.append(result)
+
+    def __iter__(self):
+        return iter(self.results)
+
+
+class SegmentSink(ResultSink):
+    """Appends results as compressed JSON lines to numbered, append-only segment files in directory
+       (results-00000.jsonl.gz, ...), so bodies go to disk as they arrive instead of piling up in RAM"""
+
+    def __init__(self,
+                 directory,
+                 compression = 'gzip',              # 'gzip' or 'zstd' (needs the zstandard package)
+                 segment_size = SEGMENT_SIZE,
+                 level = COMPRESSION_LEVEL):
+
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compressed segments require the zstandard package")
+
+        self.directory = directory
+        self.compression = compression
+        self.segment_size = segment_size
+        self.level = level
+        self.lock = Lock()
+        self.count = 0
+
+        os.makedirs(directory, exist_ok = True)
+        # carry on after any segments already in directory, never append to an old one
+        existing = [int(os.path.basename(p).split('-')[1].split('.')[0]) for p in segmentPaths(directory)]
+        self.segment = max(existing) + 1 if existing else 0
+        self.file = None
+        self.raw_file = None
+
+    def _open(self):
+        path = os.path.join(self.directory, f"results-{self.segment:05d}{EXTENSIONS[self.compression]}")
+        self.raw_file = open(path, 'xb')
+        if self.compression == 'zstd':
+            self.file = zstandard.ZstdCompressor(level = self.level).stream_writer(self.raw_file)
+        else:
+            self.file = gzip.GzipFile(fileobj = self.raw_file, mode = 'wb', compresslevel = self.level)
+        self.written = 0
+
+    def _closeSegment(self):
+        if self.file:
+            self.file.close()
+            if not self.raw_file.closed:
+                self.raw_file.close()
+            self.file = None
+            self.segment += 1
+
+    def write(self, result):
+        line = json.dumps(serializeResult(result)).encode() + b'\n'
+        with self.lock:
+            if not self.file:
+                self._open()
+            self.file.write(line)
+            self.written += len(line)
+            self.count += 1
+            if self.written >= self.segment_size:
+                self._closeSegment()
+
+    def close(self):
+        with self.lock:
+            self._closeSegment()
+
+
+def segmentPaths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith('results-') and name.endswith(tuple(EXTENSIONS.values())))
+
+
+class SegmentReader():
+    """Lazily iterates the records (dicts, see serializeResult()) in a SegmentSink directory or a single
+       segment file. Each segment is memory-mapped and decompressed as a stream, so only one record
+       at a time needs to be in memory"""
+
+    def __init__(self, path):
+        self.paths = segmentPaths(path) if os.path.isdir(path) else [path]
+
+    def __iter__(self):
+        for path in self.paths:
+            yield from self.readSegment(path)
+
+    @staticmethod
+    def readSegment(path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                if path.endswith(EXTENSIONS['zstd']):
+                    if zstandard is None:
+                        raise ImportError("reading zstd compressed segments requires the zstandard package")
+                    stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(mapped))
+                else:
+                    stream = gzip.GzipFile(fileobj = mapped, mode = 'rb')
+                try:
+                    for line in stream:
+                        yield json.loads(line)
+                except TRUNCATION_ERRORS:
+                    # segment that was still being written when the process died, keep what's complete
+                    return
+                finally:
+                    stream.close()
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from threading import Lock
+
+import stem
+from stem import CircStatus, StreamStatus
+from stem.control import EventType
+
+import Metrics
+
+
+MAX_TRACKED = 4096              # how many streams/sources/targets we remember per client
+
+
+class BoundedDict(OrderedDict):
+    """dict that forgets its oldest entries beyond maxlen"""
+
+    def __init__(self, maxlen = MAX_TRACKED):
+        super().__init__()
+        self.maxlen = maxlen
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        if len(self) > self.maxlen:
+            self.popitem(last = False)
+
+
+class StreamTracker():
+    """A single long-lived STREAM + CIRC listener on one TorClient's controller.
+
+       Circuit exits are learned from CIRC events as circuits get built, and every stream that
+       succeeds is recorded by stream id, source address and target host, so a fetch can look
+       up the exit it went out through without subscribing to events or asking the controller.
+       Tor only reports a stream's source address in its NEW/NEWRESOLVE event, so it's held by
+       stream id until the stream succeeds."""
+
+    def __init__(self, controller, metrics = None, socks_port = None):
+        self.controller = controller
+        self.lock = Lock()
+        self.socks_port = socks_port    # label for this client's metrics
+        self.last_exit = None           # exit of the most recent stream
+
+        metrics = metrics or Metrics.REGISTRY
+        self.circuits_built = metrics.counter('torgetter_circuits_built_total', 'Circuits built', ('port',))
+        self.exit_changes = metrics.counter('torgetter_exit_changes_total', 
+                                            'Streams that went out through a different exit than the previous one', 
+                                            ('port',))
+
+        self.circuit_exits = BoundedDict()  # {'circ_id': 'exit fingerprint'}
+        self.streams = BoundedDict()        # {'stream_id': ('circ_id', 'exit fingerprint')}
+        self.sources = BoundedDict()        # {'127.0.0.1:source_port': 'exit fingerprint'}
+        self.new_sources = BoundedDict()    # {'stream_id': '127.0.0.1:source_port'} of streams that haven't succeeded yet
+        self.targets = BoundedDict()        # {('socks username', 'target host'): 'exit fingerprint'}, most recent stream wins
+
+        controller.add_event_listener(self._circuitEvent, EventType.CIRC)
+        controller.add_event_listener(self._streamEvent, EventType.STREAM)
+
+        # circuits built before we subscribed won't get a CIRC event
+        for circ in controller.get_circuits():
+            if circ.status == CircStatus.BUILT and circ.path:
+                self.circuit_exits[circ.id] = circ.path[-1][0]
+
+    def close(self):
+        try:
+            self.controller.remove_event_listener(self._circuitEvent)
+            self.controller.remove_event_listener(self._streamEvent)
+        except stem.ControllerError:
+            pass    # controller already closed
+
+    def _circuitEvent(self, event):
+        if event.status == CircStatus.BUILT and event.path:
+            with self.lock:
+                self.circuit_exits[event.id] = event.path[-1][0]
+            self.circuits_built.inc(port = self.socks_port)
+        elif event.status in (CircStatus.CLOSED, CircStatus.FAILED):
+            with self.lock:
+                self.circuit_exits.pop(event.id, None)
+
+    def _streamEvent(self, event):
+        if event.status in (StreamStatus.NEW, StreamStatus.NEWRESOLVE):
+            if event.source_address:
+                with self.lock:
+                    self.new_sources[event.id] = f"{event.source_address}:{event.source_port}"
+            return
+        if event.status in (StreamStatus.FAILED, StreamStatus.CLOSED):
+            with self.lock:
+                self.new_sources.pop(event.id, None)
+            return
+        if event.status != StreamStatus.SUCCEEDED or not event.circ_id:
+            return
+
+        exit_fingerprint = self.circuit_exits.get(event.circ_id)
+        if exit_fingerprint is None:
+            # only happens if the CIRC event got lost/evicted, so this stays rare
+            try:
+                circ = self.controller.get_circuit(event.circ_id)
+                exit_fingerprint = circ.path[-1][0]
+            except (stem.ControllerError, ValueError, IndexError):
+                return
+
+        with self.lock:
+            self.circuit_exits[event.circ_id] = exit_fingerprint
+            self.streams[event.id] = (event.circ_id, exit_fingerprint)
+            source = self.new_sources.pop(event.id, None)
+            if event.source_address:
+                source = f"{event.source_address}:{event.source_port}"
+            if source:
+                self.sources[source] = exit_fingerprint
+            if event.target_address:
+                # the virtual client (see TorClientPool.VirtualClient) the stream came from, if any
+                username = event.keyword_args.get('SOCKS_USERNAME')
+                if username:
+                    username = username.strip('"')
+                self.targets[(username, event.target_address)] = exit_fingerprint
+            changed = exit_fingerprint != self.last_exit
+            self.last_exit = exit_fingerprint
+        if changed:
+            self.exit_changes.inc(port = self.socks_port)
+
+    def liveExits(self):
+        """Fingerprints of the exits of this client's currently built circuits"""
+        with self.lock:
+            return set(self.circuit_exits.values())
+
+    def exitForStream(self, stream_id):
+        stream = self.streams.get(stream_id)
+        return stream[1] if stream else None
+
+    def exitForSource(self, source_address):
+        """exit fingerprint of the stream that came from 'address:port' on our side of the SOCKS port"""
+        return self.sources.get(source_address)
+
+    def exitForTarget(self, host, username = None):
+        """exit fingerprint of the most recent stream to host, from the SOCKS username if given"""
+        return self.targets.get((username, host))
@@ -0,0 +1,600 @@
+import os
+import sys
+import json
+import logging
+import random
+import socket
+import struct
+import argparse
+import resource
+import threading
+import contextlib
+import socketserver
+from time import sleep, monotonic
+from types import SimpleNamespace
+from collections import namedtuple, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from stem import CircStatus, StreamStatus, Signal
+from stem.control import EventType
+
+import TorClientPool
+import TorGetter
+from ClientHealth import percentile
+from StreamTracker import StreamTracker
+
+
+"""
+Offline benchmarks for torgetter: the real getters + TorClientPool, driven against local stand-ins for
+everything outside the process -- a SOCKS5 proxy per "tor client" (with configurable latency, bandwidth
+and failure rate), an HTTP origin that serves every fake host, and a stem-compatible controller with a
+fake consensus + circuits. Nothing touches tor or the internet, so runs are reproducible and comparable
+before/after a change:
+
+    python TorBenchmark.py --clients 8 --requests 2000 --latency 0.05 --json bench_output.txt
+"""
+
+NUM_RELAYS = 1000               # relays in the fake consensus
+EXIT_FRACTION = 0.3             # fraction of them flagged Exit
+CIRCUITS_PER_CLIENT = 4         # built circuits each fake client has at any time
+CONTROL_LATENCY = 0.001         # seconds per fake control port round trip
+RELAY_CHUNK = 16 * 1024         # bytes relayed per read, bandwidth is throttled per chunk
+START_PORT = 19050              # fake clients' socks/control ports count up from here, below the
+                                # ephemeral range (32768+) so outgoing connections can't already hold them
+LISTEN_BACKLOG = 1024           # the default of 5 drops connections (+ adds 1s SYN retries) under concurrent load
+SAMPLE_INTERVAL = 0.01          # seconds between thread count/RSS samples
+THREAD_PREFIX = 'bench-'        # threads of the stand-ins are named like this, so they're left out of thread counts
+
+RouterStatus = namedtuple('RouterStatus', 'fingerprint nickname address flags bandwidth')
+Circuit = namedtuple('Circuit', 'id status path purpose')
+
+
+def fakeConsensus(num_relays = NUM_RELAYS, exit_fraction = EXIT_FRACTION, seed = 0):
+    rng = random.Random(seed)
+    relays = []
+    for i in range(num_relays):
+        flags = ['Fast', 'Running', 'Stable', 'Valid'] + (['Exit'] if rng.random() < exit_fraction else ['Guard'])
+        relays.append(RouterStatus(fingerprint = '%040X' % rng.getrandbits(160),
+                                   nickname = f'BenchRelay{i}',
+                                   address = socket.inet_ntoa(struct.pack('>I', rng.getrandbits(32))),
+                                   flags = flags,
+                                   bandwidth = rng.randint(100, 100000)))
+    return relays
+
+
+class FakeController():
+    """The subset of stem.control.Controller that TorClient, StreamTracker and RelayIndex use, backed by
+       a fake consensus. Every call costs control_latency seconds, like a control port round trip"""
+
+    def __init__(self, consensus, circuits = CIRCUITS_PER_CLIENT, control_latency = CONTROL_LATENCY, seed = 0):
+        self.consensus = {r.fingerprint: r for r in consensus}
+        self.exits = [r.fingerprint for r in consensus if 'Exit' in r.flags]
+        self.num_circuits = circuits
+        self.control_latency = control_latency
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.listeners = defaultdict(list)      # {EventType: [listener, ...]}
+        self.conf = {}
+        self.calls = defaultdict(int)           # {'method': times called}
+        self.circuits = {}                      # {'circ_id': Circuit}
+        self.isolated = {}                      # {('socks username', 'password'): 'circ_id'}
+        self.next_id = 1
+        self.buildCircuits()
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.control_latency:
+            sleep(self.control_latency)
+
+    def _emit(self, event_type, event):
+        for listener in list(self.listeners[event_type]):
+            listener(event)
+
+    def _newCircuit(self):
+        """Build a circuit through an exit that isn't excluded. Call with lock held"""
+        excluded = set(self.conf.get('ExcludeExitNodes', '').split(','))
+        allowed = set(self.conf['ExitNodes'].split(',')) if self.conf.get('ExitNodes') else None
+        exits = [fp for fp in self.exits if fp not in excluded and (allowed is None or fp in allowed)] or self.exits
+        hops = self.rng.sample(list(self.consensus), 2) + [self.rng.choice(exits)]
+        circ = Circuit(str(self.next_id), CircStatus.BUILT, [(fp, self.consensus[fp].nickname) for fp in hops], 'GENERAL')
+        self.circuits[circ.id] = circ
+        self.next_id += 1
+        return circ
+
+    def buildCircuits(self):
+        """Close every circuit + build num_circuits new ones"""
+        with self.lock:
+            old = list(self.circuits.values())
+            self.circuits = {}
+            self.isolated = {}
+            new = [self._newCircuit() for _ in range(self.num_circuits)]
+        for circ in old:
+            self._emit(EventType.CIRC, SimpleNamespace(id = circ.id, status = CircStatus.CLOSED, path = circ.path))
+        for circ in new:
+            self._emit(EventType.CIRC, SimpleNamespace(id = circ.id, status = CircStatus.BUILT, path = circ.path))
+
+    def attachStream(self, stream_id, source, target, username = None, password = None):
+        """Called by the fake proxy for every stream it connects: picks a circuit (one of its own for each
+           SOCKS username/password, like IsolateSOCKSAuth) + emits STREAM NEW, then SUCCEEDED. Like tor, only
+           the NEW event carries the stream's source address"""
+        built = None
+        with self.lock:
+            if username is None:
+                circ = self.rng.choice(list(self.circuits.values()))
+            else:
+                circ = self.circuits.get(self.isolated.get((username, password)))
+                if circ is None:
+                    circ = built = self._newCircuit()
+                    self.isolated[(username, password)] = circ.id
+        if built:
+            self._emit(EventType.CIRC, SimpleNamespace(id = circ.id, status = CircStatus.BUILT, path = circ.path))
+        self._emit(EventType.STREAM, SimpleNamespace(id = str(stream_id), circ_id = None,
+                                                     status = StreamStatus.NEW,
+                                                     source_address = source[0], source_port = source[1],
+                                                     target_address = target,
+                                                     keyword_args = {}))
+        self._emit(EventType.STREAM, SimpleNamespace(id = str(stream_id), circ_id = circ.id,
+                                                     status = StreamStatus.SUCCEEDED,
+                                                     source_address = None, source_port = None,
+                                                     target_address = target,
+                                                     keyword_args = {'SOCKS_USERNAME': f'"{username}"'} if username else {}))
+
+    def add_event_listener(self, listener, *event_types):
+        self._call('add_event_listener')
+        for event_type in event_types:
+            self.listeners[event_type].append(listener)
+
+    def remove_event_listener(self, listener):
+        self._call('remove_event_listener')
+        for listeners in self.listeners.values():
+            while listener in listeners:
+                listeners.remove(listener)
+
+    def get_circuits(self):
+        self._call('get_circuits')
+        with self.lock:
+            return list(self.circuits.values())
+
+    def get_circuit(self, circ_id):
+        self._call('get_circuit')
+        circ = self.circuits.get(circ_id)
+        if not circ:
+            raise ValueError(f"Circuit {circ_id} doesn't exist")
+        return circ
+
+    def get_network_status(self, fingerprint, default = None):
+        self._call('get_network_status')
+        return self.consensus.get(fingerprint, default)
+
+    def get_network_statuses(self):
+        self._call('get_network_statuses')
+        return list(self.consensus.values())
+
+    def get_info(self, key):
+        self._call('get_info')
+        if key.startswith('ip-to-country/'):
+            return 'zz'
+        if key == 'status/bootstrap-phase':
+            return 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'
+        return ''
+
+    def set_conf(self, key, value):
+        self._call('set_conf')
+        self.conf[key] = value
+
+    def signal(self, signal):
+        self._call('signal')
+        if signal == Signal.NEWNYM:
+            self.buildCircuits()
+
+    def close(self):
+        self.listeners.clear()
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Serves a page_size byte html page for any host + path, after delay seconds"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.delay:
+            sleep(self.server.delay)
+        body = self.server.page
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        threading.current_thread().name = THREAD_PREFIX + 'origin'
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+
+class BenchOrigin(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, page_size = 20000, delay = 0):
+        super().__init__(('127.0.0.1', 0), OriginHandler)
+        self.delay = delay
+        filler = b'<p>' + b'torgetter benchmark page ' * 40 + b'</p>\n'
+        self.page = (b'<html><body>\n' + filler * (page_size // len(filler) + 1))[:page_size]
+        threading.Thread(target = self.serve_forever, name = THREAD_PREFIX + 'origin', daemon = True).start()
+
+
+class SocksHandler(socketserver.BaseRequestHandler):
+    """Minimal SOCKS5 server (CONNECT only, username/password accepted as an isolation key, like tor
+       does) that sends every stream to the origin"""
+
+    def recvExactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("client went away")
+            data += chunk
+        return data
+
+    def setup(self):
+        threading.current_thread().name = THREAD_PREFIX + 'socks'
+
+    def handle(self):
+        proxy = self.server
+        try:
+            _, num_methods = self.recvExactly(2)
+            username = password = None
+            if 2 in self.recvExactly(num_methods):
+                self.request.sendall(b'\x05\x02')
+                self.recvExactly(1)
+                username = self.recvExactly(self.recvExactly(1)[0]).decode()
+                password = self.recvExactly(self.recvExactly(1)[0]).decode()
+                self.request.sendall(b'\x01\x00')
+            else:
+                self.request.sendall(b'\x05\x00')
+
+            _, command, _, address_type = self.recvExactly(4)
+            if address_type == 1:
+                host = socket.inet_ntoa(self.recvExactly(4))
+            elif address_type == 3:
+                host = self.recvExactly(self.recvExactly(1)[0]).decode()
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, self.recvExactly(16))
+            self.recvExactly(2)     # port, everything goes to the origin anyway
+
+            if proxy.latency:
+                sleep(proxy.rng.uniform(proxy.latency / 2, proxy.latency * 3 / 2))  # building the stream
+            if command != 1 or proxy.rng.random() < proxy.failure_rate:
+                self.request.sendall(b'\x05\x04\x00\x01' + bytes(6))    # host unreachable
+                return
+
+            upstream = socket.create_connection(proxy.origin)
+            proxy.streams += 1
+            proxy.controller.attachStream(proxy.streams, self.client_address, host, username, password)
+            self.request.sendall(b'\x05\x00\x00\x01' + bytes(6))
+        except (ConnectionError, ValueError, OSError):
+            return
+
+        with upstream:
+            threading.Thread(target = self.pipe, args = (self.request, upstream, None), 
+                             name = THREAD_PREFIX + 'socks', daemon = True).start()
+            self.pipe(upstream, self.request, proxy.bandwidth)
+
+    @staticmethod
+    def pipe(src, dst, bandwidth):
+        try:
+            while True:
+                data = src.recv(RELAY_CHUNK)
+                if not data:
+                    break
+                dst.sendall(data)
+                if bandwidth:
+                    sleep(len(data) / bandwidth)
+        except OSError:
+            pass
+        finally:
+            with contextlib.suppress(OSError):
+                dst.shutdown(socket.SHUT_WR)
+
+
+class FakeSocksProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, port, origin, controller, latency = 0, bandwidth = None, failure_rate = 0, seed = 0):
+        super().__init__(('127.0.0.1', int(port)), SocksHandler)
+        self.origin = origin
+        self.controller = controller
+        self.latency = latency              # seconds to set up each stream (mean, +-50%)
+        self.bandwidth = bandwidth          # bytes/sec per stream, None for unlimited
+        self.failure_rate = failure_rate    # fraction of streams that fail to connect
+        self.rng = random.Random(seed)
+        self.streams = 0
+        threading.Thread(target = self.serve_forever, name = THREAD_PREFIX + 'socks', daemon = True).start()
+
+
+class BenchClient(TorClientPool.TorClient):
+    """TorClient backed by a FakeSocksProxy + FakeController instead of a tor process"""
+
+    def __init__(self, socks_port, control_port, custom_config = None, relay_index = None, bench = None, **kwargs):
+        self.socks_port = str(socks_port)
+        self.control_port = str(control_port)
+        self.relay_index = relay_index
+        self.config = {'SOCKSPort': self.socks_port, 'ControlPort': self.control_port}
+        self.config.update(custom_config or {})
+
+        start_time = monotonic()
+        if bench.bootstrap_time:
+            sleep(bench.bootstrap_time)
+        seed = bench.seed + int(socks_port)
+        self.controller = FakeController(bench.consensus, control_latency = bench.control_latency, seed = seed)
+        for option, value in self.config.items():
+            self.controller.conf[option] = value
+        self.proxy = FakeSocksProxy(socks_port, bench.origin.server_address, self.controller,
+                                    latency = bench.latency,
+                                    bandwidth = bench.bandwidth,
+                                    failure_rate = bench.failure_rate,
+                                    seed = seed)
+        self.attempts = 1
+        self.bootstrap_time = monotonic() - start_time
+        self.streams = StreamTracker(self.controller, socks_port = self.socks_port)
+
+    def destroy(self):
+        self.streams.close()
+        self.controller.close()
+        self.proxy.shutdown()
+        self.proxy.server_close()
+
+
+class BenchPool(TorClientPool.TorClientPool):
+    """TorClientPool whose clients are BenchClients"""
+
+    def __init__(self, bench, num_tor_clients, **kwargs):
+        self.bench = bench
+        super().__init__(num_tor_clients, start_port = bench.start_port,
+                         seed_dir = None, exclusions_file = None, **kwargs)
+
+    def newClient(self, socks_port, control_port, config = None):
+        return BenchClient(socks_port, control_port, self.clientConfig(config, socks_port),
+                           relay_index = self.relay_index, bench = self.bench)
+
+
+def libraryThreads():
+    """Number of live threads, not counting the stand-ins'"""
+    return sum(1 for t in threading.enumerate() if not t.name.startswith(THREAD_PREFIX))
+
+
+class Sampler():
+    """Samples the process' thread count + RSS in the background, keeping the peaks"""
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_threads = libraryThreads()
+        self.peak_rss = currentRSS()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = THREAD_PREFIX + 'sampler', daemon = True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, libraryThreads())
+            self.peak_rss = max(self.peak_rss, currentRSS())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def currentRSS():
+    """Resident memory of this process in bytes (peak so far, where /proc isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def latencyStats(seconds):
+    seconds = sorted(seconds)
+    return {'p50': percentile(seconds, 50), 'p90': percentile(seconds, 90), 'p99': percentile(seconds, 99)}
+
+
+class Benchmark():
+    """Sets up the local origin + fake consensus, and runs each benchmark against fresh fake pools"""
+
+    def __init__(self,
+                 clients = 4,
+                 requests = 500,
+                 domains = 50,
+                 latency = 0.02,            # seconds per stream setup, per proxy
+                 bandwidth = None,          # bytes/sec per stream
+                 failure_rate = 0,
+                 page_size = 20000,
+                 origin_delay = 0,
+                 control_latency = CONTROL_LATENCY,
+                 bootstrap_time = 0,        # seconds a fake client takes to "bootstrap"
+                 delay = 0,                 # getter's per client, per domain delay
+                 virtual_clients = 1,       # isolated circuit sets per fake tor process
+                 start_port = START_PORT,
+                 seed = 0):
+
+        self.clients = clients
+        self.requests = requests
+        self.domains = domains
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.control_latency = control_latency
+        self.bootstrap_time = bootstrap_time
+        self.delay = delay
+        self.virtual_clients = virtual_clients
+        self.start_port = start_port
+        self.seed = seed
+
+        self.origin = BenchOrigin(page_size, origin_delay)
+        self.consensus = fakeConsensus(seed = seed)
+
+    def urls(self, n):
+        # hosts never get resolved (the proxies send everything to the origin), but need a public suffix
+        # for the scheduler to tell their domains apart
+        return [f'http://bench-site{i % self.domains}.com/page/{i}' for i in range(n)]
+
+    def pool(self, num_clients = None, **kwargs):
+        return BenchPool(self, num_clients or self.clients, exclude_debounce = 0.1, 
+                         virtual_clients = self.virtual_clients, **kwargs)
+
+    def measure(self, name, function):
+        """Run function() (which returns a dict of metrics), adding wall time + peak threads/RSS to its metrics"""
+        with Sampler() as sampler:
+            start_time = monotonic()
+            metrics = function()
+            elapsed = monotonic() - start_time
+        return dict({'benchmark': name, 'seconds': elapsed,
+                     'peak_threads': sampler.peak_threads, 'peak_rss_mb': sampler.peak_rss / 1024 ** 2}, **metrics)
+
+    def fetchMetrics(self, results, elapsed):
+        ok = [r for r in results if r.ok]
+        return dict({'urls': len(results),
+                     'errors': len(results) - len(ok),
+                     'urls_per_sec': len(ok) / elapsed if elapsed else None},
+                    **latencyStats([r.seconds for r in results]))
+
+    def benchSpawn(self):
+        pool = self.pool()
+        summary = pool.spawnSummary()
+        pool.cleanShutdown()
+        return {'clients': summary['ready'], 'spawn_seconds': summary['elapsed']}
+
+    def benchFetch(self):
+        """RequestsTorGetter.fetch(), one request at a time over one client"""
+        pool = self.pool(1)
+        getter = TorGetter.RequestsTorGetter([], pool, delay = self.delay)
+        port = next(iter(pool.endpoints))
+        start_time = monotonic()
+        results = [getter.fetch(url, port) for url in self.urls(max(self.requests // 10, 1))]
+        elapsed = monotonic() - start_time
+        getter.killAllSessions()
+        pool.cleanShutdown()
+        return self.fetchMetrics(results, elapsed)
+
+    def benchFetchConcurrent(self):
+        """RequestsTorGetter.fetchConcurrent() over the whole pool"""
+        pool = self.pool()
+        getter = TorGetter.RequestsTorGetter(self.urls(self.requests), pool, delay = self.delay)
+        start_time = monotonic()
+        results, errors = getter.fetchConcurrent(self.requests)
+        elapsed = monotonic() - start_time
+        getter.killAllSessions()
+        pool.cleanShutdown()
+        return self.fetchMetrics(results + errors, elapsed)
+
+    def benchFetchAsync(self):
+        """AsyncTorGetter.fetchStream() over the whole pool"""
+        pool = self.pool()
+        getter = TorGetter.AsyncTorGetter(self.urls(self.requests), pool, delay = self.delay)
+        start_time = monotonic()
+        results = list(getter.fetchStream())
+        elapsed = monotonic() - start_time
+        getter.stopLoop()
+        pool.cleanShutdown()
+        return self.fetchMetrics(results, elapsed)
+
+    def benchExcludeExit(self, num_exits = 100):
+        """num_exits excludeExit() calls, then one flushExclusions() applying them to every client"""
+        pool = self.pool()
+        exits = pool.relay_index.exits()[:num_exits]
+        start_time = monotonic()
+        for fingerprint in exits:
+            pool.excludeExit(fingerprint)
+        queue_time = monotonic() - start_time
+        start_time = monotonic()
+        pool.flushExclusions()
+        flush_time = monotonic() - start_time
+        newnyms = sum(c.controller.calls['signal'] for c in pool.clients.values())
+        pool.cleanShutdown()
+        return {'exclusions': len(exits),
+                'exclude_calls_per_sec': len(exits) / queue_time if queue_time else None,
+                'flush_seconds': flush_time,
+                'newnyms': newnyms}
+
+    def benchGetCircuits(self, calls = 200):
+        """TorClient.getCircuits(), with relays looked up in the pool's RelayIndex vs over the controller"""
+        pool = self.pool(1)
+        client = next(iter(pool.clients.values()))
+        metrics = {}
+        for label, relay_index in (('indexed', pool.relay_index), ('controller', None)):
+            client.relay_index = relay_index
+            start_time = monotonic()
+            for _ in range(calls):
+                client.getCircuits()
+            metrics[f'{label}_calls_per_sec'] = calls / (monotonic() - start_time)
+        pool.cleanShutdown()
+        return metrics
+
+    def run(self, names = None):
+        benchmarks = {'spawn': self.benchSpawn,
+                      'fetch': self.benchFetch,
+                      'fetchConcurrent': self.benchFetchConcurrent,
+                      'excludeExit': self.benchExcludeExit,
+                      'getCircuits': self.benchGetCircuits}
+        if TorGetter.aiohttp is not None:
+            benchmarks['fetchAsync'] = self.benchFetchAsync
+        unknown = set(names or ()) - set(benchmarks)
+        if unknown:
+            raise ValueError(f"Unknown benchmarks: {', '.join(sorted(unknown))} (have: {', '.join(benchmarks)})")
+        return [self.measure(name, benchmarks[name]) for name in (names or benchmarks)]
+
+
+def formatResult(result):
+    return '  '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}'
+                     for key, value in result.items())
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Offline torgetter benchmarks against local SOCKS/HTTP/controller stand-ins")
+    parser.add_argument('benchmarks', nargs = '*', help = "benchmarks to run (default: all)")
+    parser.add_argument('--clients', type = int, default = 4)
+    parser.add_argument('--requests', type = int, default = 500)
+    parser.add_argument('--domains', type = int, default = 50)
+    parser.add_argument('--latency', type = float, default = 0.02, help = "seconds per stream setup")
+    parser.add_argument('--bandwidth', type = float, default = None, help = "bytes/sec per stream")
+    parser.add_argument('--failure-rate', type = float, default = 0)
+    parser.add_argument('--page-size', type = int, default = 20000)
+    parser.add_argument('--origin-delay', type = float, default = 0)
+    parser.add_argument('--control-latency', type = float, default = CONTROL_LATENCY)
+    parser.add_argument('--bootstrap-time', type = float, default = 0)
+    parser.add_argument('--delay', type = float, default = 0, help = "getter delay per client, per domain")
+    parser.add_argument('--virtual-clients', type = int, default = 1, help = "isolated circuit sets per fake tor process")
+    parser.add_argument('--start-port', type = int, default = START_PORT)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--json', help = "also write the results to this file, as JSON")
+    parser.add_argument('--log-level', default = 'ERROR', help = "level for the library's logging")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = args.log_level.upper())
+
+    bench = Benchmark(clients = args.clients, requests = args.requests, domains = args.domains,
+                      latency = args.latency, bandwidth = args.bandwidth, failure_rate = args.failure_rate,
+                      page_size = args.page_size, origin_delay = args.origin_delay,
+                      control_latency = args.control_latency, bootstrap_time = args.bootstrap_time,
+                      delay = args.delay, virtual_clients = args.virtual_clients, 
+                      start_port = args.start_port, seed = args.seed)
+    results = []
+    for result in bench.run(args.benchmarks or None):
+        print(formatResult(result))
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,24 @@
 import os
 import shutil
+import fcntl
 import logging
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from threading import Timer
+import tempfile
 import json
 
+import stem
 import stem.process
 from stem.control import Controller
 from stem import CircStatus, Signal
 
+import Metrics
+from RelayIndex import RelayIndex
+from StreamTracker import StreamTracker
+
 """
                                                                     
 @@@@@@@   @@@@@@   @@@@@@@         @@@@@@@    @@@@@@    @@@@@@   @@@       
@@ -28,6 +37,62 @@ from stem import CircStatus, Signal
 MAX_CIRCUIT_DIRTINESS = '1800'
 NUM_CLIENTS = 10
 DEFAULT_CIRCUIT_LENGTH = 3
+SPAWN_CONCURRENCY = 8           # max number of tor clients bootstrapping (or shutting down) at the same time
+BOOTSTRAP_TIMEOUT = 90          # seconds a tor client gets to finish bootstrapping before it's killed + retried
+BOOTSTRAP_ATTEMPTS = 3          # how many times we try to bootstrap a tor client before giving up on it
+BOOTSTRAP_POLL_INTERVAL = 0.5   # seconds between bootstrap progress checks over the control port
+SPARE_RETRY_DELAY = 30          # seconds before bringing up a spare that failed to bootstrap is tried again
+SEED_DIRECTORY = './.torseed'   # shared copy of cached directory documents new clients bootstrap from
+SEED_REFRESH_INTERVAL = 3600    # seconds before the seed is refreshed from a freshly bootstrapped client
+
+# Directory documents that tor replaces atomically (write to tmp file + rename), so the
+# same inode can safely be hardlinked into every client's DataDirectory ...
+SEED_LINKED_FILES = ('cached-certs', 'cached-microdesc-consensus', 'cached-microdescs', 'cached-consensus')
+# ... and journals that tor appends to in place, which each client needs its own copy of
+SEED_COPIED_FILES = ('cached-microdescs.new',)
+
+EXCLUSIONS_FILE = './.tor_excluded_exits.json'  # excluded exit fingerprints, kept across pool restarts ...
+EXCLUSION_TTL = 24 * 3600       # ... for this many seconds after they were excluded (None: forever)
+EXCLUDE_DEBOUNCE = 2            # seconds to collect excluded exits into one batch before applying them
+
+FICLONE = 0x40049409            # linux ioctl for a copy-on-write (reflink) copy, on btrfs/xfs/etc
+DEFAULT_CIRCUITS_PENDING = 32   # tor's default MaxClientCircuitsPending, raised to fit many virtual clients
+MAX_CIRCUITS_PENDING = 1024     # tor's upper limit for it
+
+logger = logging.getLogger(__name__)
+
+
+def cloneFile(src, dst):
+    """copy src to dst, sharing blocks copy-on-write if the filesystem supports it"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def seedDirectory(src_dir, dst_dir):
+    """populate dst_dir with the cached directory documents in src_dir, without duplicating them on disk.
+       Returns the number of files seeded"""
+    os.makedirs(dst_dir, mode = 0o700, exist_ok = True)
+    seeded = 0
+    for name in SEED_LINKED_FILES + SEED_COPIED_FILES:
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if not os.path.isfile(src):
+            continue
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if name in SEED_LINKED_FILES:
+            try:
+                os.link(src, dst)
+            except OSError:     # e.g. seed + data dirs on different filesystems
+                cloneFile(src, dst)
+        else:
+            cloneFile(src, dst)
+        seeded += 1
+    return seeded
+
 
 class TorClient():
     """represents a running tor process with own socks/control port + a stem.Controller()"""
@@ -36,13 +101,21 @@ class TorClient():
     def __init__(self, 
                  socks_port, 
                  control_port, 
-                 custom_config = None,
-                 circuit_pool = None):   # dict of option:value pairs to add to default config
+                 custom_config = None,       # dict of option:value pairs to add to default config
+                 circuit_pool = None,
+                 bootstrap_timeout = BOOTSTRAP_TIMEOUT,
+                 bootstrap_attempts = BOOTSTRAP_ATTEMPTS,
+                 seed_dir = None,            # directory of cached consensus/descriptors to bootstrap from
+                 relay_index = None,         # pool's shared RelayIndex, for relay lookups without the control port
+                 metrics = None):            # MetricsRegistry, default Metrics.REGISTRY
                      
         self.socks_port = str(socks_port)
         self.control_port = str(control_port)
+        self.relay_index = relay_index
 
-        self.config = {'SOCKSPort': socks_port, 'ControlPort': control_port, 'DataDirectory': './.tordata' + socks_port, 
+        # IsolateSOCKSAuth (tor's default, but the pool's virtual clients depend on it): streams 
+        # with different SOCKS username/password never share a circuit
+        self.config = {'SOCKSPort': f'{socks_port} IsolateSOCKSAuth', 'ControlPort': control_port, 'DataDirectory': './.tordata' + socks_port, 
                          'CookieAuthentication' : '1',  'MaxCircuitDirtiness': MAX_CIRCUIT_DIRTINESS,
                          'StrictNodes': '1', 'GeoIPExcludeUnknown': '1', 'EnforceDistinctSubnets': '0'}
         
@@ -50,18 +123,80 @@ class TorClient():
             for opt, val in custom_config.items():
                 self.config[opt] = val
         
+        # start from a warm directory cache instead of downloading the consensus + microdescriptors again
+        if seed_dir and os.path.isdir(seed_dir):
+            try:
+                seeded = seedDirectory(seed_dir, self.config['DataDirectory'])
+                logger.debug("Seeded tor client @ port %s with %d cached directory documents", self.socks_port, seeded)
+            except OSError as e:
+                # e.g. refreshSeed() swapped the seed out from under us. Seeding only saves downloads, so
+                # drop whatever was half seeded and let tor fetch its directory documents itself
+                logger.warning("Failed to seed tor client @ port %s, bootstrapping without the seed: %s",
+                               self.socks_port, e, extra = {'port': self.socks_port})
+                shutil.rmtree(self.config['DataDirectory'], ignore_errors = True)
+
+        start_time = monotonic()
+        self.attempts = 0
         while True:
+            self.attempts += 1
             try:
-                self.process = stem.process.launch_tor_with_config(config = self.config)
-                break;
-            except OSError as e: # if attempt to bring it up timed out, try again until success
-                print(f"Attempt to create circuits failed with error: {e}. Trying again ...")
-                continue;  
+                self.launch(bootstrap_timeout)
+                break
+            except (OSError, stem.ControllerError) as e: # if attempt to bring it up failed/timed out, try again
+                logger.warning("Attempt %d to bootstrap tor client @ port %s failed with error: %s",
+                               self.attempts, self.socks_port, e, 
+                               extra = {'port': self.socks_port, 'attempt': self.attempts})
+                if self.attempts >= bootstrap_attempts:
+                    raise OSError(f"Tor client @ port {self.socks_port} failed to bootstrap "
+                                  f"after {self.attempts} attempts: {e}") from e
+                logger.info("Trying again ...")
                     
-        self.controller = Controller.from_port(port = int(self.control_port))
-        self.controller.authenticate()
+        self.bootstrap_time = monotonic() - start_time
+        self.streams = StreamTracker(self.controller, metrics, self.socks_port)   # maps this client's streams to exits
+
+
+    def launch(self, bootstrap_timeout):
+        """Start the tor process + controller, and wait up to bootstrap_timeout seconds for bootstrapping to finish"""
+        deadline = monotonic() + bootstrap_timeout
+
+        # stem's own launch timeout relies on SIGALRM, which only works in the main thread, so
+        # we return as soon as tor is running and poll its bootstrap progress ourselves
+        self.process = stem.process.launch_tor_with_config(config = self.config, 
+                                                           completion_percent = 0, 
+                                                           timeout = None)
+        self.controller = None
+        try:
+            self.controller = Controller.from_port(port = int(self.control_port))
+            self.controller.authenticate()
+            
+            while 'PROGRESS=100' not in self.controller.get_info('status/bootstrap-phase'):
+                if monotonic() > deadline:
+                    raise OSError(f"reached a {bootstrap_timeout} second timeout without success")
+                sleep(BOOTSTRAP_POLL_INTERVAL)
+
+        except:
+            if self.controller:
+                self.controller.close()
+            self.process.kill()     # don't leave a half-bootstrapped process lingering
+            self.process.wait()
+            raise
         
 
+    def relayStatus(self, fingerprint):
+        """Router status dict for the relay with this fingerprint, or None if it's not in the consensus.
+           Served from the pool's RelayIndex when we have one, otherwise asked of our controller"""
+        if self.relay_index is not None and len(self.relay_index):
+            return self.relay_index.get(fingerprint)
+
+        desc = self.controller.get_network_status(fingerprint, None)
+        if not desc:
+            return None
+        return {'nickname': desc.nickname,
+                'address': desc.address,
+                'flags': frozenset(desc.flags),
+                'bandwidth': desc.bandwidth,
+                'country': None}
+
     def getCircuits(self):
         """Return list of dicts of info re: circuits/paths for this client"""
         circuits = []
@@ -78,10 +213,12 @@ class TorClient():
                 relay_info = {}
                 relay_info['fingerprint'] = fingerprint
                 relay_info['nickname'] = nickname
-                #TODO: extract all other fields from desc ...
-                desc = self.controller.get_network_status(fingerprint, None)
-                #print("DEBUG: " + str(desc))
-                relay_info['address'] = desc.address if desc else 'unknown'
+                status = self.relayStatus(fingerprint)
+                relay_info['address'] = status['address'] if status else 'unknown'
+                relay_info['flags'] = status['flags'] if status else frozenset()
+                relay_info['bandwidth'] = status['bandwidth'] if status else None
+                relay_info['country'] = (self.relay_index.country(fingerprint) 
+                                         if status and self.relay_index is not None else None)
                 circuit_info['relays'].append(relay_info)
             
             circuits.append(circuit_info)
@@ -95,8 +232,8 @@ class TorClient():
             if circ.status != CircStatus.BUILT:
                 continue
             fingerprint, nickname = circ.path[-1]
-            desc = self.controller.get_network_status(fingerprint, None)
-            exit_ips.append((circ.id, desc.address))
+            status = self.relayStatus(fingerprint)
+            exit_ips.append((circ.id, status['address'] if status else None))
         return exit_ips
 
 
@@ -113,52 +250,369 @@ class TorClient():
     def destroy(self):
         """shut down this tor client, remove data directory"""
         try:
-            print(f"Destroying Tor process listening on SOCKS port:"
-                  f"{self.socks_port}) + removing data directory...")
+            logger.info("Destroying Tor process listening on SOCKS port %s + removing data directory ...", 
+                        self.socks_port)
             data_dir = self.config['DataDirectory']            
+            self.streams.close()
             self.controller.close()
             self.process.kill()
             self.process.wait()
             shutil.rmtree(data_dir)
 
         except:
-            print(f"destroy() failed for client @ port {self.socks_port}")
+            logger.exception("destroy() failed for client @ port %s", self.socks_port)
             raise
 
 
+class VirtualClient():
+    """One isolated set of circuits inside a TorClient, selected by SOCKS username/password.
+
+       Tor never puts streams with different SOCKS credentials on the same circuit, so each virtual
+       client gets its own exits while sharing one tor process (and its directory cache + memory)
+       with the others. key is what getters address it by: the socks port itself for a pool without
+       virtual clients (and then no credentials are sent), 'socks_port:index' otherwise"""
+
+    def __init__(self, client, index = None):
+        self.client = client
+        self.index = index
+        self.generation = 0     # bumped by renew()
+        if index is None:
+            self.key = client.socks_port
+            self.username = None
+        else:
+            self.key = f"{client.socks_port}:{index}"
+            self.username = f"torgetter{index}"
+
+    @property
+    def socks_port(self):
+        return self.client.socks_port
+
+    @property
+    def password(self):
+        return f"gen{self.generation}" if self.username else None
+
+    def renew(self):
+        """Switch to fresh circuits: tor won't reuse the old ones once the SOCKS password changes.
+           Sessions have to be recreated with the new proxyURL()"""
+        self.generation += 1
+
+    def proxyURL(self, scheme = 'socks5h'):
+        auth = f"{self.username}:{self.password}@" if self.username else ''
+        return f"{scheme}://{auth}127.0.0.1:{self.client.socks_port}"
+
+    def exitForTarget(self, host):
+        return self.client.streams.exitForTarget(host, self.username)
+
+    def exitForSource(self, source_address):
+        return self.client.streams.exitForSource(source_address)
+
+
 class TorClientPool():
     
     def __init__(self, 
                  num_tor_clients = NUM_CLIENTS, 
                  start_port = 9050, 
-                 tor_config = None):
+                 tor_config = None,
+                 max_concurrency = SPAWN_CONCURRENCY,     # max number of clients bootstrapping at once
+                 min_ready = None,                        # return once this many clients are up (default: all)
+                 bootstrap_timeout = BOOTSTRAP_TIMEOUT,
+                 bootstrap_attempts = BOOTSTRAP_ATTEMPTS,
+                 seed_dir = SEED_DIRECTORY,               # None disables shared directory seeding
+                 seed_refresh_interval = SEED_REFRESH_INTERVAL,
+                 exclusions_file = EXCLUSIONS_FILE,       # None to not persist excluded exits
+                 exclusion_ttl = EXCLUSION_TTL,           # seconds a persisted exclusion outlives the pool
+                 exclude_debounce = EXCLUDE_DEBOUNCE,
+                 num_spares = 0,                          # bootstrapped clients kept in reserve for restartClient()
+                 metrics = None,                          # MetricsRegistry, default Metrics.REGISTRY
+                 virtual_clients = 1,                     # isolated circuit sets (VirtualClients) per tor process
+                 exit_planner = None):                    # ExitPlanner giving each client its own ExitNodes
         
+        if virtual_clients < 1:
+            raise ValueError("virtual_clients must be at least 1")
+        self.virtual_clients = virtual_clients
+        self.metrics = metrics or Metrics.REGISTRY
+        self.bootstrap_seconds = self.metrics.histogram('torgetter_bootstrap_seconds', 
+                                                        'Time for a tor client to bootstrap, retries included')
+        self.bootstrap_failures = self.metrics.counter('torgetter_bootstrap_failures_total', 
+                                                       'Tor clients that gave up bootstrapping')
+        self.client_gauge = self.metrics.gauge('torgetter_clients', 'Bootstrapped tor clients', ('state',))
+        self.restarts = self.metrics.counter('torgetter_client_restarts_total', 
+                                             'Tor clients replaced, by a spare or a cold start', ('kind',))
+        self.exclusion_counter = self.metrics.counter('torgetter_excluded_exits_total', 'Exits excluded on every client')
+        self.newnyms = self.metrics.counter('torgetter_newnym_total', 'NEWNYM signals sent', ('port',))
+
         self.clients = {}   # {'socks_port': TorClient(), ...}
+        self.max_concurrency = max_concurrency
+        self.bootstrap_timeout = bootstrap_timeout
+        self.bootstrap_attempts = bootstrap_attempts
+        self.seed_dir = seed_dir
+        self.seed_refresh_interval = seed_refresh_interval
+        self.seed_lock = self.metrics.timedLock('pool_seed')
+        self.relay_index = RelayIndex()     # built from the first client to come up, see indexRelays()
+        self.index_lock = self.metrics.timedLock('pool_index')
+
+        self.exclusions_file = exclusions_file
+        self.exclusion_ttl = exclusion_ttl
+        self.exclude_debounce = exclude_debounce
+        self.exclusion_times = {}                       # {'fingerprint': unix time it was excluded}
+        self.excluded_exits = self.loadExclusions()     # {'fingerprint', ...} applied to every client
+        self.pending_exclusions = set()                 # waiting for the next batch
+        self.exclude_timer = None
+        self.exclude_lock = self.metrics.timedLock('pool_exclude')
+        self.flush_lock = self.metrics.timedLock('pool_flush')
+
+        self.exit_planner = exit_planner
+        if exit_planner and tor_config and 'ExitNodes' in tor_config:
+            logger.warning("tor_config sets ExitNodes, so they won't be planned")
+            self.exit_planner = None
+        self.plan_lock = self.metrics.timedLock('pool_plan')
         
         # create list of (source_port, control_port) tuples
         tor_ports = [(str(start_port + i), 
                       str(start_port + num_tor_clients + i)) for i in range(num_tor_clients)]
         
+        # spares get their own reserved range of ports after the main clients'
+        spare_start = start_port + 2 * num_tor_clients
+        spare_ports = [(str(spare_start + i), 
+                        str(spare_start + num_spares + i)) for i in range(num_spares)]
+        self.tor_config = tor_config
+        self.spares = deque()   # [TorClient(), ...] bootstrapped + ready to swap in
+        self.spare_executor = ThreadPoolExecutor(max_workers = max(num_spares, 1))
+        self.spare_futures = set()
+        self.spare_timers = []  # Timers of spares waiting to be tried again
+
+        # deal out exits from the seed's consensus before any client is spawned, so each one starts with its
+        # own ExitNodes. Without a seed, see applyExitPlan()
+        self.exit_ports = [socks_port for socks_port, control_port in tor_ports + spare_ports]
+        if self.exit_planner and (len(self.exit_planner) or (self.seed_dir and os.path.isdir(self.seed_dir)
+                                                             and self.exit_planner.load(self.seed_dir))):
+            self.exit_planner.plan(self.exit_ports, self.excluded_exits, self.exitsPerClient())
     
-        self.spawnClients(tor_ports, tor_config)
+        self.spawnClients(tor_ports, tor_config, min_ready)
+        for socks_port, control_port in spare_ports:
+            self.spawnSpare(socks_port, control_port, tor_config)
 
-    def spawnClients(self, tor_ports, config = None):
+    def spawnClients(self, tor_ports, config = None, min_ready = None):
+        """Bootstrap a tor client for each (socks_port, control_port) tuple, up to max_concurrency at a time.
+           Returns once min_ready clients are up (all of them by default), the rest keep joining
+           self.clients in the background -- see waitForClients()"""
             
-        print(f"Spawning {len(tor_ports)} tor clients ...")
-        start_time = datetime.now()
+        logger.info("Spawning %d tor clients ...", len(tor_ports))
+        self.spawn_start = monotonic()
         
         self.clients = {} 
-        successes = 0    
-        for p in tor_ports:
-            """Create a tor process + controller for each port"""
-            socks_port = p[0]
-            control_port = p[1]
-            self.clients[socks_port] = TorClient(socks_port, control_port, config)
-            successes += 1
-            print(f"Successfully brought up Tor client # {successes}")
-
-        spawning_time = (datetime.now() - start_time).seconds
-        print(f"Spawning completed in {spawning_time} seconds.")
+        self.endpoints = {}     # {'key': VirtualClient(), ...} what getters send their requests through
+        self.spawn_report = {}  # {'socks_port': {'time': seconds, 'attempts': n, 'error': None}, ...}
+        self.clients_lock = self.metrics.timedLock('pool_clients')
+
+        executor = ThreadPoolExecutor(max_workers = self.max_concurrency)
+        self.spawning = [executor.submit(self._spawnClient, socks_port, control_port, config) 
+                         for socks_port, control_port in tor_ports]
+        executor.shutdown(wait = False)     # don't block on stragglers, they finish in the background
+
+        quorum = len(tor_ports) if min_ready is None else min(min_ready, len(tor_ports))
+        successes = 0
+        for future in as_completed(self.spawning):
+            if future.result():
+                successes += 1
+            if successes >= quorum:
+                break
+
+        spawning_time = monotonic() - self.spawn_start
+        if successes < quorum:
+            # nothing else would ever stop the clients that did come up, or the ones still bootstrapping
+            logger.error("Only %d of the %d required tor clients bootstrapped, shutting down the pool ...",
+                         successes, quorum)
+            self.cleanShutdown()
+            raise OSError(f"Only {successes} of the {quorum} required tor clients bootstrapped")
+
+        logger.info("%d of %d tor clients ready in %.1f seconds.", successes, len(tor_ports), spawning_time)
+
+    def _spawnClient(self, socks_port, control_port, config):
+        """Runs in the spawning thread pool: bring up one client + record how long it took"""
+        start_time = monotonic()
+        try:
+            client = self.newClient(socks_port, control_port, config)
+        except OSError as e:
+            logger.error("Giving up on tor client @ port %s: %s", socks_port, e, extra = {'port': socks_port})
+            with self.clients_lock:
+                self.spawn_report[socks_port] = {'time': monotonic() - start_time, 
+                                                 'attempts': self.bootstrap_attempts, 
+                                                 'error': e}
+            return False
+
+        with self.clients_lock:
+            self.clients[socks_port] = client
+            self.addEndpoints(client)
+            self.syncExclusions(client)
+            self.spawn_report[socks_port] = {'time': client.bootstrap_time, 
+                                             'attempts': client.attempts, 
+                                             'error': None}
+            self.client_gauge.set(len(self.clients), state = 'ready')
+            logger.info("Successfully brought up Tor client # %d (port %s) in %.1f seconds",
+                        len(self.clients), socks_port, client.bootstrap_time,
+                        extra = {'port': socks_port, 'seconds': client.bootstrap_time})
+
+        self.refreshSeed(client)
+        self.indexRelays(client)
+        self.applyExitPlan(client)
+        return True
+
+    def addEndpoints(self, client):
+        """Add client's VirtualClients to self.endpoints. Call with clients_lock held"""
+        indexes = [None] if self.virtual_clients == 1 else range(self.virtual_clients)
+        for index in indexes:
+            endpoint = VirtualClient(client, index)
+            self.endpoints[endpoint.key] = endpoint
+
+    def removeEndpoints(self, socks_port):
+        """Remove the VirtualClients of the client @ socks_port. Call with clients_lock held"""
+        for key in [k for k, e in self.endpoints.items() if e.socks_port == socks_port]:
+            del self.endpoints[key]
+
+    def renewEndpoint(self, key):
+        """Give the virtual client key fresh circuits, without touching the others in its tor process"""
+        self.endpoints[key].renew()
+        self.restarts.inc(kind = 'virtual')
+
+    def renewCircuits(self, socks_port):
+        """Send NEWNYM to the client @ socks_port, so its new streams go out over new circuits"""
+        client = self.clients[socks_port]
+        try:
+            logger.info("Sending NEWNYM signal to client @ port %s ...", socks_port)
+            client.controller.signal(Signal.NEWNYM)
+            self.newnyms.inc(port = socks_port)
+        except stem.ControllerError as e:
+            logger.warning("Failed to send NEWNYM to client @ port %s: %s", socks_port, e)
+
+    def indexRelays(self, client, force = False):
+        """Build the pool's RelayIndex from client's consensus and follow its updates,
+           unless the index is already attached to a live client"""
+        with self.index_lock:
+            if self.relay_index.controller is not None and not force:
+                return
+            try:
+                self.relay_index.attach(client.controller)
+            except stem.ControllerError as e:
+                logger.warning("Failed to index relays from client @ port %s: %s", client.socks_port, e)
+                self.relay_index.detach()
+
+    def seedAge(self):
+        """Seconds since the shared seed was last refreshed, or None if there isn't one yet"""
+        if not self.seed_dir:
+            return None
+        try:
+            return datetime.now().timestamp() - os.path.getmtime(self.seed_dir)
+        except OSError:
+            return None
+
+    def refreshSeed(self, client, force = False):
+        """Replace the shared seed with the directory documents of a freshly bootstrapped client,
+           if the seed is missing or older than seed_refresh_interval"""
+        if not self.seed_dir:
+            return False
+        age = self.seedAge()
+        if not force and age is not None and age < self.seed_refresh_interval:
+            return False
+        if not self.seed_lock.acquire(blocking = False):
+            return False    # another thread is already refreshing it
+        
+        try:
+            # build the new seed next to the old one, then swap it in, so clients
+            # being seeded concurrently never see a half-written directory
+            parent = os.path.dirname(os.path.abspath(self.seed_dir))
+            new_seed = tempfile.mkdtemp(prefix = '.torseed-new-', dir = parent)
+            if not seedDirectory(client.config['DataDirectory'], new_seed):
+                shutil.rmtree(new_seed)
+                return False
+            
+            old_seed = None
+            if os.path.isdir(self.seed_dir):
+                old_seed = tempfile.mkdtemp(prefix = '.torseed-old-', dir = parent)
+                os.rename(self.seed_dir, os.path.join(old_seed, 'seed'))
+            os.rename(new_seed, self.seed_dir)
+            if old_seed:
+                shutil.rmtree(old_seed)
+
+            logger.info("Refreshed shared directory seed from tor client @ port %s", client.socks_port)
+            if self.exit_planner:
+                self.exit_planner.load(self.seed_dir)   # replacements are picked from the newer consensus
+            return True
+
+        except OSError as e:
+            logger.warning("Failed to refresh directory seed from client @ port %s: %s", client.socks_port, e)
+            return False
+        finally:
+            self.seed_lock.release()
+
+    def newClient(self, socks_port, control_port, config = None):
+        """Bootstrap a TorClient with the pool's settings (blocks until it's up)"""
+        try:
+            client = TorClient(socks_port, control_port, self.clientConfig(config, socks_port), 
+                               bootstrap_timeout = self.bootstrap_timeout,
+                               bootstrap_attempts = self.bootstrap_attempts,
+                               seed_dir = self.seed_dir,
+                               relay_index = self.relay_index,
+                               metrics = self.metrics)
+        except OSError:
+            self.bootstrap_failures.inc()
+            raise
+        self.bootstrap_seconds.observe(client.bootstrap_time)
+        return client
+
+    def spawnSpare(self, socks_port, control_port, config = None, old_client = None):
+        """In the background: destroy old_client (if given, freeing up the ports), then bootstrap 
+           a spare client on socks_port/control_port"""
+        try:
+            future = self.spare_executor.submit(self._spawnSpare, socks_port, control_port, config, old_client)
+        except RuntimeError:    # a retry that came due as the pool was shutting down
+            return
+        self.spare_futures.add(future)
+        future.add_done_callback(self.spare_futures.discard)
+
+    def _spawnSpare(self, socks_port, control_port, config, old_client):
+        if old_client:
+            try:
+                old_client.destroy()
+            except Exception as e:
+                logger.warning("Failed to destroy replaced client @ port %s: %s", old_client.socks_port, e)
+        try:
+            spare = self.newClient(socks_port, control_port, config)
+        except OSError as e:
+            # or the pool would run a spare short for good
+            logger.error("Failed to bring up spare tor client @ port %s, trying again in %d seconds: %s",
+                         socks_port, SPARE_RETRY_DELAY, e)
+            timer = Timer(SPARE_RETRY_DELAY, self.spawnSpare, (socks_port, control_port, config))
+            timer.daemon = True
+            with self.clients_lock:
+                self.spare_timers = [t for t in self.spare_timers if t.is_alive()] + [timer]
+            timer.start()
+            return
+        self.refreshSeed(spare)
+        self.applyExitPlan(spare)
+        with self.clients_lock:
+            self.spares.append(spare)
+            self.syncExclusions(spare)
+            self.client_gauge.set(len(self.spares), state = 'spare')
+        logger.info("Spare tor client @ port %s ready (%d spares)", socks_port, len(self.spares))
+
+    def waitForClients(self, timeout = None):
+        """Block until every client from the last spawnClients() call is up (or has given up)"""
+        wait(self.spawning, timeout = timeout)
+        return len(self.clients)
+
+    def spawnSummary(self):
+        """Startup timings for the last spawnClients() call"""
+        times = sorted(r['time'] for r in self.spawn_report.values() if not r['error'])
+        return {'requested': len(self.spawning),
+                'ready': len(times),
+                'failed': sum(1 for r in self.spawn_report.values() if r['error']),
+                'pending': sum(1 for f in self.spawning if not f.done()),
+                'retries': sum(r['attempts'] - 1 for r in self.spawn_report.values()),
+                'min_time': times[0] if times else None,
+                'median_time': times[len(times) // 2] if times else None,
+                'max_time': times[-1] if times else None,
+                'elapsed': monotonic() - self.spawn_start}
 
     def updateClientConfigs(self, config_dict):
         for client in self.clients.values():
@@ -167,49 +621,246 @@ class TorClientPool():
 
 
     def restartClient(self, socks_port):
-        """Destroy the tor client @ socks_port, and create a new one to replace it, with same config"""
-        tor_client = self.clients[socks_port]
+        """Replace the tor client @ socks_port with a fresh one, with same config. Returns the socks port
+           of the replacement, which is different from socks_port if it's a spare that was swapped in"""
+        tor_client = self.clients.get(socks_port)
 
         if not tor_client:
-            print(f"Received invalid SOCKS port: no tor client @ port {socks_port} ...")
+            logger.error("Received invalid SOCKS port: no tor client @ port %s ...", socks_port)
             raise ValueError
             
-        else:
-            # Extract the info we need from old client, then kill it
-            config = tor_client.config
-            control_port = config['ControlPort']
+        # Extract the info we need from old client, then kill it
+        config = tor_client.config
+        control_port = config['ControlPort']
+        if self.exit_planner and 'ExitNodes' in config:
+            # the client that takes over socks_port gets a fresh set of exits, see clientConfig()
+            config = {opt: val for opt, val in config.items() if opt != 'ExitNodes'}
+            self.exit_planner.retire(socks_port)
+
+        indexed = self.relay_index.controller is tor_client.controller
+        if indexed:
+            self.relay_index.detach()
+
+        with self.clients_lock:
+            spare = self.spares.popleft() if self.spares else None
+            if spare:
+                # instant swap, the old process is torn down + replaced by a new spare in the background
+                del self.clients[socks_port]
+                self.clients[spare.socks_port] = spare
+                self.removeEndpoints(socks_port)
+                self.addEndpoints(spare)
+                self.client_gauge.set(len(self.spares), state = 'spare')
+
+        if spare:
+            logger.info("Swapped spare tor client @ port %s in for client @ port %s", spare.socks_port, socks_port)
+            self.restarts.inc(kind = 'spare')
+            self.spawnSpare(socks_port, control_port, config, old_client = tor_client)
+            new_client = spare
 
+        else:
             tor_client.destroy()
             
-            print(f"DEBUG: Creating new tor client with tor_config {str(config)}")
-            self.clients[socks_port] = TorClient(socks_port, control_port, config)
+            logger.debug("Creating new tor client with tor_config %s", config)
+            self.restarts.inc(kind = 'cold')
+            new_client = self.newClient(socks_port, control_port, config)
+            with self.clients_lock:
+                self.clients[socks_port] = new_client
+                self.removeEndpoints(socks_port)
+                self.addEndpoints(new_client)
+                self.syncExclusions(new_client)
+            self.refreshSeed(new_client)
+
+        if indexed:
+            self.indexRelays(new_client)
+        return new_client.socks_port
             
 
+    def clientConfig(self, config = None, socks_port = None):
+        """config for a new tor client, with the pool's current exit exclusions baked in, and the exits
+           planned for socks_port as its ExitNodes"""
+        config = dict(config) if config else {}
+        if self.virtual_clients > DEFAULT_CIRCUITS_PENDING:
+            # or tor queues the virtual clients' first circuits behind each other
+            config.setdefault('MaxClientCircuitsPending', str(min(self.virtual_clients, MAX_CIRCUITS_PENDING)))
+        if self.excluded_exits:
+            config['ExcludeExitNodes'] = self.excludeExitNodes(self.excluded_exits)
+        if self.exit_planner and socks_port is not None and 'ExitNodes' not in config:
+            exit_nodes = self.exitNodes(socks_port)
+            if exit_nodes:
+                config['ExitNodes'] = exit_nodes
+        return config
+
+    def excludeExitNodes(self, excluded):
+        """ExcludeExitNodes value with the entries tor_config already excludes (fingerprints, nicknames,
+           {country} codes ...) kept, followed by the excluded fingerprints"""
+        configured = (self.tor_config or {}).get('ExcludeExitNodes') or ''
+        if not isinstance(configured, str):
+            configured = ','.join(configured)
+        entries = [entry.strip() for entry in configured.split(',') if entry.strip()]
+        entries += sorted(set(excluded) - set(entries))
+        return ','.join(entries)
+
+    def excludedExits(self):
+        with self.exclude_lock:
+            return self.excluded_exits | self.pending_exclusions
+
+    def exitsPerClient(self):
+        # every virtual client should be able to get an exit of its own
+        return max(self.exit_planner.exits_per_client, self.virtual_clients)
+
+    def exitNodes(self, socks_port):
+        """ExitNodes for the client @ socks_port: the exits planned for it, or a fresh set from the planner
+           if it doesn't have one (yet, or any more after a restart). None if the planner has no exits to give"""
+        if not self.exit_planner.exitNodes(socks_port):
+            self.exit_planner.assign(socks_port, self.excludedExits(), self.exitsPerClient())
+        return self.exit_planner.exitNodes(socks_port)
+
+    def applyExitPlan(self, client):
+        """Set the planned ExitNodes on a client that came up without them, because there was no cached
+           consensus to plan from when it was spawned. The first such client deals out the exits of its
+           consensus (or the seed refreshed from it) over the pool's ports"""
+        if not self.exit_planner or 'ExitNodes' in client.config:
+            return
+        with self.plan_lock:
+            if not self.exit_planner.assigned:
+                data_dir = client.config.get('DataDirectory')
+                if not len(self.exit_planner) and not (data_dir and self.exit_planner.load(data_dir)):
+                    return
+                self.exit_planner.plan(self.exit_ports, self.excludedExits(), self.exitsPerClient())
+            exit_nodes = self.exitNodes(client.socks_port)
+        if not exit_nodes:
+            return
+        try:
+            client.controller.set_conf('ExitNodes', exit_nodes)
+            client.config['ExitNodes'] = exit_nodes
+            logger.info("Set %d planned exits on tor client @ port %s",
+                        exit_nodes.count(',') + 1, client.socks_port, extra = {'port': client.socks_port})
+        except stem.ControllerError as e:
+            logger.warning("Failed to set ExitNodes for client @ port %s: %s", client.socks_port, e)
+
+    def loadExclusions(self):
+        """Excluded exits persisted by earlier pools, minus those excluded more than exclusion_ttl seconds ago,
+           so exits that failed once get another chance eventually instead of the list only ever growing"""
+        if not self.exclusions_file or not os.path.isfile(self.exclusions_file):
+            return set()
+        with open(self.exclusions_file) as f:
+            saved = json.load(f)
+        now = datetime.now().timestamp()
+        if isinstance(saved, list):     # written before exclusions had timestamps: their ttl starts now
+            saved = dict.fromkeys(saved, now)
+        self.exclusion_times = {fingerprint: excluded_at for fingerprint, excluded_at in saved.items()
+                                if self.exclusion_ttl is None or now - excluded_at < self.exclusion_ttl}
+        if len(saved) > len(self.exclusion_times):
+            logger.info("%d persisted exit exclusions expired, %d still apply", 
+                        len(saved) - len(self.exclusion_times), len(self.exclusion_times))
+        return set(self.exclusion_times)
+
+    def saveExclusions(self):
+        if not self.exclusions_file:
+            return
+        tmp_file = self.exclusions_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.exclusion_times, f, sort_keys = True)
+        os.replace(tmp_file, self.exclusions_file)
+
     def excludeExit(self, exit_fingerprint):
-        """given a TorRelay object, adds relay to ExcludeExitNodes in config
-           but can still be an entry/middle node"""
-        for client in self.clients.values():
-            # get the current list of excluded exit nodes for this client
-            current = client.controller.get_conf('ExcludeExitNodes')
-            if current == '{??}':
-                client.controller.set_conf('ExcludeExitNodes', exit_fingerprint)
-                continue;
-            
-            if not exit_fingerprint:
-                print("ERROR: Received empty exit fingerprint")
-                continue
-            elif exit_fingerprint in current:
-                print("ERROR: currently using an exit that's already been excluded")
-                continue
-            else:
-                new_exclude_list = current +  ', ' + exit_fingerprint
-                print(f"Updating client @ socks port {client.socks_port} with ExcludeExitNodes = {str(new_exclude_list)}")
-                client.controller.set_conf('ExcludeExitNodes', new_exclude_list)
-            
-            if exit_fingerprint in client.getExitFingerprints():
-                print(f"Sending NEWNYM signal to client @ port {client.socks_port} ...")
+        """Queue an exit fingerprint to be added to ExcludeExitNodes on every client (it can still be an
+           entry/middle node). Returns immediately: exclusions are applied in batches, exclude_debounce
+           seconds after the first one of the batch arrives"""
+        if not exit_fingerprint:
+            logger.error("Received empty exit fingerprint")
+            return
+
+        with self.exclude_lock:
+            if exit_fingerprint in self.excluded_exits or exit_fingerprint in self.pending_exclusions:
+                return
+            self.pending_exclusions.add(exit_fingerprint)
+            if self.exclude_timer is None:
+                self.exclude_timer = Timer(self.exclude_debounce, self.flushExclusions)
+                self.exclude_timer.daemon = True
+                self.exclude_timer.start()
+
+    def flushExclusions(self, apply = True):
+        """Apply (and persist) the pending batch of excluded exits now, on all clients concurrently.
+           Clients with a circuit through one of the newly excluded exits are sent NEWNYM, and ones
+           that had them planned as ExitNodes get replacements for them from the planner"""
+        with self.flush_lock:
+            with self.exclude_lock:
+                if self.exclude_timer:
+                    self.exclude_timer.cancel()
+                    self.exclude_timer = None
+                batch = self.pending_exclusions
+                self.pending_exclusions = set()
+                if not batch:
+                    return
+                self.excluded_exits |= batch
+                self.exclusion_times.update(dict.fromkeys(batch, datetime.now().timestamp()))
+                self.exclusion_counter.inc(len(batch))
+                exclude_list = self.excludeExitNodes(self.excluded_exits)
+                self.saveExclusions()
+
+            if not apply:
+                return
+
+            with self.clients_lock:     # restartClient() swaps clients in + out concurrently
+                clients = list(self.clients.values()) + list(self.spares)
+            logger.info("Excluding %d more exits (%d total) on %d clients ...", 
+                        len(batch), len(self.excluded_exits), len(clients))
+            exit_plans = self.topUpExitPlans(clients)
+            with ThreadPoolExecutor(max_workers = self.max_concurrency) as executor:
+                for client in clients:
+                    executor.submit(self._applyExclusions, client, exclude_list, batch, exit_plans.get(client.socks_port))
+
+    def topUpExitPlans(self, clients):
+        """{socks_port: new ExitNodes value} for the clients whose planned exits were just excluded, with
+           StrictNodes they'd otherwise be left with fewer and fewer exits until they had none at all.
+           '' for a client the planner has nothing left for, which then exits wherever tor likes"""
+        if not self.exit_planner:
+            return {}
+        exit_plans = {}
+        excluded = self.excludedExits()
+        with self.plan_lock:
+            for client in clients:
+                if 'ExitNodes' not in client.config:
+                    continue
+                exits = self.exit_planner.topUp(client.socks_port, excluded, self.exitsPerClient())
+                if exits is not None:
+                    exit_plans[client.socks_port] = ','.join(exits)
+        return exit_plans
+
+    def syncExclusions(self, client):
+        """Apply the pool's current exclusions to a client that's joining self.clients or self.spares: it was
+           configured when it started bootstrapping, so exits a flushExclusions() excluded since then never
+           reached it. Call with clients_lock held, so the next flushExclusions() finds the client"""
+        with self.exclude_lock:
+            excluded = set(self.excluded_exits)
+        exclude_list = self.excludeExitNodes(excluded)
+        if exclude_list == client.config.get('ExcludeExitNodes', ''):
+            return
+        configured = set(client.config.get('ExcludeExitNodes', '').split(','))
+        self._applyExclusions(client, exclude_list, excluded - configured,
+                              self.topUpExitPlans([client]).get(client.socks_port))
+
+    def _applyExclusions(self, client, exclude_list, batch, exit_nodes = None):
+        try:
+            if exit_nodes is not None:
+                # the new ExitNodes first, so there's no moment where all of them are excluded
+                client.controller.set_conf('ExitNodes', exit_nodes or None)
+                if exit_nodes:
+                    client.config['ExitNodes'] = exit_nodes
+                else:
+                    logger.warning("No planned exits left for client @ port %s, letting tor pick them",
+                                   client.socks_port, extra = {'port': client.socks_port})
+                    client.config.pop('ExitNodes', None)
+            client.controller.set_conf('ExcludeExitNodes', exclude_list)
+            client.config['ExcludeExitNodes'] = exclude_list
+            if batch & client.streams.liveExits():
+                # tor rate limits NEWNYM itself, so there's no need to wait out get_newnym_wait() here
+                logger.info("Sending NEWNYM signal to client @ port %s ...", client.socks_port)
                 client.controller.signal(Signal.NEWNYM)
-                sleep(client.controller.get_newnym_wait())    
+                self.newnyms.inc(port = client.socks_port)
+        except stem.ControllerError as e:
+            logger.warning("Failed to update ExcludeExitNodes for client @ port %s: %s", client.socks_port, e)
 
             
     def excludeRelay(self, tor_relay):
@@ -217,5 +868,19 @@ class TorClientPool():
         pass
         
     def cleanShutdown(self):
-        for client in self.clients.values():
-            client.destroy()
+        """Stop any clients still waiting to bootstrap, then destroy all clients, max_concurrency at a time"""
+        for future in self.spawning:
+            future.cancel()
+        wait(self.spawning)
+        for timer in self.spare_timers:
+            timer.cancel()
+        self.spare_executor.shutdown(wait = True, cancel_futures = True)
+        self.relay_index.detach()
+        self.flushExclusions(apply = False)     # just persist any pending exclusions
+
+        with ThreadPoolExecutor(max_workers = self.max_concurrency) as executor:
+            clients = list(self.clients.values()) + list(self.spares)
+            futures = [executor.submit(client.destroy) for client in clients]
+            for future in as_completed(futures):
+                if future.exception():
+                    logger.error("Error during shutdown: %s", future.exception())
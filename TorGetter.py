@@ -1,23 +1,42 @@
 import os
 import signal
 import logging
-from datetime import datetime
-from time import sleep
+import asyncio
+import queue
+import sqlite3
+from time import sleep, monotonic
 import functools
 from abc import ABC, abstractmethod
 from collections import defaultdict, deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock, Semaphore
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Condition, Event, Lock, Semaphore, Thread
 from urllib.error import URLError
+from urllib.parse import urlparse
 import json
 
 import requests
-import tldextract
+import urllib3
 from stem import Signal, StreamStatus
 from stem.control import Controller, EventType
+
+import Metrics
+from Pipeline import Pipeline
+from FetchResult import FetchResult
+from DomainScheduler import DomainScheduler
+from ClientHealth import ClientHealth
+from AdaptiveTimeout import AdaptiveTimeout
+from Frontier import domainFromURL
 from selenium import webdriver
 from selenium.common import exceptions as selenium_exceptions
 
+try:    # only needed for AsyncTorGetter
+    import aiohttp
+    from aiohttp import compression_utils
+    from aiohttp_socks import ProxyConnector, ProxyError, ProxyConnectionError, ProxyTimeoutError
+except ImportError:
+    aiohttp = None
+
 
 """
  _                            _    _              
@@ -46,48 +65,274 @@ from selenium.common import exceptions as selenium_exceptions
 """
 
 DEFAULT_DELAY = 5               # delay between requests for each tor client, in seconds
-DEFAULT_TIMEOUT = 30            # http request timeout, in seconds
+DEFAULT_DOMAIN_DELAY = 0        # delay between requests to the same domain across all tor clients, in seconds
+DEFAULT_LOOKAHEAD = 1000        # max urls buffered from the input, so the scheduler can skip rate-limited domains
+DEFAULT_TIMEOUT = 30            # http request timeout, in seconds (the most an adaptive timeout can go up to)
+HEDGE_PERCENTILE = 95           # a fetch running longer than this percentile of fetches like it gets a duplicate ...
+HEDGE_BUDGET = 0.05             # ... as long as duplicates stay under this fraction of all fetches
+HEDGE_RETRY_INTERVAL = 1        # seconds before looking again for a client to duplicate a fetch on, if none could take it
 MAX_FAILED_FETCHES = 2          # tor client is allowed to return failure (timeout, connection error, etc) for N requests per batch, before being replaced 
 DEFAULT_UA = 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+# compressed encodings we ask servers for: only ones the http library can decode, so br + zstd once
+# brotli / zstd support is installed for it (pip install urllib3[brotli,zstd], aiohttp[speedups])
+ACCEPT_ENCODING = urllib3.util.make_headers(accept_encoding = True)['accept-encoding']
+AIOHTTP_ACCEPT_ENCODING = ','.join(['gzip', 'deflate'] 
+                                   + (['br'] if aiohttp and compression_utils.HAS_BROTLI else [])
+                                   + (['zstd'] if aiohttp and getattr(compression_utils, 'HAS_ZSTD', False) else []))
 DISABLE_IMAGE_LOADING = True
 DISABLE_HTTP_KEEP_ALIVE = True
 CONNECTION_RETRIES = 1          # if a connection fails, how many times do we retry?
+STREAMS_PER_CLIENT = 32         # max requests in flight per tor client (AsyncTorGetter)
+STREAMS_PER_DOMAIN = 4          # max requests in flight per domain, per tor client (AsyncTorGetter)
+TABS_PER_BROWSER = 4            # pages loading at once in each headless browser (SeleniumTorGetter)
+PAGE_LOAD_STRATEGY = 'eager'    # 'eager': page is done once the DOM is parsed, 'normal': once every subresource has loaded too
+RECYCLE_AFTER_PAGES = 200       # restart a browser after it has loaded this many pages ...
+BROWSER_MAX_RSS = 1024 ** 3     # ... or once it (+ its renderers) uses more than this many bytes of RAM
+RSS_CHECK_EVERY = 10            # pages between RSS checks, since walking /proc isn't free
+TAB_POLL_INTERVAL = 0.1         # seconds between checks on whether a tab has finished loading
+IDLE_POLL_INTERVAL = 0.5        # seconds between checks for a tor client to fetch with, when there's none
+# bodies are streamed in (RequestsTorGetter, AsyncTorGetter) so a fetch can give up on one early
+MAX_BODY_SIZE = 10 * 1024 ** 2  # bytes; a longer body is abandoned and the fetch fails
+CONTENT_TYPES = None            # e.g. ('text/html', 'text/*'); responses of any other type aren't read. None: any
+MIN_THROUGHPUT = 1024           # bytes/sec; a body trickling in slower than this over THROUGHPUT_WINDOW is abandoned
+THROUGHPUT_WINDOW = 10          # seconds
+CHUNK_SIZE = 64 * 1024          # max bytes read from a response at a time
+
+# blocked (as url patterns) in SeleniumTorGetter's browsers, so pages don't pull them over tor
+RESOURCE_EXTENSIONS = {'image': ('png', 'jpg', 'jpeg', 'gif', 'webp', 'avif', 'svg', 'ico', 'bmp'),
+                       'stylesheet': ('css',),
+                       'font': ('woff', 'woff2', 'ttf', 'otf', 'eot'),
+                       'media': ('mp4', 'webm', 'ogg', 'ogv', 'mp3', 'm4a', 'wav', 'flac', 'mov', 'avi')}
+BLOCKED_RESOURCE_TYPES = ('stylesheet', 'font', 'media') + (('image',) if DISABLE_IMAGE_LOADING else ())
+READY_STATES = {'none': ('loading', 'interactive', 'complete'),
+                'eager': ('interactive', 'complete'),
+                'normal': ('complete',)}
+
+logger = logging.getLogger(__name__)
+
+
+class FetchAborted(Exception):
+    """The getter gave up on a response before reading all of its body"""
+    client_fault = False    # does it count against the tor client that fetched it?
+
+
+class ContentTypeRejected(FetchAborted):
+    pass
+
+
+class BodyTooLarge(FetchAborted):
+    pass
+
+
+class TooSlow(FetchAborted):
+    client_fault = True     # a circuit this slow should be replaced
+
+
+class FetchCancelled(FetchAborted):
+    pass                    # a hedged duplicate of the fetch came back first
+
+
+# errors of fetches that ran out of time, whichever engine made them
+TIMEOUT_ERRORS = (requests.exceptions.Timeout, urllib3.exceptions.TimeoutError, TimeoutError,
+                  asyncio.TimeoutError, selenium_exceptions.TimeoutException)
+
+
+def isTimeout(error):
+    """Did a fetch fail with error because it ran out of time?"""
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        error = error.args[0]   # a read timing out while the body streams in comes wrapped in a ConnectionError
+    return isinstance(error, TIMEOUT_ERRORS)
+
+
+class BodyBuffer():
+    """Collects a response body chunk by chunk, raising BodyTooLarge once it grows past max_size
+       and TooSlow if it arrives slower than min_throughput bytes/sec over any window seconds"""
+
+    def __init__(self, max_size = MAX_BODY_SIZE, min_throughput = MIN_THROUGHPUT, window = THROUGHPUT_WINDOW,
+                 cancel = None):     # threading.Event, FetchCancelled is raised once it's set
+        self.max_size = max_size
+        self.min_throughput = min_throughput
+        self.window = window
+        self.cancel = cancel
+        self.chunks = []
+        self.size = 0
+        self.window_start = monotonic()
+        self.window_bytes = 0
+
+    def add(self, chunk):
+        if self.cancel and self.cancel.is_set():
+            raise FetchCancelled("A duplicate of the fetch finished first")
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise BodyTooLarge(f"Body is over {self.max_size} bytes")
+        self.chunks.append(chunk)
+
+        self.window_bytes += len(chunk)
+        elapsed = monotonic() - self.window_start
+        if elapsed >= self.window:
+            if self.min_throughput and self.window_bytes / elapsed < self.min_throughput:
+                raise TooSlow(f"Body arrived at {self.window_bytes / elapsed:.0f} bytes/sec over the last {elapsed:.0f}s")
+            self.window_start += elapsed
+            self.window_bytes = 0
+
+    def getvalue(self):
+        return b''.join(self.chunks)
 
 
 class TorGetter(ABC):
+    fetches_per_client = 1          # fetches a session can have in flight at once
+
     def __init__(self,
                  urls,                       # urls to fetch
                  tor_client_pool,            # TorClientPool to route requests through
                  delay = DEFAULT_DELAY,      # num seconds between requests, per client, per domain
-                 timeout = DEFAULT_TIMEOUT): # num seconds to wait for fetch() to succeed before timeout
+                 timeout = DEFAULT_TIMEOUT,  # num seconds to wait for fetch() to succeed before timeout
+                 adaptive_timeout = True,    # time fetches out sooner, going by how long fetches like them take
+                 hedge_percentile = None,    # duplicate fetches slower than this percentile on another client, None: never
+                 hedge_budget = HEDGE_BUDGET,           # max fraction of fetches that are duplicates
+                 domain_delay = DEFAULT_DOMAIN_DELAY,   # num seconds between requests per domain, across all clients
+                 lookahead = DEFAULT_LOOKAHEAD,         # max urls buffered for scheduling
+                 max_body_size = MAX_BODY_SIZE,         # bytes, None: no limit  (not SeleniumTorGetter)
+                 content_types = CONTENT_TYPES,         # allowed Content-Types  (not SeleniumTorGetter)
+                 min_throughput = MIN_THROUGHPUT,       # bytes/sec, 0: no floor (not SeleniumTorGetter)
+                 metrics = None):                       # MetricsRegistry, default Metrics.REGISTRY
 
         self.urls = urls
         self.tor_client_pool = tor_client_pool
 
         self.delay = delay         
         self.timeout = timeout 
+        self.adaptive_timeout = adaptive_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.domain_delay = domain_delay
+        self.lookahead = lookahead
+        self.max_body_size = max_body_size
+        self.content_types = content_types
+        self.min_throughput = min_throughput
         
         # {port: number of times fetch has failed on this port ...}
         self.failed_fetch_count = defaultdict(int)    
-        
-        # each tor SOCKS port maps to dict: {'domain': Lock(), 'domainB': Lock(), ...}
-        # to enforce rate limits per domain per port
-        self.locks = {}
-        for socks_port in tor_client_pool.clients.keys():
-            self.locks[socks_port] = defaultdict(Lock)
+        self.health = ClientHealth()    # rolling latency/error/throughput stats per port
+        self.latencies = AdaptiveTimeout()      # latency percentiles per port + per domain
+        self.fetches_started = 0
+        self.hedges_started = 0
 
-        self.num_threads = len(self.tor_client_pool.clients.keys())    # one thread per tor client
+        self.metrics = metrics or Metrics.REGISTRY
+        self.fetch_seconds = self.metrics.histogram('torgetter_fetch_seconds', 'Fetch latency per tor client', ('port',))
+        self.domain_seconds = self.metrics.histogram('torgetter_domain_fetch_seconds', 'Fetch latency per domain', 
+                                                     ('domain',))
+        self.fetches = self.metrics.counter('torgetter_fetches_total', 'Fetches per tor client, by outcome', 
+                                            ('port', 'outcome'))
+        self.received = self.metrics.counter('torgetter_received_bytes_total', 
+                                             'Size of fetched bodies per tor client, decompressed', ('port',))
+        self.wire_received = self.metrics.counter('torgetter_wire_bytes_total', 
+                                                  'Body bytes that came over tor per tor client, before decompression '
+                                                  '(RequestsTorGetter)', ('port',))
+        self.replacements = self.metrics.counter('torgetter_client_replacements_total', 
+                                                 'Tor clients the getter had replaced, by reason', ('reason',))
+        self.queued = self.metrics.gauge('torgetter_scheduler_queued', 'Urls buffered in the scheduler')
+        self.in_flight = self.metrics.gauge('torgetter_fetches_in_flight', 'Fetches in flight')
+        self.timeouts = self.metrics.histogram('torgetter_timeout_seconds', 'Timeouts given to fetches')
+        self.hedges = self.metrics.counter('torgetter_hedges_total', 
+                                           'Duplicated slow fetches: started, won (the duplicate came back first) or lost',
+                                           ('outcome',))
 
         self.generateSessions()
 
 
+    def checkHeaders(self, headers):
+        """Raise a FetchAborted if a response with these headers shouldn't have its body read"""
+        content_type = headers.get('Content-Type')
+        if self.content_types is not None and content_type:
+            mime_type = content_type.split(';')[0].strip().lower()
+            if not any(mime_type == allowed or (allowed.endswith('/*') and mime_type.startswith(allowed[:-1]))
+                       for allowed in self.content_types):
+                raise ContentTypeRejected(f"Content-Type {mime_type} isn't allowed")
+        content_length = headers.get('Content-Length')
+        if self.max_body_size and content_length and content_length.isdigit() and int(content_length) > self.max_body_size:
+            raise BodyTooLarge(f"Content-Length {content_length} is over {self.max_body_size} bytes")
+
+    def bodyBuffer(self, cancel = None):
+        return BodyBuffer(self.max_body_size, self.min_throughput, cancel = cancel)
+
+    def fetchTimeout(self, socks_port, domain):
+        """Seconds to give a fetch of domain over socks_port"""
+        if not self.adaptive_timeout:
+            return self.timeout
+        timeout = self.latencies.timeout(socks_port, domain, self.timeout)
+        self.timeouts.observe(timeout)
+        return timeout
+
+    def newFlight(self, url, domain, socks_port, hedge = False):
+        """Bookkeeping for a fetch the engine is starting. Set 'cancel' to a callable that stops the fetch"""
+        now = monotonic()
+        self.fetches_started += 1
+        hedge_after = None
+        if self.hedge_percentile is not None and not hedge:
+            hedge_after = self.latencies.estimate(socks_port, domain, self.hedge_percentile)
+        return {'url': url,
+                'domain': domain,
+                'port': socks_port,
+                'start': now,
+                'cancel': None,
+                'hedge': hedge,             # is this the duplicate?
+                'twin': None,               # future of the other copy, while both are in flight
+                'lost': False,              # the other copy came back first
+                'hedge_at': now + hedge_after if hedge_after is not None else None}
+
+    def hedgeWait(self, flights, now = None):
+        """Seconds until the next fetch in flights ({future: flight}) is due a duplicate, None if none will be"""
+        if self.hedge_percentile is None or self.hedges_started >= self.hedge_budget * self.fetches_started:
+            return None
+        due = [f['hedge_at'] for f in flights.values() if f['hedge_at'] is not None and f['twin'] is None]
+        if not due:
+            return None
+        now = monotonic() if now is None else now
+        return max(min(due) - now, 0)
+
+    def startHedges(self, flights, scheduler, free, start):
+        """Duplicate the fetches in flights that are due one on a different port in free (which is updated),
+           within the hedge budget. start(url, domain, socks_port) starts a fetch and returns its future"""
+        now = monotonic()
+        for future, flight in list(flights.items()):
+            if not free or self.hedges_started >= self.hedge_budget * self.fetches_started:
+                return
+            if flight['hedge_at'] is None or flight['hedge_at'] > now or flight['twin'] is not None:
+                continue
+            socks_port = scheduler.claim([p for p in free if p != flight['port']], flight['domain'], now)
+            if socks_port is None:
+                flight['hedge_at'] = now + HEDGE_RETRY_INTERVAL
+                continue
+            flight['hedge_at'] = None
+            self.hedges_started += 1
+            self.hedges.inc(outcome = 'started')
+            twin = start(flight['url'], flight['domain'], socks_port, hedge = True)
+            flight['twin'] = twin
+            flights[twin]['twin'] = future
+            logger.debug("Duplicating slow fetch of %s from port %s on port %s", flight['url'], flight['port'], socks_port)
+
+    def settleFlight(self, flights, flight, result):
+        """Deal with the other copy of a hedged fetch that just finished, returns True if result should be
+           passed on: the first copy to succeed is, the other one is cancelled"""
+        if flight['lost']:
+            return False
+        twin = flights.get(flight['twin'])
+        if twin is None:
+            return True
+        if not result.ok:
+            twin['twin'] = None     # the other copy may still get through
+            return False
+        twin['lost'] = True
+        twin['cancel']()
+        self.hedges.inc(outcome = 'won' if flight['hedge'] else 'lost')
+        return True
+
     def domainFromURL(self, url):
-        tld = tldextract.extract(url)
-        domain = tld.domain + "." + tld.suffix
-        return domain
+        return domainFromURL(url)
 
     @abstractmethod
-    def fetch(self, url, socks_port): pass
+    def fetch(self, url, socks_port, timeout = None, cancel = None): pass   # timeout: default self.timeout, cancel: threading.Event
 
     @abstractmethod
     def newSession(self, socks_port): pass
@@ -96,20 +341,293 @@ class TorGetter(ABC):
     def killSession(self, port): pass
 
     def generateSessions(self):
+        # {key: session} per endpoint of the pool: the socks port, or 'socks_port:index' for a virtual client
         self.sessions = {}
-        for socks_port in self.tor_client_pool.clients.keys():
-            self.newSession(socks_port)
+        self.syncSessions()
+
+    def syncSessions(self):
+        """Start sessions for any tor clients that finished bootstrapping since we last looked"""
+        for socks_port in list(self.tor_client_pool.endpoints.keys()):
+            if socks_port not in self.sessions:
+                self.newSession(socks_port)
+        self.num_threads = len(self.sessions) * self.fetches_per_client    # one thread per fetch slot
 
     def replaceSession(self, socks_port):
         self.killSession(socks_port)
-        self.sessions[socks_port] = self.newSession(socks_port)
+        self.newSession(socks_port)
 
     def killAllSessions(self):
         for socks_port in self.sessions.keys():
             self.killSession(socks_port)
+
+    def popURLs(self, limit = None):
+        """Lazily pops up to limit urls off self.urls. fetchStream() buffers up to lookahead of them in its
+           scheduler, and puts the ones it never dispatched back in the list if it's stopped early"""
+        popped = 0
+        while self.urls and (limit is None or popped < limit):
+            popped += 1
+            yield self.urls.pop()
+
+    def newScheduler(self, streams_per_domain = 1):
+        """DomainScheduler enforcing this getter's rate limits"""
+        return DomainScheduler(client_delay = self.delay, 
+                               domain_delay = self.domain_delay,
+                               streams_per_domain = streams_per_domain)
+
+    def cachedResult(self, url):
+        """Result for url served without fetching it (e.g. from a cache), or None if it has to be fetched"""
+        return None
+
+    def fillScheduler(self, scheduler, urls, hits = None):
+        """Buffer urls from the iterator urls into scheduler, up to self.lookahead of them. Items can be
+           urls or (url, domain) pairs, e.g. from a Frontier. With the list hits, urls that have a
+           cachedResult() go there instead (up to lookahead of them), so they don't wait out any rate
+           limit. Returns True once urls is exhausted"""
+        while len(scheduler) < self.lookahead and (hits is None or len(hits) < self.lookahead):
+            item = next(urls, None)
+            if item is None:
+                return True
+            url, domain = item if isinstance(item, tuple) else (item, None)
+            result = self.cachedResult(url) if hits is not None else None
+            if result:
+                hits.append(result)
+            else:
+                scheduler.push(url, domain or self.domainFromURL(url))
+        return False
+
+    def waitIdle(self, scheduler):
+        """Nothing is in flight but urls are queued: wait until one may be sent. Returns False if none ever
+           can, because there's no tor client left to send them over, or still bootstrapping"""
+        if self.sessions:
+            delay = scheduler.delay()   # everything left is rate limited
+            sleep(delay if delay is not None else IDLE_POLL_INTERVAL)
+            return True
+        if self.tor_client_pool.endpoints:
+            sleep(IDLE_POLL_INTERVAL)   # sessions for them are started on the next pass
+            return True
+        spawning = [f for f in self.tor_client_pool.spawning if not f.done()]
+        if not spawning:
+            logger.error("No tor clients left, giving up on %d queued urls", len(scheduler))
+            return False
+        wait(spawning, timeout = IDLE_POLL_INTERVAL, return_when = FIRST_COMPLETED)
+        return True
+
+    def fetchStream(self, urls = None, limit = None):
+        """Fetch every url in the iterable urls (default: self.urls, or a Frontier), or the first limit of
+           them, yielding result dicts as they complete. Urls taken from self.urls that were never sent
+           go back in it if the stream is abandoned.
+
+           Each tor client has at most fetches_per_client fetches in flight (just one, except for getters
+           that can multiplex a session, like SeleniumTorGetter's tabs): a port only gets its next url once
+           one of its fetches has returned, so urls are pulled from the iterable as clients free up (it can
+           be unbounded) and memory stays constant however long the job is. Which url a free client gets
+           is up to a DomainScheduler, which holds back domains that client (or any client) has hit too
+           recently. A client that needs replacing stops getting new urls until its fetches have drained.
+
+           Each fetch gets a timeout from fetchTimeout(). With hedge_percentile set, a fetch still running
+           after that percentile of the latencies of fetches like it is duplicated on another free client
+           (up to hedge_budget of all fetches); whichever copy succeeds first is yielded, the other is cancelled"""
+        requeue = urls is None
+        urls = iter(self.popURLs(limit)) if urls is None else islice(urls, limit)
+        self.syncSessions()
+        scheduler = self.newScheduler()
+        hits = deque()  # cachedResult()s, yielded without being scheduled
+
+        max_workers = max(len(self.tor_client_pool.spawning) * self.tor_client_pool.virtual_clients 
+                          * self.fetches_per_client, self.num_threads)
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            in_flight = {}                  # {future: flight, see newFlight()}
+            busy = defaultdict(int)         # {socks_port: number of fetches in flight}
+            draining = {}                   # {socks_port: exit fingerprint to exclude, or None} for clients waiting to be replaced
+            exhausted = False
+
+            def start(url, domain, socks_port, hedge = False):
+                busy[socks_port] += 1
+                if busy[socks_port] >= self.fetches_per_client:
+                    free.remove(socks_port)
+                flight = self.newFlight(url, domain, socks_port, hedge)
+                cancel = Event()
+                flight['cancel'] = cancel.set
+                future = executor.submit(self.fetch, url, socks_port, self.fetchTimeout(socks_port, domain), cancel)
+                in_flight[future] = flight
+                return future
+
+            try:
+                while True:
+                    if len(self.sessions) < len(self.tor_client_pool.endpoints):
+                        # clients that were still bootstrapping when we started have joined the pool
+                        self.syncSessions()
+
+                    if not exhausted:
+                        exhausted = self.fillScheduler(scheduler, urls, hits)
+                    while hits:
+                        yield hits.popleft()
+
+                    # ports with a free slot, least busy first, then fastest clients get first pick of the ready urls
+                    free = sorted((p for p in self.sessions.keys() 
+                                   if p not in draining and busy[p] < self.fetches_per_client),
+                                  key = lambda p: (busy[p], -self.health.score(p)))
+                    while free:
+                        job = scheduler.next(free)
+                        if not job:
+                            break
+                        start(*job)
+                    # clients left idle take on duplicates of the slowest fetches
+                    self.startHedges(in_flight, scheduler, free, start)
+                    self.queued.set(len(scheduler))
+                    self.in_flight.set(len(in_flight))
+
+                    if not in_flight:
+                        if not len(scheduler):
+                            if exhausted:
+                                break
+                            continue    # fillScheduler() stopped at a run of cache hits
+                        if not self.waitIdle(scheduler):
+                            break
+                        continue
+
+                    waits = [w for w in (scheduler.delay(), self.hedgeWait(in_flight)) if w is not None] if free else []
+                    done, _ = wait(in_flight, timeout = min(waits) if waits else None, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        flight = in_flight.pop(future)
+                        socks_port, domain = flight['port'], flight['domain']
+                        busy[socks_port] -= 1
+                        scheduler.release(socks_port, domain)
+                        result = future.result()
+                        self.recordFetch(result, domain)
+                        reason = None if flight['lost'] else self.checkClient(socks_port, result)
+                        if reason and socks_port not in draining:
+                            # a client that's only slow gets new circuits, but its exit isn't excluded
+                            draining[socks_port] = result.exit_fingerprint if reason == 'failures' else None
+                        deliver = self.settleFlight(in_flight, flight, result)
+                        # once nothing is in flight on the port, its client can be replaced without disrupting other fetches
+                        if socks_port in draining and not busy[socks_port]:
+                            self.replaceClient(socks_port, draining.pop(socks_port))
+                        if deliver:
+                            yield result
+            finally:
+                # urls buffered in the scheduler but never sent stay in self.urls, e.g. if the consumer stops early
+                if requeue:
+                    self.urls.extend(scheduler.drain())
+
+    def recordFetch(self, result, domain):
+        """Update the fetch metrics with a result"""
+        seconds = result.seconds
+        self.fetch_seconds.observe(seconds, port = result.port)
+        self.domain_seconds.observe(seconds, domain = domain)
+        if isinstance(result.error, FetchCancelled):
+            outcome = 'cancelled'
+        elif isinstance(result.error, FetchAborted) and not result.error.client_fault:
+            outcome = 'rejected'
+        else:
+            outcome = 'ok' if result.ok else 'error'
+        self.fetches.inc(port = result.port, outcome = outcome)
+        if outcome == 'ok':
+            self.received.inc(result.size, port = result.port)
+            if result.wire_size is not None:
+                self.wire_received.inc(result.wire_size, port = result.port)
+            self.latencies.record(result.port, domain, seconds)
+        elif isTimeout(result.error):
+            # it would have taken at least this long: without it, a domain slower than the timeout it's
+            # given never gets a longer one
+            self.latencies.recordTimeout(result.port, domain, seconds)
+
+    def checkClient(self, socks_port, result):
+        """Update failure count + health stats for socks_port with a fetch result. Returns why its client
+           should be replaced, 'failures' or 'slow', or None if it shouldn't"""
+        failed = not result.ok
+        if isinstance(result.error, FetchAborted) and not result.error.client_fault:
+            failed = False      # the response was unwanted, not the client's fault
+        if failed:
+            self.failed_fetch_count[socks_port] += 1
+        self.health.record(socks_port, result.seconds, result.size, not failed)
+
+        if self.failed_fetch_count[socks_port] >= MAX_FAILED_FETCHES:
+            logger.warning("Too many failed downloads for client @ port %s.", socks_port, extra = {'port': socks_port})
+            self.replacements.inc(reason = 'failures')
+            return 'failures'
+        if self.health.isSlow(socks_port):
+            logger.warning("Client @ port %s is persistently slower than the rest of the pool.", socks_port,
+                           extra = {'port': socks_port})
+            self.replacements.inc(reason = 'slow')
+            return 'slow'
+        return None
+
+    def replaceClient(self, socks_port, exit_fingerprint = None):
+        """Exclude the exit the client @ socks_port was using (if given) + start a new session on it, over
+           new circuits, or on the pool's spare client that was swapped in for it. Returns the socks port to
+           use from now on. Only call while socks_port has no fetches in flight"""
+        if exit_fingerprint:
+            self.tor_client_pool.excludeExit(exit_fingerprint)
+
+        if self.tor_client_pool.endpoints[socks_port].username:
+            # virtual client: new SOCKS credentials get it fresh circuits, its tor process stays up
+            logger.info("Renewing circuits of virtual client %s and starting new HTTP session", socks_port)
+            self.killSession(socks_port)
+            self.tor_client_pool.renewEndpoint(socks_port)
+            self.newSession(socks_port)
+            new_port = socks_port
+        elif self.tor_client_pool.spares:
+            self.killSession(socks_port)
+            del self.sessions[socks_port]
+            new_port = self.tor_client_pool.restartClient(socks_port)
+            logger.info("Starting new HTTP session on spare client @ port %s", new_port)
+            self.newSession(new_port)
+        else:
+            logger.info("Requesting new Tor circuit for client @ port %s and starting new HTTP session", socks_port)
+            if not exit_fingerprint:
+                # nothing excluded, so nothing makes the client leave its current circuits on its own
+                self.tor_client_pool.renewCircuits(socks_port)
+            self.replaceSession(socks_port)
+            new_port = socks_port
+
+        self.failed_fetch_count[socks_port] = 0   # reset counter
+        self.health.reset(socks_port)
+        self.latencies.reset(socks_port)
+        return new_port
             
+    def fetchFrontier(self, frontier):
+        """Fetch the pending urls of a Frontier, yielding results as they complete + recording each
+           url as done or failed in the frontier, so an interrupted job can be resumed. Failed urls go
+           back to pending and are fetched again in another pass over the frontier, until they've used up
+           its max_attempts. Responses the getter rejected itself (e.g. a disallowed Content-Type) would
+           only be rejected again, so those urls are failed right away"""
+        while True:
+            for result in self.fetchStream(frontier):
+                if result.ok:
+                    frontier.markDone(result.url)
+                else:
+                    retry = not (isinstance(result.error, FetchAborted) and not result.error.client_fault)
+                    frontier.markFailed(result.url, result.error, retry = retry)
+                yield result
+            # the frontier stops yielding once it's out of pending urls, while the last of them are still in flight
+            if not frontier.pending():
+                return
+
+    def fetchProcessed(self, stages, urls = None, **pipeline_kwargs):
+        """Fetch every url in urls (default: self.urls) like fetchStream(), running each page through
+           the processing stages in worker processes as it arrives, see Pipeline. Yields results with the
+           stages' output in result['processed'] as their processing completes"""
+        pipeline = Pipeline(stages, metrics = self.metrics, **pipeline_kwargs)
+        yield from pipeline.process(self.fetchStream(urls))
+
+    def fetchInto(self, sink, urls = None, stages = None):
+        """Fetch every url in urls (default: self.urls), writing each result to the ResultSink sink as it
+           arrives rather than collecting them, so memory is bounded by the fetches in flight. With stages,
+           results are processed first, see fetchProcessed(). Returns (number of results, number of errors)"""
+        num_results = 0
+        num_errors = 0
+        results = self.fetchStream(urls) if stages is None else self.fetchProcessed(stages, urls)
+        for result in results:
+            sink.write(result)
+            if result.ok:
+                num_results += 1
+            else:
+                num_errors += 1
+        return (num_results, num_errors)
+
     def fetchConcurrent(self, num_to_fetch):
-        """fetches num_to_fetch urls from self.urls, """
+        """fetches num_to_fetch urls from self.urls, returns (results, errors) lists"""
         if num_to_fetch < 0:
             raise ValueError
         if num_to_fetch == 0 or len(self.urls) == 0:
@@ -118,206 +636,338 @@ class TorGetter(ABC):
         results = []
         errors = []
         
-        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-
-            # This just endlessly rotates through our SOCKS ports, so that below
-            # the calls to fetch() are mapped to each socks port about the same # of times
-            def _portGenerator():
-                ports = deque(self.sessions.keys())
-                while True:
-                    p = ports.pop()
-                    yield p
-                    ports.appendleft(p)
-            ports = _portGenerator()   
-            
-            futures = []
-            
-            for i in range(min(num_to_fetch, len(self.urls))):
-                url = self.urls.pop()
-                socks_port = next(ports)
-                futures.append(executor.submit(self.fetch, url, socks_port))
-
-            for future in as_completed(futures):
-                result = future.result()
-                socks_port = result['port']
-                #TODO: when we get a result from result['port'], submit
-                #      the next fetch() for this port to executor ... this means
-                #      that only one fetch() per client is in ThreadPoolExecutor
-                #      at any given time., and in case of fatal error requiring
-                #      restart of client/session, we can do that here with 
-                #      guarantee that no other fetches are in progress on this
-                #      port at the same time ... 
-                if result['error'] or not result['html']:
-                    errors.append(result)
-                    self.failed_fetch_count[socks_port] += 1
-
-                else:
-                    print(f"GOT: {result['url'].strip()} in {result['time']}"
-                          f"seconds, using proxy on port {result['port']}")
-                    results.append(result)
-                    
-
-                # XXXX: how do we cancel the rest of the futures with this session? 
-                #    ... then get new tor circuit + session and resubmit?
-                if self.failed_fetch_count[socks_port] >= MAX_FAILED_FETCHES:
-                    print(f"Too many failed downloads for client @"
-                          f"port {socks_port}. Requesting new Tor circuit ...")
-                    if result['exit_fingerprint']:
-                        self.tor_client_pool.excludeExit(result['exit_fingerprint'])
-                    
-                    print("... and starting new HTTP session")
-                    self.killSession(socks_port)
-                    self.newSession(socks_port)
-                    self.failed_fetch_count[socks_port] = 0   # reset counter
-                    sleep(self.delay)
-
-                #TODO: this is where we will submit the new task for the port we just got result from
+        for result in self.fetchStream(limit = num_to_fetch):
+            if result.ok:
+                logger.debug("GOT: %s in %.2f seconds, using proxy on port %s", 
+                             result.url.strip(), result.seconds, result.port)
+                results.append(result)
+            else:
+                errors.append(result)
     
         return (results, errors)
 
     
 class RequestsTorGetter(TorGetter):
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, cache = None, **kwargs):     # cache: optional ResponseCache
+        self.cache = cache
         super().__init__(*args, **kwargs)
         
     
     def newSession(self, socks_port):
-        proxy_address = 'socks5://127.0.0.1:' + socks_port
+        # socks5h: let tor resolve hostnames, so STREAM events carry the host we asked for
+        proxy_address = self.tor_client_pool.endpoints[socks_port].proxyURL('socks5h')
 
         s = requests.Session()
-        s.headers.update({'User-Agent': DEFAULT_UA})
+        s.headers.update({'User-Agent': DEFAULT_UA, 'Accept-Encoding': ACCEPT_ENCODING})
         s.proxies = {'http': proxy_address, 'https': proxy_address}
         self.sessions[socks_port] =  s
                               
     def killSession(self, port):
         self.sessions[port].close()
             
-    def fetch(self, url, port):
+    def cacheLookup(self, url):
+        """url's cache entry, None if there's none (or no cache, or it can't be read)"""
+        if not self.cache:
+            return None
+        try:
+            return self.cache.lookup(url)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Cache lookup of %s failed: %s", url, e, extra = {'url': url})
+            return None
+
+    def cachedBody(self, entry, response = None):
+        """Body of a cache entry (revalidated by response, its 304, if given), None if it can't be read,
+           e.g. because it was evicted since it was looked up"""
+        try:
+            if response is not None:
+                self.cache.refresh(entry, response)
+            return self.cache.body(entry)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Reading the cached body of %s failed: %s", entry['key'], e, extra = {'url': entry['key']})
+            return None
+
+    def cachedResult(self, url):
+        """Result for a fresh cache hit, served before url is scheduled: no rate limit, no tor client"""
+        cached = self.cacheLookup(url)
+        if not cached or not cached['fresh']:
+            return None
+        body = self.cachedBody(cached)
+        if body is None:
+            return None
+        return FetchResult(url = url,
+                           body = body,
+                           encoding = cached['encoding'],
+                           port = None,
+                           exit_fingerprint = None,
+                           error = None)
+
+    def fetch(self, url, port, timeout = None, cancel = None):
+        """Fetch url over the network, revalidating its cache entry if it has one. Fresh cache hits are
+           served by fetchStream() before they're scheduled, see cachedResult()"""
         session = self.sessions[port]
-        domain = self.domainFromURL(url)
+        endpoint = self.tor_client_pool.endpoints[port]
+        source = None   # our end of the connection to the SOCKS port, which tor reports in STREAM events
 
-        tor_controller = self.tor_client_pool.clients[port].controller
-        exit_fingerprint = None
-        
-        # Callback passed to controller.add_event_listener(), which
-        # extracts the exit fingerprint used for the get() request
-        def _stream_event(controller, event):
-            nonlocal exit_fingerprint
-            if event.status == StreamStatus.SUCCEEDED and event.circ_id:
-                circ = controller.get_circuit(event.circ_id)
-                exit_fingerprint = circ.path[-1][0]
+        try:
+            start_time = monotonic()
+            cached = self.cacheLookup(url)
+            while True:
+                headers = self.cache.conditionalHeaders(cached) if cached else None
+                # streamed, so we can stop reading (+ drop the connection) as soon as the body turns out unwanted
+                with session.get(url, timeout = timeout or self.timeout, headers = headers, stream = True) as r:
+                    connection = r.raw.connection
+                    if connection and connection.sock:
+                        source = '%s:%s' % connection.sock.getsockname()[:2]
+                    if cached and r.status_code == 304:
+                        body = self.cachedBody(cached, r)
+                        if body is None:
+                            cached = None   # gone since the lookup: ask again, unconditionally
+                            continue
+                        encoding = cached['encoding']
+                    else:
+                        self.checkHeaders(r.headers)
+                        buffer = self.bodyBuffer(cancel)
+                        # read1() returns whatever has arrived (decompressed) instead of blocking for a full chunk
+                        for chunk in iter(lambda: r.raw.read1(CHUNK_SIZE, decode_content = True), b''):
+                            buffer.add(chunk)
+                        body = buffer.getvalue()
+                        encoding = r.encoding
+                        if self.cache:
+                            try:
+                                self.cache.store(url, r, body)
+                            except (OSError, sqlite3.Error) as e:
+                                logger.warning("Caching %s failed: %s", url, e, extra = {'url': url})
+                    wire_size = r.raw.tell()    # compressed bytes actually read off the connection
+                break
+                
+            return FetchResult(url = url, 
+                               body = body, 
+                               encoding = encoding,
+                               started = start_time, 
+                               wire_size = wire_size,
+                               port = port,
+                               exit_fingerprint = endpoint.exitForSource(source) or endpoint.exitForTarget(urlparse(r.url).hostname),
+                               error = None)
 
-        stream_listener = functools.partial(_stream_event, tor_controller)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, FetchAborted) as e:
+            logger.info("Request of URL %s failed over port %s with connection error: %s", url, port, e,
+                        extra = {'url': url, 'port': port})
+                
+            # only an exit that this fetch's own stream went through: the most recent stream to the same
+            # host may have been another, successful fetch's, and whatever's returned here can get excluded
+            return FetchResult(url = url, 
+                               body = None, 
+                               started = start_time, 
+                               port = port,
+                               exit_fingerprint = endpoint.exitForSource(source),
+                               error = e)
 
-        with self.locks[port][domain]:      
+    def setTimeout(self, t):
+        self.timeout = t
+
+
+
+def processTreeRSS(pid):
+    """Resident memory of process pid + all its descendants, in bytes (summed, so pages shared between
+       them count more than once). None where there's no /proc to read it from"""
+    try:
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        children = defaultdict(list)
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
             try:
-                start_time = datetime.now()
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue    # exited while we were looking
+            children[ppid].append(int(entry))
+    except (OSError, AttributeError, ValueError):
+        return None
 
-                tor_controller.add_event_listener(stream_listener, EventType.STREAM)
-                r = session.get(url, timeout = self.timeout)
-                
-                sleep(self.delay)
+    total = 0
+    stack = [pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            pass
+        stack.extend(children[pid])
+    return total
 
-                return {'url': url, 
-                        'html': r.text, 
-                        'time': datetime.now() - start_time, 
-                        'port': port,
-                        'exit_fingerprint': exit_fingerprint,
-                        'error': None}
 
-            except requests.exceptions.RequestException as e:
-                print("Request of URL " + url + " failed with exception: " + str(e))
+class BrowserSession():
+    """One headless browser + its tabs. Tabs load pages concurrently: a fetch only holds the browser's
+       lock to start a navigation or check on it, never while waiting for the page. The browser is
+       restarted once its tabs are idle after it has loaded recycle_after pages or grown past max_rss"""
 
-                sleep(self.delay)
+    def __init__(self, new_driver, num_tabs, recycle_after, max_rss):
+        self.new_driver = new_driver    # callable returning a new webdriver, with its tabs set up
+        self.num_tabs = num_tabs
+        self.recycle_after = recycle_after
+        self.max_rss = max_rss
 
-                print(f"Request of URL {url} failed over port {port} with "
-                      f"connection error: {str(e)}")
-                self.failed_fetch_count[port] += 1
-                
-                return {'url': url, 
-                        'html': None, 
-                        'time': datetime.now() - start_time, 
-                        'port': port,
-                        'exit_fingerprint': exit_fingerprint,
-                        'error': e} 
+        self.condition = Condition()
+        self.retiring = False           # no new fetches until the browser has been recycled
+        self.recycles = 0
+        self.start()
 
-            finally:
-                tor_controller.remove_event_listener(stream_listener)
+    def start(self):
+        self.driver, tabs = self.new_driver()
+        self.free_tabs = list(tabs)
+        self.pages = 0
 
-    def setTimeout(self, t):
-        self.timeout = t
+    def quit(self):
+        if self.driver.service.process:
+            self.driver.quit()
+
+    def rss(self):
+        process = self.driver.service.process
+        return processTreeRSS(process.pid) if process else None
 
+    def acquireTab(self):
+        with self.condition:
+            while self.retiring or not self.free_tabs:
+                self.condition.wait()
+            return self.free_tabs.pop()
+
+    def releaseTab(self, tab):
+        """Return tab after a page load, recycling the browser if it's due and this was the last busy tab"""
+        with self.condition:
+            self.free_tabs.append(tab)
+            self.pages += 1
+            if not self.retiring:
+                if self.recycle_after and self.pages >= self.recycle_after:
+                    self.retiring = True
+                elif self.max_rss and self.pages % RSS_CHECK_EVERY == 0:
+                    self.retiring = (self.rss() or 0) > self.max_rss
+
+            if self.retiring and len(self.free_tabs) == self.num_tabs:
+                logger.info("Recycling browser after %d pages", self.pages)
+                try:
+                    self.quit()
+                    self.start()
+                    self.recycles += 1
+                except (OSError, selenium_exceptions.WebDriverException) as e:
+                    # fetches on the dead browser will fail, until the client + its session get replaced
+                    logger.error("Couldn't restart browser: %s", e)
+                self.retiring = False
+                self.condition.notify_all()
+            elif not self.retiring:
+                self.condition.notify()
 
 
 class SeleniumTorGetter(TorGetter):
     """Spawn a horde of headless browsers for sites that 
-       require rendering JavaScript... buy lots of RAM :)"""
+       require rendering JavaScript... buy lots of RAM :)
+
+       Each browser loads tabs_per_browser pages at once, blocks stylesheets/fonts/media/images
+       (block_resources, plus any url patterns in block_patterns, e.g. '*googletagmanager.com*')
+       and gets restarted every so often to give back the memory it accumulates"""
        
-    def __init__(self, *args, **kwargs):
+    def __init__(self, 
+                 *args, 
+                 tabs_per_browser = TABS_PER_BROWSER,
+                 block_resources = BLOCKED_RESOURCE_TYPES,  # keys of RESOURCE_EXTENSIONS
+                 block_patterns = (),                       # extra url patterns to block, '*' is a wildcard
+                 page_load_strategy = PAGE_LOAD_STRATEGY,   # 'none', 'eager' or 'normal'
+                 recycle_after = RECYCLE_AFTER_PAGES,       # pages per browser before restarting it, None for never
+                 max_rss = BROWSER_MAX_RSS,                 # bytes of RAM per browser before restarting it, None for no limit
+                 **kwargs):
+        if page_load_strategy not in READY_STATES:
+            raise ValueError(f"Unknown page load strategy: {page_load_strategy}")
+
+        self.fetches_per_client = tabs_per_browser
+        self.block_resources = block_resources
+        self.page_load_strategy = page_load_strategy
+        self.recycle_after = recycle_after
+        self.max_rss = max_rss
+        self.blocked_urls = [pattern for resource in block_resources 
+                             for ext in RESOURCE_EXTENSIONS[resource] 
+                             for pattern in (f'*.{ext}', f'*.{ext}?*')] + list(block_patterns)
         super().__init__(*args, **kwargs)
         
-    def fetch(self, url, port):        
+    def fetch(self, url, port, timeout = None, cancel = None):        
         
         session = self.sessions[port]
-        domain = self.domainFromURL(url)
-
-        tor_controller = self.tor_client_pool.clients[port].controller
-        exit_fingerprint = None
-        
-        # Callback passed to controller.add_event_listener(), which
-        # extracts the exit fingerprint used for the get() request
-        def _stream_event(controller, event):
-            nonlocal exit_fingerprint
-            if event.status == StreamStatus.SUCCEEDED and event.circ_id:
-                circ = controller.get_circuit(event.circ_id)
-                exit_fingerprint = circ.path[-1][0]
-                #print(f"DEBUG: port {port} --> StreamStatus: {str(event.status)} /// Exit Fingerprint: {exit_fingerprint}")
-
-        stream_listener = functools.partial(_stream_event, tor_controller)
+        endpoint = self.tor_client_pool.endpoints[port]
+        tab = session.acquireTab()
         
-        
-        # ensure that only one request is happening per domain over this port
-        with self.locks[port][domain]:
-            try:
-                start_time = datetime.now()
+        try:
+            start_time = monotonic()
+            deadline = monotonic() + (timeout or self.timeout)
 
-                tor_controller.add_event_listener(stream_listener, EventType.STREAM)
-                session.get(url)
-                
-                sleep(self.delay)           
+            with session.condition:
+                driver = session.driver
+                driver.switch_to.window(tab)
+                # the flag goes away with the old document, so we can tell when the new one has replaced it
+                driver.execute_script('window.__torgetterStale = true; window.location.href = arguments[0];', url)
+
+            while True:
+                sleep(TAB_POLL_INTERVAL)
+                with session.condition:
+                    driver.switch_to.window(tab)
+                    state = driver.execute_script('return window.__torgetterStale ? null : document.readyState;')
+                    if state in READY_STATES[self.page_load_strategy]:
+                        current_url = driver.current_url
+                        if current_url.startswith('chrome-error://'):
+                            raise selenium_exceptions.WebDriverException(f"Browser couldn't load {url}")
+                        html = driver.page_source
+                        break
+                    if monotonic() > deadline:
+                        driver.execute_script('window.stop();')
+                        raise selenium_exceptions.TimeoutException(f"Timed out loading {url}")
+                    if cancel and cancel.is_set():
+                        driver.execute_script('window.stop();')
+                        raise FetchCancelled("A duplicate of the fetch finished first")
                 
-                #TODO: replace with FetchResult() attrs class
-                return {'url': url, 
-                        'html': session.page_source, 
-                        'time': datetime.now() - start_time, 
-                        'port': port,
-                        'exit_fingerprint': exit_fingerprint,
-                        'error': None}
-
-            except (ConnectionError, 
-                    ConnectionRefusedError, 
-                    URLError,
-                    selenium_exceptions.WebDriverException) as e:
-
-                print(f"Request of URL {url} failed over port {port}"
-                      f"with connection error: {str(e)}")
-                self.failed_fetch_count[port] += 1
+            return FetchResult(url = url, 
+                               body = None,
+                               html = html, 
+                               started = start_time, 
+                               port = port,
+                               exit_fingerprint = endpoint.exitForTarget(urlparse(current_url).hostname),
+                               error = None)
+
+        except (ConnectionError, 
+                ConnectionRefusedError, 
+                URLError,
+                selenium_exceptions.WebDriverException,
+                FetchCancelled) as e:
+
+            logger.info("Request of URL %s failed over port %s with connection error: %s", url, port, e,
+                        extra = {'url': url, 'port': port})
                 
-                return {'url': url, 
-                        'html': None, 
-                        'time': datetime.now() - start_time, 
-                        'port': port,
-                        'exit_fingerprint': exit_fingerprint,
-                        'error': e} 
-            finally:
-                tor_controller.remove_event_listener(stream_listener)
+            # the browser's streams can't be told apart, so there's no exit we know this fetch failed on
+            return FetchResult(url = url, 
+                               body = None, 
+                               started = start_time, 
+                               port = port,
+                               exit_fingerprint = None,
+                               error = e)
+
+        finally:
+            session.releaseTab(tab)
 
 
     def newSession(self, socks_port):
-            print(f"Loading headless Chromium browser using proxy port: {socks_port}")
+        self.sessions[socks_port] = BrowserSession(functools.partial(self.newBrowser, socks_port),
+                                                   num_tabs = self.fetches_per_client,
+                                                   recycle_after = self.recycle_after,
+                                                   max_rss = self.max_rss)
+
+    def newBrowser(self, socks_port):
+            """Start a headless Chromium using the tor client @ socks_port, returns (driver, [tab handles])"""
+            logger.info("Loading headless Chromium browser using proxy port: %s", socks_port)
         
-            proxy_address = 'socks5://127.0.0.1:' + socks_port
+            endpoint = self.tor_client_pool.endpoints[socks_port]
+            if endpoint.username:
+                raise ValueError("Chrome can't authenticate to a SOCKS proxy, so SeleniumTorGetter "
+                                 "needs a pool without virtual clients")
+            proxy_address = endpoint.proxyURL('socks5')
 
             #########################################################
             #  config/init headless chrome browser
@@ -327,14 +977,17 @@ class SeleniumTorGetter(TorGetter):
             chrome_options.add_argument('--window-size=1420,1080')
             chrome_options.add_argument('--headless')
             chrome_options.add_argument('--disable-gpu')
+            chrome_options.add_argument('--disable-dev-shm-usage')
             chrome_options.add_argument('--proxy-server=%s' % proxy_address)
+            chrome_options.page_load_strategy = self.page_load_strategy
 
-            if DISABLE_IMAGE_LOADING:
+            if 'image' in self.block_resources:
                 exper_prefs = {}
                 chrome_options.experimental_options["prefs"] = exper_prefs
                 exper_prefs["profile.default_content_settings"] = {"images": 2}
+                exper_prefs["profile.managed_default_content_settings"] = {"images": 2}
 
-            driver = webdriver.Chrome(chrome_options=chrome_options)
+            driver = webdriver.Chrome(options=chrome_options)
             if DISABLE_HTTP_KEEP_ALIVE:
                 driver.command_executor.keep_alive = False
             else:
@@ -342,17 +995,206 @@ class SeleniumTorGetter(TorGetter):
                 
             driver.set_page_load_timeout(self.timeout)
 
-            self.sessions[socks_port] = driver
+            tabs = [driver.current_window_handle]
+            while len(tabs) < self.fetches_per_client:
+                driver.switch_to.new_window('tab')
+                tabs.append(driver.current_window_handle)
+            if self.blocked_urls:
+                # request blocking is set per tab
+                for tab in tabs:
+                    driver.switch_to.window(tab)
+                    driver.execute_cdp_cmd('Network.enable', {})
+                    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': self.blocked_urls})
+
+            return (driver, tabs)
             
     def killSession(self, port):
-        if self.sessions[port].service.process:
-            self.sessions[port].quit()
+        self.sessions[port].quit()
             
 
     def setTimeout(self, t):
         """Set the timeout (in seconds) per request, and update configs of all persistent sessions"""
         self.timeout = t
         for s in self.sessions.values():
-            s.set_page_load_timeout(self.timeout)
+            with s.condition:
+                s.driver.set_page_load_timeout(self.timeout)
+
+
+
+class AsyncTorGetter(TorGetter):
+    """Drives every fetch from a single asyncio event loop, with many concurrent streams per
+       tor client, so a handful of tor processes can keep thousands of requests in flight
+       without a thread each. Requires aiohttp + aiohttp_socks"""
+
+    def __init__(self, 
+                 *args, 
+                 streams_per_client = STREAMS_PER_CLIENT,   # max requests in flight per tor client
+                 streams_per_domain = STREAMS_PER_DOMAIN,   # max requests in flight per domain, per tor client
+                 **kwargs):
+        if aiohttp is None:
+            raise ImportError("AsyncTorGetter requires the aiohttp and aiohttp_socks packages")
+
+        self.streams_per_client = streams_per_client
+        self.streams_per_domain = streams_per_domain
+
+        # aiohttp sessions belong to the event loop they're created on, so all of them
+        # (and all fetches) live on one loop running in a background thread
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target = self.loop.run_forever, daemon = True)
+        self.loop_thread.start()
+
+        super().__init__(*args, **kwargs)
+
+    def runInLoop(self, coroutine):
+        """Schedule coroutine on the getter's event loop, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def newSession(self, socks_port):
+        self.sessions[socks_port] = self.runInLoop(self._newSession(socks_port)).result()
+
+    async def _newSession(self, socks_port):
+        connector = ProxyConnector.from_url(self.tor_client_pool.endpoints[socks_port].proxyURL('socks5'),
+                                            rdns = True,
+                                            limit = self.streams_per_client,
+                                            force_close = DISABLE_HTTP_KEEP_ALIVE)
+        return aiohttp.ClientSession(connector = connector, 
+                                     headers = {'User-Agent': DEFAULT_UA, 'Accept-Encoding': AIOHTTP_ACCEPT_ENCODING},
+                                     timeout = aiohttp.ClientTimeout(total = self.timeout))
+
+    def killSession(self, port):
+        self.runInLoop(self.sessions[port].close()).result()
+
+    def stopLoop(self):
+        """Close all sessions + stop the event loop thread; the getter can't be used after this"""
+        self.killAllSessions()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def fetch(self, url, port, timeout = None, cancel = None):
+        """Blocking fetch, to satisfy the TorGetter contract -- fetchStream() doesn't use this"""
+        return self.runInLoop(self.fetchAsync(url, port, timeout)).result()
+
+    async def fetchAsync(self, url, port, timeout = None):
+        session = self.sessions[port]
+        endpoint = self.tor_client_pool.endpoints[port]
+        source = None   # our end of the connection to the SOCKS port, which tor reports in STREAM events
+
+        start_time = monotonic()
+        try:
+            async with session.get(url, timeout = aiohttp.ClientTimeout(total = timeout or self.timeout)) as r:
+                if r.connection and r.connection.transport:
+                    source = '%s:%s' % r.connection.transport.get_extra_info('sockname')[:2]
+                self.checkHeaders(r.headers)
+                buffer = self.bodyBuffer()
+                async for chunk in r.content.iter_any():
+                    buffer.add(chunk)
+
+            return FetchResult(url = url, 
+                               body = buffer.getvalue(), 
+                               encoding = r.charset,
+                               started = start_time, 
+                               port = port,
+                               exit_fingerprint = endpoint.exitForSource(source) or endpoint.exitForTarget(r.url.host),
+                               error = None)
+
+        except (aiohttp.ClientError, 
+                asyncio.TimeoutError,
+                ProxyError,
+                ProxyConnectionError,
+                ProxyTimeoutError,
+                FetchAborted) as e:
+            logger.info("Request of URL %s failed over port %s with connection error: %s", url, port, e,
+                        extra = {'url': url, 'port': port})
+
+            return FetchResult(url = url, 
+                               body = None, 
+                               started = start_time, 
+                               port = port,
+                               exit_fingerprint = endpoint.exitForSource(source),     # see RequestsTorGetter.fetch()
+                               error = e)
+
+    def fetchStream(self, urls = None, limit = None):
+        """Like TorGetter.fetchStream(), but keeps up to streams_per_client fetches in flight per
+           tor client (streams_per_domain of them to the same domain). A client that needs replacing
+           stops getting new urls until its in-flight fetches have drained"""
+        requeue = urls is None
+        urls = iter(self.popURLs(limit)) if urls is None else islice(urls, limit)
+        self.syncSessions()
+        scheduler = self.newScheduler(self.streams_per_domain)
+
+        completed = queue.Queue()           # futures of finished fetches, put there from the loop thread
+        in_flight = {}                      # {future: flight, see newFlight()}
+        busy = defaultdict(int)             # {socks_port: number of fetches in flight}
+        draining = {}                       # {socks_port: exit fingerprint to exclude, or None} for clients waiting to be replaced
+        exhausted = False
+
+        def start(url, domain, socks_port, hedge = False):
+            busy[socks_port] += 1
+            if busy[socks_port] >= self.streams_per_client:
+                available.remove(socks_port)
+            flight = self.newFlight(url, domain, socks_port, hedge)
+            future = self.runInLoop(self.fetchAsync(url, socks_port, self.fetchTimeout(socks_port, domain)))
+            flight['cancel'] = future.cancel
+            in_flight[future] = flight
+            future.add_done_callback(completed.put)
+            return future
+
+        try:
+            while True:
+                if len(self.sessions) < len(self.tor_client_pool.endpoints):
+                    self.syncSessions()
+                if not exhausted:
+                    exhausted = self.fillScheduler(scheduler, urls)
+
+                # ports with free stream slots, least busy relative to their health score first
+                available = sorted((p for p in self.sessions.keys() 
+                                    if p not in draining and busy[p] < self.streams_per_client),
+                                   key = lambda p: busy[p] / max(self.health.score(p), 0.1))
+                while available:
+                    job = scheduler.next(available)
+                    if not job:
+                        break
+                    start(*job)
+                self.startHedges(in_flight, scheduler, available, start)
+                self.queued.set(len(scheduler))
+                self.in_flight.set(len(in_flight))
+
+                if not in_flight:
+                    if not len(scheduler) or not self.waitIdle(scheduler):
+                        break
+                    continue
+
+                waits = [w for w in (scheduler.delay(), self.hedgeWait(in_flight)) if w is not None] if available else []
+                try:
+                    future = completed.get(timeout = min(waits) if waits else None)
+                except queue.Empty:
+                    continue
+                flight = in_flight.pop(future)
+                socks_port, domain = flight['port'], flight['domain']
+                if future.cancelled():
+                    result = FetchResult(url = flight['url'],
+                                         body = None,
+                                         started = flight['start'],
+                                         port = socks_port,
+                                         exit_fingerprint = None,
+                                         error = FetchCancelled("A duplicate of the fetch finished first"))
+                else:
+                    result = future.result()
+                busy[socks_port] -= 1
+                scheduler.release(socks_port, domain)
+                self.recordFetch(result, domain)
 
+                reason = None if flight['lost'] else self.checkClient(socks_port, result)
+                if reason and socks_port not in draining:
+                    draining[socks_port] = result.exit_fingerprint if reason == 'failures' else None
+                deliver = self.settleFlight(in_flight, flight, result)
+                if socks_port in draining and not busy[socks_port]:
+                    self.replaceClient(socks_port, draining.pop(socks_port))
 
+                if deliver:
+                    yield result
+        finally:
+            # urls buffered in the scheduler but never sent stay in self.urls, e.g. if the consumer stops early
+            if requeue:
+                self.urls.extend(scheduler.drain())
@@ -0,0 +1,367 @@
+import os
+import queue
+import socket
+import logging
+import argparse
+import itertools
+import multiprocessing
+from time import sleep, monotonic
+from threading import Lock, Thread
+from collections import defaultdict, deque
+from multiprocessing.managers import BaseManager
+
+import TorClientPool
+import TorGetter
+from ResultStore import SegmentSink
+
+
+"""
+Coordinator/worker sharding: a Coordinator serves the url queue, collects results and keeps the
+job-wide set of excluded exits; any number of ShardWorkers (each with its own TorClientPool + getter,
+in its own process, on this host or others) pull batches of urls from it over multiprocessing's
+authenticated RPC channel and push their results + newly excluded exits back.
+
+    python TorShard.py coordinator --urls urls.txt --listen 0.0.0.0:50000 --authkey secret --output results/
+    python TorShard.py worker --connect coordinator-host:50000 --authkey secret --clients 20 --start-port 9050
+"""
+
+SHARD_ADDRESS = ('127.0.0.1', 50000)
+BATCH_SIZE = 50                 # urls per getWork() round trip, results per putResults() round trip
+LEASE_TIMEOUT = 600             # seconds before urls handed to a worker that hasn't reported them go to someone else
+MAX_PENDING_RESULTS = 10000     # results queued at the coordinator before workers block on putResults()
+POLL_INTERVAL = 1               # seconds between checks for work/completion when there's nothing to do
+AUTHKEY_ENV = 'TORSHARD_AUTHKEY'
+
+logger = logging.getLogger(__name__)
+
+
+def itemURL(item):
+    """url of a url or (url, domain) pair"""
+    return item if isinstance(item, str) else item[0]
+
+
+def shardResult(result):
+    """FetchResult -> something that pickles safely (exceptions may carry unpicklable requests, etc)"""
+    return result.copy(error = repr(result.error) if result.error else None)
+
+
+class ShardJob():
+    """Coordinator-side state of a job, called by workers through a ShardManager proxy. Every method
+       is safe to call from the manager's per-connection threads"""
+
+    def __init__(self, urls, excluded_exits = (), max_pending_results = MAX_PENDING_RESULTS):
+        self.urls = iter(urls)
+        self.exhausted = False
+        self.lock = Lock()
+        self.retry = deque()                # urls whose lease expired, handed out before new ones
+        self.leased = {}                    # {url: (worker_id, lease time)}
+        self.seen = set()                   # urls handed out so far, leases + results are keyed by url
+        self.duplicates = 0
+        self.results = queue.Queue(maxsize = max_pending_results)
+        self.excluded = set(excluded_exits)
+        self.workers = defaultdict(lambda: {'results': 0, 'errors': 0, 'last_seen': None})
+
+    def getWork(self, worker_id, n = BATCH_SIZE):
+        """Lease up to n urls to worker_id. An empty list means there's nothing to hand out right now:
+           the worker should check finished() before asking again"""
+        now = monotonic()
+        with self.lock:
+            self.workers[worker_id]['last_seen'] = now
+            batch = []
+            while self.retry and len(batch) < n:
+                batch.append(self.retry.popleft())
+            while not self.exhausted and len(batch) < n:
+                new = list(itertools.islice(self.urls, n - len(batch)))
+                self.exhausted = len(new) < n - len(batch)
+                for item in new:
+                    # a second lease of the same url would overwrite the first, so duplicates are skipped
+                    if itemURL(item) in self.seen:
+                        self.duplicates += 1
+                        continue
+                    self.seen.add(itemURL(item))
+                    batch.append(item)
+            for item in batch:
+                self.leased[itemURL(item)] = (worker_id, now)
+            return batch
+
+    def putResults(self, worker_id, results, exclusions = ()):
+        """Hand in results (see shardResult()) + exits the worker excluded since its last call.
+           Blocks while the coordinator is max_pending_results behind. Returns every excluded exit
+           of the job, for the worker to apply to its own pool"""
+        with self.lock:
+            self.excluded.update(exclusions)
+            stats = self.workers[worker_id]
+            stats['last_seen'] = monotonic()
+            # a url whose lease expired + went to another worker is only reported once
+            results = [r for r in results if self.leased.get(r['url'], (None,))[0] == worker_id]
+            excluded = sorted(self.excluded)
+
+        for result in results:
+            self.results.put(result)
+        with self.lock:
+            for result in results:
+                self.leased.pop(result['url'], None)
+                stats['results' if result.ok else 'errors'] += 1
+        return excluded
+
+    def exclusions(self):
+        with self.lock:
+            return sorted(self.excluded)
+
+    def reclaim(self, lease_timeout = LEASE_TIMEOUT):
+        """Put urls leased more than lease_timeout seconds ago back in the queue, returns how many"""
+        cutoff = monotonic() - lease_timeout
+        with self.lock:
+            expired = [url for url, (_, leased_at) in self.leased.items() if leased_at < cutoff]
+            for url in expired:
+                del self.leased[url]
+                self.retry.append(url)
+        if expired:
+            logger.warning("Reclaimed %d urls from workers that didn't report them in %d seconds",
+                           len(expired), lease_timeout)
+        return len(expired)
+
+    def finished(self):
+        """True once every url has been handed out and reported"""
+        with self.lock:
+            return self.exhausted and not self.retry and not self.leased
+
+    def stats(self):
+        with self.lock:
+            return {'leased': len(self.leased),
+                    'retry': len(self.retry),
+                    'duplicates': self.duplicates,
+                    'pending_results': self.results.qsize(),
+                    'excluded_exits': len(self.excluded),
+                    'workers': {worker_id: dict(stats) for worker_id, stats in self.workers.items()}}
+
+
+class ShardManager(BaseManager):
+    """What workers connect with, see ShardWorker"""
+
+ShardManager.register('job')
+
+
+def parseAddress(address):
+    """'host:port' -> ('host', port)"""
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+def defaultAuthkey():
+    authkey = os.environ.get(AUTHKEY_ENV)
+    return authkey.encode() if authkey else None
+
+
+class Coordinator():
+    """Serves a ShardJob over the network (from a background thread of this process) + collects the
+       results workers hand in. Workers authenticate with authkey, which must be shared with them"""
+
+    def __init__(self,
+                 urls,
+                 address = SHARD_ADDRESS,
+                 authkey = None,
+                 lease_timeout = LEASE_TIMEOUT,
+                 excluded_exits = (),
+                 max_pending_results = MAX_PENDING_RESULTS):
+
+        authkey = authkey or defaultAuthkey()
+        if not authkey:
+            raise ValueError(f"An authkey is required (or set {AUTHKEY_ENV}): workers send pickles")
+        self.authkey = authkey
+        self.lease_timeout = lease_timeout
+        self.job = ShardJob(urls, excluded_exits, max_pending_results)
+
+        # a class of our own, so the registration doesn't leak into other coordinators/ShardManager
+        class CoordinatorManager(BaseManager): pass
+        CoordinatorManager.register('job', callable = lambda: self.job)
+        self.manager = CoordinatorManager(address = address, authkey = authkey)
+        self.server = self.manager.get_server()
+        self.address = self.server.address
+        self.workers = []       # local worker processes, see spawnLocalWorkers()
+        Thread(target = self.server.serve_forever, daemon = True).start()
+        logger.info("Coordinator listening on %s:%d", *self.address)
+
+    def results(self):
+        """Yield results (see shardResult()) as workers hand them in, until every url is done"""
+        last_reclaim = monotonic()
+        while True:
+            try:
+                yield self.job.results.get(timeout = POLL_INTERVAL)
+            except queue.Empty:
+                if self.job.finished() and self.job.results.empty():
+                    return
+            if monotonic() - last_reclaim > POLL_INTERVAL:
+                self.job.reclaim(self.lease_timeout)
+                last_reclaim = monotonic()
+
+    def fetchInto(self, sink):
+        """Write every result to the ResultSink sink, returns (number of results, number of errors)"""
+        num_results = 0
+        num_errors = 0
+        for result in self.results():
+            sink.write(result)
+            if result.ok:
+                num_results += 1
+            else:
+                num_errors += 1
+        return (num_results, num_errors)
+
+    def spawnLocalWorkers(self, num_workers, ports_per_worker, start_port = 9050, target = None, **worker_kwargs):
+        """Start num_workers worker processes on this host, each with its own range of ports.
+           target(address, authkey, start_port = ..., **worker_kwargs) runs in each, runWorker by default"""
+        host = '127.0.0.1' if self.address[0] in ('0.0.0.0', '') else self.address[0]
+        for i in range(num_workers):
+            process = multiprocessing.Process(target = target or runWorker,
+                                              args = ((host, self.address[1]), self.authkey),
+                                              kwargs = dict(worker_kwargs, start_port = start_port + i * ports_per_worker),
+                                              daemon = True)
+            process.start()
+            self.workers.append(process)
+        return self.workers
+
+    def joinWorkers(self, timeout = None):
+        for process in self.workers:
+            process.join(timeout)
+
+    def stats(self):
+        return self.job.stats()
+
+
+class ShardWorker():
+    """Fetches urls leased from a Coordinator with a getter over its own pool, handing results +
+       newly excluded exits back a batch at a time"""
+
+    def __init__(self,
+                 address,                   # coordinator's (host, port)
+                 authkey,
+                 getter,                    # TorGetter over this worker's shard of the pool
+                 batch_size = BATCH_SIZE,
+                 worker_id = None):
+
+        self.getter = getter
+        self.pool = getter.tor_client_pool
+        self.batch_size = batch_size
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+
+        manager = ShardManager(address = address, authkey = authkey)
+        manager.connect()
+        self.job = manager.job()
+        self.buffer = []
+        self.reported = set()   # exits we've told the coordinator about
+        self.syncExclusions(self.job.exclusions())
+
+    def pull(self):
+        """urls for getter.fetchStream(), leased from the coordinator a batch at a time"""
+        while True:
+            batch = self.job.getWork(self.worker_id, self.batch_size)
+            if not batch:
+                return
+            yield from batch
+
+    def localExclusions(self):
+        return self.pool.excludedExits()
+
+    def syncExclusions(self, excluded):
+        """Exclude exits other workers have excluded, locally"""
+        for fingerprint in set(excluded) - self.localExclusions():
+            self.pool.excludeExit(fingerprint)
+        self.reported.update(excluded)
+
+    def flush(self):
+        new = self.localExclusions() - self.reported
+        if not self.buffer and not new:
+            return
+        excluded = self.job.putResults(self.worker_id, self.buffer, sorted(new))
+        self.buffer = []
+        self.reported |= new
+        self.syncExclusions(excluded)
+
+    def run(self):
+        """Fetch until the coordinator's job is finished"""
+        logger.info("Worker %s fetching with %d clients", self.worker_id, len(self.pool.endpoints))
+        while True:
+            for result in self.getter.fetchStream(self.pull()):
+                self.buffer.append(shardResult(result))
+                if len(self.buffer) >= self.batch_size:
+                    self.flush()
+            self.flush()
+            if self.job.finished():
+                return
+            sleep(POLL_INTERVAL)    # other workers still have urls that may come back to us
+
+
+def runWorker(address, authkey,
+              num_clients = TorClientPool.NUM_CLIENTS,
+              start_port = 9050,
+              getter_class = 'RequestsTorGetter',
+              pool_kwargs = None,
+              getter_kwargs = None,
+              batch_size = BATCH_SIZE):
+    """Bring up a pool shard + getter, fetch until the job is finished, then shut down. The getter's
+       lookahead defaults to batch_size, so a worker doesn't sit on urls others could be fetching"""
+    pool = TorClientPool.TorClientPool(num_clients, start_port = start_port, **(pool_kwargs or {}))
+    getter_kwargs = dict({'lookahead': batch_size}, **(getter_kwargs or {}))
+    getter = getattr(TorGetter, getter_class)([], pool, **getter_kwargs)
+    try:
+        ShardWorker(address, authkey, getter, batch_size).run()
+    finally:
+        if hasattr(getter, 'stopLoop'):
+            getter.stopLoop()
+        else:
+            getter.killAllSessions()
+        pool.cleanShutdown()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Sharded torgetter: a coordinator + workers pulling urls from it")
+    parser.add_argument('--authkey', default = os.environ.get(AUTHKEY_ENV),
+                        help = f"shared secret (default: ${AUTHKEY_ENV})")
+    parser.add_argument('--log-level', default = 'INFO')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    coordinator = commands.add_parser('coordinator')
+    coordinator.add_argument('--urls', required = True, help = "file with one url per line")
+    coordinator.add_argument('--listen', default = '%s:%d' % SHARD_ADDRESS)
+    coordinator.add_argument('--output', required = True, help = "directory for result segments")
+    coordinator.add_argument('--lease-timeout', type = float, default = LEASE_TIMEOUT)
+    coordinator.add_argument('--local-workers', type = int, default = 0, help = "also run this many workers here")
+
+    worker = commands.add_parser('worker')
+    worker.add_argument('--connect', default = '%s:%d' % SHARD_ADDRESS)
+    worker.add_argument('--batch-size', type = int, default = BATCH_SIZE)
+
+    for command in (coordinator, worker):
+        command.add_argument('--clients', type = int, default = TorClientPool.NUM_CLIENTS, help = "tor clients per worker")
+        command.add_argument('--virtual-clients', type = int, default = 1)
+        command.add_argument('--start-port', type = int, default = 9050)
+        command.add_argument('--getter', default = 'RequestsTorGetter')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = args.log_level.upper())
+    if not args.authkey:
+        parser.error(f"--authkey (or ${AUTHKEY_ENV}) is required")
+    authkey = args.authkey.encode()
+    pool_kwargs = {'virtual_clients': args.virtual_clients}
+
+    if args.command == 'worker':
+        runWorker(parseAddress(args.connect), authkey, args.clients, args.start_port, args.getter,
+                  pool_kwargs = pool_kwargs, batch_size = args.batch_size)
+        return
+
+    with open(args.urls) as f:
+        urls = [line.strip() for line in f if line.strip()]
+    coordinator = Coordinator(urls, parseAddress(args.listen), authkey, args.lease_timeout)
+    if args.local_workers:
+        # each worker's main clients + control ports, then its spares'
+        coordinator.spawnLocalWorkers(args.local_workers, 2 * args.clients, args.start_port,
+                                      num_clients = args.clients, getter_class = args.getter,
+                                      pool_kwargs = pool_kwargs)
+    with SegmentSink(args.output) as sink:
+        num_results, num_errors = coordinator.fetchInto(sink)
+    logger.info("Done: %d results, %d errors", num_results, num_errors)
+    coordinator.joinWorkers()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import unittest
+
+from AdaptiveTimeout import AdaptiveTimeout
+
+
+MAX_TIMEOUT = 30
+PAGE_SECONDS = 6        # how long the slow domain's pages take
+
+
+class AdaptiveTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.latencies = AdaptiveTimeout(min_timeout = 5, min_samples = 10)
+        for _ in range(50):
+            self.latencies.record('9050', 'fast.com', 0.5)
+
+    def fetchSlow(self, tries = 20):
+        """Fetch slow.com until a fetch gets a timeout long enough for it, recording each outcome like
+           TorGetter.recordFetch(). Returns the number of fetches that timed out first"""
+        for timed_out in range(tries):
+            timeout = self.latencies.timeout('9050', 'slow.com', MAX_TIMEOUT)
+            if timeout >= PAGE_SECONDS:
+                self.latencies.record('9050', 'slow.com', PAGE_SECONDS)
+                return timed_out
+            self.latencies.recordTimeout('9050', 'slow.com', timeout)
+        self.fail("slow.com never got a long enough timeout")
+
+    def testUnsampledDomainGetsMaxTimeout(self):
+        # the pool + the client only know fast.com, which says nothing about slow.com
+        self.assertEqual(self.latencies.timeout('9050', 'slow.com', MAX_TIMEOUT), MAX_TIMEOUT)
+        self.assertEqual(self.fetchSlow(), 0)
+
+    def testSampledDomainAdapts(self):
+        self.assertEqual(self.latencies.timeout('9050', 'fast.com', MAX_TIMEOUT), 5)
+
+    def testSlowDomainRecovers(self):
+        # slow.com used to be fast, so its timeouts adapted down to min_timeout before its pages slowed down
+        for _ in range(10):
+            self.latencies.record('9050', 'slow.com', 0.5)
+        self.assertEqual(self.latencies.timeout('9050', 'slow.com', MAX_TIMEOUT), 5)
+
+        self.assertLessEqual(self.fetchSlow(), 2)
+        # + once it's been sampled at its new speed, it keeps getting timeouts it can make
+        for _ in range(20):
+            self.assertEqual(self.fetchSlow(), 0)
+
+    def testTimeoutsNeverPassMax(self):
+        for _ in range(20):
+            self.latencies.recordTimeout('9050', 'dead.com', MAX_TIMEOUT)
+        self.assertEqual(self.latencies.timeout('9050', 'dead.com', MAX_TIMEOUT), MAX_TIMEOUT)
+
+    def testResetForgetsClient(self):
+        for _ in range(20):
+            self.latencies.record('9051', 'other.com', 20)
+        self.assertEqual(self.latencies.timeout('9051', 'fast.com', MAX_TIMEOUT), MAX_TIMEOUT)
+        self.latencies.reset('9051')
+        self.assertLess(self.latencies.timeout('9051', 'fast.com', MAX_TIMEOUT), MAX_TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from ClientHealth import ClientHealth, percentile
+
+
+class ClientHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.health = ClientHealth(min_samples = 10)
+
+    def fetches(self, socks_port, seconds, num = 10, num_bytes = 10000, ok = True):
+        for _ in range(num):
+            self.health.record(socks_port, seconds, num_bytes if ok else 0, ok)
+
+    def testPercentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(percentile(values, 50), 6)
+        self.assertEqual(percentile(values, 90), 10)
+        self.assertEqual(percentile(values, 100), 10)
+        self.assertIsNone(percentile([], 50))
+
+    def testNeutralUntilMinSamples(self):
+        self.fetches('9050', 1)
+        self.fetches('9051', 10, num = 9)
+        self.assertEqual(self.health.score('9051'), 1.0)
+        self.assertFalse(self.health.isSlow('9051'))
+        self.assertEqual(self.health.score('9052'), 1.0)
+
+    def testFasterClientsScoreHigher(self):
+        self.fetches('9050', 1)
+        self.fetches('9051', 2)
+        self.fetches('9052', 4)
+        self.assertGreater(self.health.score('9050'), self.health.score('9051'))
+        self.assertGreater(self.health.score('9051'), self.health.score('9052'))
+        self.assertEqual(self.health.rank(['9052', '9050', '9051']), ['9050', '9051', '9052'])
+
+    def testErrorsLowerScore(self):
+        self.fetches('9050', 1)
+        self.fetches('9051', 1)
+        self.fetches('9051', 1, num = 5, ok = False)
+        self.assertLess(self.health.score('9051'), self.health.score('9050'))
+
+    def testSlowClient(self):
+        for socks_port in ('9050', '9051', '9052'):
+            self.fetches(socks_port, 1)
+        self.fetches('9053', 2)
+        self.fetches('9054', 5)
+        self.assertFalse(self.health.isSlow('9053'))
+        self.assertTrue(self.health.isSlow('9054'))
+
+    def testFlakyClientIsSlow(self):
+        self.fetches('9050', 1)
+        self.fetches('9051', 1, num = 4)
+        self.fetches('9051', 1, num = 6, ok = False)
+        self.assertTrue(self.health.isSlow('9051'))
+
+    def testWindowForgetsOldFetches(self):
+        health = ClientHealth(window = 10, min_samples = 10)
+        for _ in range(10):
+            health.record('9050', 1, 10000, True)
+            health.record('9052', 1, 10000, True)
+            health.record('9051', 10, 10000, True)
+        self.assertTrue(health.isSlow('9051'))
+        for _ in range(10):
+            health.record('9051', 1, 10000, True)
+        self.assertFalse(health.isSlow('9051'))
+
+    def testReset(self):
+        self.fetches('9050', 1)
+        self.fetches('9051', 10)
+        self.health.reset('9051')
+        self.assertEqual(self.health.score('9051'), 1.0)
+        self.assertFalse(self.health.isSlow('9051'))
+
+
+if __name__ == '__main__':
+    unittest.main()
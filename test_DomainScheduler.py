@@ -0,0 +1,123 @@
+import unittest
+
+from DomainScheduler import DomainScheduler
+
+
+class DomainSchedulerTest(unittest.TestCase):
+
+    def testClientDelayCountsFromRelease(self):
+        scheduler = DomainScheduler(client_delay = 5)
+        scheduler.push('http://a.com/1', 'a.com')
+        scheduler.push('http://a.com/2', 'a.com')
+
+        self.assertEqual(scheduler.next(['9050'], now = 0), ('http://a.com/1', 'a.com', '9050'))
+        self.assertIsNone(scheduler.next(['9050'], now = 1))      # still in flight
+        scheduler.release('9050', 'a.com', now = 2)
+        self.assertIsNone(scheduler.next(['9050'], now = 6.9))
+        self.assertAlmostEqual(scheduler.delay(now = 6.9), 0.1)   # rescheduled for when 9050 may send again
+        self.assertEqual(scheduler.next(['9050'], now = 7), ('http://a.com/2', 'a.com', '9050'))
+        self.assertEqual(len(scheduler), 0)
+
+    def testOtherClientTakesRateLimitedDomain(self):
+        scheduler = DomainScheduler(client_delay = 5)
+        for i in range(2):
+            scheduler.push(f'http://a.com/{i}', 'a.com')
+        scheduler.next(['9050'], now = 0)
+        scheduler.release('9050', 'a.com', now = 1)
+
+        # a client that hasn't hit a.com yet may go right away
+        self.assertEqual(scheduler.next(['9050', '9051'], now = 2), ('http://a.com/1', 'a.com', '9051'))
+
+    def testDomainDelayAcrossClients(self):
+        scheduler = DomainScheduler(domain_delay = 3)
+        for i in range(2):
+            scheduler.push(f'http://a.com/{i}', 'a.com')
+
+        self.assertEqual(scheduler.next(['9050', '9051'], now = 0)[2], '9050')
+        self.assertIsNone(scheduler.next(['9051'], now = 2.9))
+        self.assertAlmostEqual(scheduler.delay(now = 2), 1)
+        self.assertEqual(scheduler.next(['9051'], now = 3), ('http://a.com/1', 'a.com', '9051'))
+
+    def testStreamsPerDomain(self):
+        scheduler = DomainScheduler(streams_per_domain = 2)
+        for i in range(3):
+            scheduler.push(f'http://a.com/{i}', 'a.com')
+
+        self.assertIsNotNone(scheduler.next(['9050'], now = 0))
+        self.assertIsNotNone(scheduler.next(['9050'], now = 0))
+        self.assertIsNone(scheduler.next(['9050'], now = 0))
+        scheduler.release('9050', 'a.com', now = 0)
+        self.assertEqual(scheduler.next(['9050'], now = 0), ('http://a.com/2', 'a.com', '9050'))
+
+    def testReadyDomainsGoFirst(self):
+        scheduler = DomainScheduler(domain_delay = 10)
+        scheduler.push('http://a.com/1', 'a.com')
+        scheduler.push('http://a.com/2', 'a.com')
+        scheduler.push('http://b.com/1', 'b.com')
+        scheduler.push('http://c.com/1', 'c.com')
+
+        sent = []
+        for _ in range(3):
+            url, domain, socks_port = scheduler.next(['9050'], now = 0)
+            scheduler.release(socks_port, domain, now = 0)
+            sent.append(url)
+        # a.com's second url waits out domain_delay, behind the domains that are ready now
+        self.assertEqual(sent, ['http://a.com/1', 'http://b.com/1', 'http://c.com/1'])
+        self.assertIsNone(scheduler.next(['9050'], now = 5))
+        self.assertAlmostEqual(scheduler.delay(now = 5), 5)
+        self.assertEqual(scheduler.next(['9050'], now = 10)[0], 'http://a.com/2')
+        self.assertIsNone(scheduler.delay())
+
+    def testIdlePortsTriedInOrder(self):
+        scheduler = DomainScheduler()
+        scheduler.push('http://a.com/1', 'a.com')
+        self.assertEqual(scheduler.next(['9052', '9050'], now = 0)[2], '9052')
+        self.assertIsNone(scheduler.next([], now = 0))
+
+    def testDrain(self):
+        scheduler = DomainScheduler(domain_delay = 10)
+        for url, domain in (('http://a.com/1', 'a.com'), ('http://a.com/2', 'a.com'), ('http://b.com/1', 'b.com')):
+            scheduler.push(url, domain)
+        scheduler.next(['9050'], now = 0)
+
+        self.assertEqual(sorted(scheduler.drain()), ['http://a.com/2', 'http://b.com/1'])
+        self.assertEqual(len(scheduler), 0)
+        self.assertIsNone(scheduler.next(['9050'], now = 100))
+        self.assertIsNone(scheduler.delay())
+
+    def testPruneKeepsLiveLimits(self):
+        scheduler = DomainScheduler(client_delay = 5, domain_delay = 5)
+        scheduler.push('http://a.com/1', 'a.com')
+        scheduler.next(['9050'], now = 0)
+        scheduler.release('9050', 'a.com', now = 1)
+
+        scheduler.prune(now = 2)
+        self.assertIn(('9050', 'a.com'), scheduler.client_ready)
+        scheduler.prune(now = 7)
+        self.assertEqual(scheduler.client_ready, {})
+        self.assertEqual(scheduler.domain_ready, {})
+
+    def testClaimCountsAsInFlight(self):
+        scheduler = DomainScheduler(client_delay = 5)
+        self.assertEqual(scheduler.claim(['9050', '9051'], 'a.com', now = 0), '9050')
+        self.assertEqual(scheduler.claim(['9050', '9051'], 'a.com', now = 0), '9051')
+        self.assertIsNone(scheduler.claim(['9050', '9051'], 'a.com', now = 0))
+
+        scheduler.release('9050', 'a.com', now = 1)
+        self.assertIsNone(scheduler.claim(['9050'], 'a.com', now = 5.9))
+        self.assertEqual(scheduler.claim(['9050'], 'a.com', now = 6), '9050')
+
+    def testClaimHoldsBackQueuedUrls(self):
+        scheduler = DomainScheduler(domain_delay = 3)
+        scheduler.push('http://a.com/1', 'a.com')
+        self.assertEqual(scheduler.claim(['9050'], 'a.com', now = 0), '9050')
+
+        # the duplicate used up a.com's turn: its queued url waits domain_delay after it
+        self.assertIsNone(scheduler.next(['9051'], now = 1))
+        self.assertAlmostEqual(scheduler.delay(now = 1), 2)
+        self.assertIsNone(scheduler.claim(['9051'], 'a.com', now = 1))
+        self.assertEqual(scheduler.next(['9051'], now = 3), ('http://a.com/1', 'a.com', '9051'))
+
+
+if __name__ == '__main__':
+    unittest.main()
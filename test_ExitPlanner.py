@@ -0,0 +1,171 @@
+import os
+import base64
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from stem.exit_policy import MicroExitPolicy
+
+import Metrics
+from ExitPlanner import ExitPlanner
+
+
+FLAGS = ('Exit', 'Fast', 'Running', 'Valid')
+
+
+def fingerprint(i):
+    return '%040X' % i
+
+
+def relay(i, bandwidth, flags = FLAGS, policy = 'accept 80,443', address = None):
+    return SimpleNamespace(fingerprint = fingerprint(i), nickname = f'relay{i}', address = address or f'10.0.0.{i}',
+                           flags = list(flags), bandwidth = bandwidth, exit_policy = MicroExitPolicy(policy))
+
+
+def consensusEntry(i, bandwidth, flags, policy, address):
+    """Lines of a relay's router status entry in a full consensus"""
+    identity = base64.b64encode(bytes.fromhex(fingerprint(i))).decode().rstrip('=')
+    digest = base64.b64encode(b'\x09' * 20).decode().rstrip('=')
+    return [f'r relay{i} {identity} {digest} 2026-10-16 23:00:00 {address} 9001 0',
+            's ' + ' '.join(flags), f'w Bandwidth={bandwidth}', f'p {policy}']
+
+
+class ExitPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.geoip_file = os.path.join(self.directory, 'geoip')
+        with open(self.geoip_file, 'w') as f:
+            f.write('# 10.0.0.0/8 is in de, 20.0.0.0/8 in nl\n167772160,184549375,DE\n335544320,352321535,NL\n')
+        # relay i has bandwidth 1000 * i, so higher numbered relays are better
+        self.relays = [relay(i, 1000 * i) for i in range(1, 9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def planner(self, relays = None, bandwidth_weights = None, **kwargs):
+        planner = ExitPlanner(geoip_file = self.geoip_file, metrics = Metrics.MetricsRegistry(), **kwargs)
+        planner.build(self.relays if relays is None else relays, bandwidth_weights)
+        return planner
+
+    def testCandidates(self):
+        relays = self.relays + [relay(20, 10 ** 6, policy = 'accept 80'),
+                                relay(21, 10 ** 6, flags = FLAGS + ('BadExit',)),
+                                relay(22, 10 ** 6, flags = ('Exit', 'Running', 'Valid')),
+                                relay(23, 10 ** 6, flags = ('Fast', 'Running', 'Valid'))]
+        planner = self.planner(relays)
+        self.assertEqual(planner.candidates(), [fingerprint(i) for i in range(8, 0, -1)])
+        self.assertEqual(planner.candidates(excluded = [fingerprint(8)])[0], fingerprint(7))
+        # any exit at all is indexed, even one that can't be planned
+        self.assertIn(fingerprint(20), planner.exits)
+        self.assertNotIn(fingerprint(21), planner.exits)
+
+    def testGuardWeight(self):
+        relays = [relay(1, 1000), relay(2, 1500, flags = FLAGS + ('Guard',))]
+        planner = self.planner(relays, {'Wee': 10000, 'Wed': 5000})
+        self.assertEqual(planner.exits[fingerprint(2)]['weight'], 750)
+        self.assertEqual(planner.candidates(), [fingerprint(1), fingerprint(2)])
+
+    def testCountries(self):
+        relays = self.relays + [relay(30, 10 ** 6, address = '20.0.0.30')]
+        self.assertEqual(self.planner(relays).exits[fingerprint(30)]['country'], 'nl')
+        self.assertEqual(self.planner(relays, countries = {'NL'}).candidates(), [fingerprint(30)])
+
+    def testPlanDealsInSnakeOrder(self):
+        planner = self.planner(exits_per_client = 2)
+        plan = planner.plan(['9050', '9051', '9052'])
+        self.assertEqual(plan, {'9050': [fingerprint(8), fingerprint(3)],
+                                '9051': [fingerprint(7), fingerprint(4)],
+                                '9052': [fingerprint(6), fingerprint(5)]})
+        self.assertEqual(planner.exitNodes('9051'), f'{fingerprint(7)},{fingerprint(4)}')
+        self.assertIsNone(planner.exitNodes('9053'))
+
+    def testPlanSkipsExcludedAndRunsShort(self):
+        planner = self.planner(exits_per_client = 3)
+        plan = planner.plan(['9050', '9051', '9052'], excluded = [fingerprint(8)])
+        planned = [fp for exits in plan.values() for fp in exits]
+        self.assertEqual(sorted(planned), sorted(fingerprint(i) for i in range(1, 8)))
+        self.assertEqual(sorted(len(exits) for exits in plan.values()), [2, 2, 3])
+
+    def testAssignAndRetire(self):
+        planner = self.planner(exits_per_client = 2)
+        planner.plan(['9050', '9051'])      # 8, 5 + 7, 6
+        self.assertEqual(planner.assign('9052'), [fingerprint(4), fingerprint(3)])
+
+        # a restarted client gets the best exits nobody has, before the ones it just gave up
+        self.assertEqual(planner.assign('9050'), [fingerprint(2), fingerprint(1)])
+        self.assertEqual(planner.retired, {fingerprint(8), fingerprint(5)})
+        self.assertEqual(planner.retire('9051'), [fingerprint(7), fingerprint(6)])
+        self.assertNotIn('9051', planner.assigned)
+
+        # with every unused exit handed out, the retired ones go again, best first
+        self.assertEqual(planner.assign('9053'), [fingerprint(8), fingerprint(7)])
+        self.assertEqual(planner.retired, {fingerprint(6), fingerprint(5)})
+
+    def testAssignWithNothingLeft(self):
+        planner = self.planner(relays = self.relays[:2], exits_per_client = 2)
+        planner.plan(['9050'])
+        self.assertEqual(planner.assign('9051'), [])
+        self.assertIsNone(planner.exitNodes('9051'))
+
+    def testTopUpReplacesExcludedExits(self):
+        planner = self.planner(exits_per_client = 3)
+        planner.plan(['9050', '9051'])      # 8, 5, 4 + 7, 6, 3
+
+        exits = planner.topUp('9050', {fingerprint(8), fingerprint(4)})
+        self.assertEqual(exits, [fingerprint(5), fingerprint(2), fingerprint(1)])
+        self.assertEqual(planner.assigned['9050'], exits)
+        self.assertIsNone(planner.topUp('9051', {fingerprint(8), fingerprint(4)}))
+        self.assertEqual(planner.assigned['9051'], [fingerprint(7), fingerprint(6), fingerprint(3)])
+
+    def testTopUpWithNothingLeft(self):
+        planner = self.planner(exits_per_client = 4)
+        planner.plan(['9050', '9051'])
+        excluded = set(planner.assigned['9050'])
+        self.assertEqual(planner.topUp('9050', excluded), [])
+        self.assertNotIn('9050', planner.assigned)
+
+    def writeSeed(self, entries):
+        lines = ['network-status-version 3', 'vote-status consensus', 'consensus-method 28',
+                 'valid-after 2026-10-17 00:00:00', 'fresh-until 2026-10-17 01:00:00',
+                 'valid-until 2026-10-17 03:00:00', 'voting-delay 300 300',
+                 'known-flags BadExit Exit Fast Guard Running Stable Valid']
+        for entry in entries:
+            lines += consensusEntry(*entry)
+        lines += ['directory-footer', 'bandwidth-weights Wed=5000 Wee=10000']
+        seed_dir = os.path.join(self.directory, 'seed')
+        os.makedirs(seed_dir)
+        with open(os.path.join(seed_dir, 'cached-consensus'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return seed_dir
+
+    def testLoadFromSeed(self):
+        seed_dir = self.writeSeed([(1, 3000, FLAGS, 'accept 80,443', '10.0.0.1'),
+                                   (2, 4000, FLAGS + ('Guard',), 'accept 80,443', '20.0.0.2'),
+                                   (3, 9000, FLAGS, 'accept 80', '10.0.0.3'),
+                                   (4, 9000, ('Fast', 'Running', 'Valid'), 'reject 1-65535', '10.0.0.4')])
+        planner = ExitPlanner(geoip_file = self.geoip_file, metrics = Metrics.MetricsRegistry())
+        self.assertEqual(planner.load(seed_dir), 3)
+        self.assertEqual(planner.exits[fingerprint(2)]['weight'], 2000)
+        self.assertEqual(planner.exits[fingerprint(2)]['country'], 'nl')
+        self.assertEqual(planner.exits[fingerprint(3)]['ports'], frozenset([80]))
+        self.assertEqual(planner.candidates(), [fingerprint(1), fingerprint(2)])
+
+    def testLoadKeepsAssignments(self):
+        seed_dir = self.writeSeed([(1, 3000, FLAGS, 'accept 80,443', '10.0.0.1'),
+                                   (2, 4000, FLAGS, 'accept 80,443', '10.0.0.2')])
+        planner = self.planner(exits_per_client = 1)
+        planner.plan(['9050'])
+        planner.load(seed_dir)
+        self.assertEqual(planner.assigned, {'9050': [fingerprint(8)]})
+        self.assertEqual(planner.candidates(), [fingerprint(2), fingerprint(1)])
+
+    def testLoadWithoutConsensus(self):
+        planner = ExitPlanner(geoip_file = self.geoip_file, metrics = Metrics.MetricsRegistry())
+        self.assertEqual(planner.load(self.directory), 0)
+        self.assertEqual(planner.plan(['9050']), {'9050': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
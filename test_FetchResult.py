@@ -0,0 +1,159 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+import ResultStore
+from FetchResult import FetchResult
+
+
+PAGE = '<html><body>café</body></html>'
+
+
+class FetchResultTest(unittest.TestCase):
+
+    def testDecodesBodyOnDemand(self):
+        result = FetchResult('http://a.com/', PAGE.encode('latin-1'), '9050', encoding = 'latin-1')
+        self.assertIsNone(result._html)
+        self.assertEqual(result.html, PAGE)
+        self.assertEqual(result['html'], PAGE)
+        self.assertEqual(result.size, len(PAGE.encode('latin-1')))
+
+    def testBogusCharsetFallsBackToUTF8(self):
+        result = FetchResult('http://a.com/', PAGE.encode(), '9050', encoding = 'no-such-charset')
+        self.assertEqual(result.html, PAGE)
+
+    def testHtmlOnly(self):
+        result = FetchResult('http://a.com/', None, '9050', html = PAGE)
+        self.assertEqual(result.body, PAGE.encode())
+        self.assertTrue(result.ok)
+
+    def testOk(self):
+        self.assertFalse(FetchResult('http://a.com/', None, '9050', error = OSError("reset")).ok)
+        self.assertFalse(FetchResult('http://a.com/', b'', '9050').ok)
+        self.assertTrue(FetchResult('http://a.com/', b'x', '9050').ok)
+
+    def testTimings(self):
+        result = FetchResult('http://a.com/', b'x', '9050', started = 10.0, finished = 12.5)
+        self.assertEqual(result.seconds, 2.5)
+        self.assertEqual(result['time'], timedelta(seconds = 2.5))
+        self.assertEqual(FetchResult('http://a.com/', b'x', '9050').seconds, 0)
+
+    def testReadsLikeADict(self):
+        result = FetchResult('http://a.com/', b'x', '9050', exit_fingerprint = 'A' * 40)
+        self.assertEqual(result['exit_fingerprint'], 'A' * 40)
+        self.assertEqual(result.get('processed', 'none'), 'none')
+        with self.assertRaises(KeyError):
+            result['processed']
+
+        result['processed'] = {'title': 'x'}
+        result['port'] = '9051'
+        self.assertIn('processed', result)
+        self.assertEqual(result['processed'], {'title': 'x'})
+        self.assertEqual(result.port, '9051')
+        self.assertEqual(result.keys(), FetchResult.KEYS + ('processed',))
+
+    def testCopy(self):
+        result = FetchResult('http://a.com/', b'x', '9050', error = ValueError("bad"))
+        result['processed'] = 1
+        copy = result.copy(error = 'ValueError()')
+        self.assertEqual(copy.error, 'ValueError()')
+        self.assertIsInstance(result.error, ValueError)
+        copy['processed'] = 2
+        self.assertEqual(result['processed'], 1)
+
+    def testPickleRoundTrip(self):
+        result = FetchResult('http://a.com/', PAGE.encode(), '9050', encoding = 'utf-8',
+                             started = 1.0, finished = 2.0, wire_size = 20)
+        result.html    # decoded, but the decoded copy isn't pickled along with the body
+        result['processed'] = [1, 2]
+
+        copy = pickle.loads(pickle.dumps(result))
+        self.assertIsNone(copy._html)
+        self.assertEqual(copy.html, PAGE)
+        self.assertEqual((copy.seconds, copy.wire_size, copy['processed']), (1.0, 20, [1, 2]))
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def results(self, num):
+        for i in range(num):
+            if i % 3 == 2:
+                yield FetchResult(f'http://a.com/{i}', None, '9050', error = OSError("reset"),
+                                  started = 0, finished = 1)
+            else:
+                yield FetchResult(f'http://a.com/{i}', (PAGE * (i + 1)).encode(), '9050',
+                                  exit_fingerprint = 'A' * 40, started = 0, finished = 0.5)
+
+    def roundTrip(self, compression = 'gzip', num = 10, **sink_kwargs):
+        with ResultStore.SegmentSink(self.directory, compression = compression, **sink_kwargs) as sink:
+            for result in self.results(num):
+                sink.write(result)
+        self.assertEqual(sink.count, num)
+        records = list(ResultStore.SegmentReader(self.directory))
+        self.assertEqual(records, [ResultStore.serializeResult(r) for r in self.results(num)])
+        return records
+
+    def testMemorySink(self):
+        with ResultStore.MemorySink() as sink:
+            for result in self.results(3):
+                sink.write(result)
+        self.assertEqual([r.url for r in sink], ['http://a.com/0', 'http://a.com/1', 'http://a.com/2'])
+
+    def testRoundTrip(self):
+        records = self.roundTrip()
+        self.assertEqual(records[0], {'url': 'http://a.com/0', 'html': PAGE, 'time': 0.5, 'port': '9050',
+                                      'exit_fingerprint': 'A' * 40, 'error': None})
+        self.assertEqual(records[2]['error'], 'reset')
+        self.assertIsNone(records[2]['html'])
+
+    def testSegmentsRollOver(self):
+        self.roundTrip(segment_size = 200)
+        self.assertGreater(len(ResultStore.segmentPaths(self.directory)), 1)
+
+    def testNewSinkStartsANewSegment(self):
+        self.roundTrip(num = 2)
+        with ResultStore.SegmentSink(self.directory) as sink:
+            sink.write(FetchResult('http://b.com/', b'x', '9051'))
+        paths = ResultStore.segmentPaths(self.directory)
+        self.assertEqual([os.path.basename(p) for p in paths], ['results-00000.jsonl.gz', 'results-00001.jsonl.gz'])
+        self.assertEqual(len(list(ResultStore.SegmentReader(self.directory))), 3)
+        self.assertEqual(len(list(ResultStore.SegmentReader(paths[1]))), 1)
+
+    def testProcessedOutput(self):
+        result = FetchResult('http://a.com/', b'x', '9050')
+        result['processed'] = {'links': 3}
+        result['process_error'] = None
+        with ResultStore.SegmentSink(self.directory) as sink:
+            sink.write(result)
+        record, = ResultStore.SegmentReader(self.directory)
+        self.assertEqual((record['processed'], record['process_error']), ({'links': 3}, None))
+
+    def testTruncatedSegmentKeepsCompleteRecords(self):
+        self.roundTrip(num = 50)
+        path, = ResultStore.segmentPaths(self.directory)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) * 2 // 3)
+        records = list(ResultStore.SegmentReader(path))
+        self.assertLess(len(records), 50)
+        self.assertEqual([r['url'] for r in records], [f'http://a.com/{i}' for i in range(len(records))])
+
+    @unittest.skipUnless(ResultStore.zstandard, "needs the zstandard package")
+    def testZstdRoundTrip(self):
+        self.roundTrip(compression = 'zstd')
+
+    def testUnknownCompression(self):
+        with self.assertRaises(ValueError):
+            ResultStore.SegmentSink(self.directory, compression = 'lzma')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import Frontier
+from FetchResult import FetchResult
+from TorGetter import TorGetter, ContentTypeRejected
+
+
+URLS = ['http://a.example.com/1', 'http://a.example.com/2', 'http://b.example.org/1']
+
+
+class FlakyGetter():
+    """Stands in for a getter's fetchStream(): a url's first failures_per_url fetches fail"""
+
+    def __init__(self, failures_per_url = 1, error = None):
+        self.failures_per_url = failures_per_url
+        self.error = error or OSError("connection reset")
+        self.attempts = {}
+
+    def fetchStream(self, urls):
+        for url, domain in urls:
+            self.attempts[url] = self.attempts.get(url, 0) + 1
+            if self.attempts[url] <= self.failures_per_url:
+                yield FetchResult(url, None, '9050', error = self.error)
+            else:
+                yield FetchResult(url, b'<html></html>', '9050')
+
+    def fetchFrontier(self, frontier):
+        return TorGetter.fetchFrontier(self, frontier)
+
+
+class FrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'frontier.sqlite')
+        self.frontier = Frontier.Frontier(self.path, max_attempts = 3)
+        self.frontier.add(URLS)
+
+    def tearDown(self):
+        self.frontier.close()
+        shutil.rmtree(self.directory)
+
+    def testAddDeduplicates(self):
+        self.assertEqual(self.frontier.add(URLS + ['HTTP://A.EXAMPLE.COM/1']), 0)
+        self.assertEqual(self.frontier.counts(), {Frontier.PENDING: 3})
+        self.assertEqual(self.frontier.domains(), {'example.com': 2, 'example.org': 1})
+
+    def testIterInterleavesDomainsAndMarksInFlight(self):
+        items = list(self.frontier)
+        self.assertEqual([domain for _, domain in items], ['example.com', 'example.org', 'example.com'])
+        self.assertEqual(self.frontier.counts(), {Frontier.IN_FLIGHT: 3})
+        self.assertEqual(self.frontier.pending(), 0)
+
+    def testInFlightGoesBackToPendingOnReopen(self):
+        next(iter(self.frontier))
+        self.frontier.close()
+        self.frontier = Frontier.Frontier(self.path)
+        self.assertEqual(self.frontier.counts(), {Frontier.PENDING: 3})
+
+    def testFailedThenRetried(self):
+        url, _ = next(iter(self.frontier))     # the whole batch goes in flight
+        self.frontier.markFailed(url, 'timed out')
+        self.assertEqual(self.frontier.pending(), 1)
+        self.assertEqual([u for u, _ in self.frontier], [url])
+        self.frontier.markFailed(url, 'timed out')
+        self.frontier.markFailed(url, 'timed out')
+        self.assertEqual(self.frontier.counts()[Frontier.FAILED], 1)
+        self.assertNotIn(url, [u for u, _ in self.frontier])
+
+    def testNotRetryableFailsRightAway(self):
+        url, _ = next(iter(self.frontier))
+        self.frontier.markFailed(url, 'rejected', retry = False)
+        self.assertEqual(self.frontier.counts().get(Frontier.FAILED), 1)
+
+    def testDone(self):
+        for url, _ in self.frontier:
+            self.frontier.markDone(url)
+        self.assertEqual(self.frontier.counts(), {Frontier.DONE: 3})
+        self.assertEqual(list(self.frontier), [])
+
+    def testFetchFrontierRetriesFailuresInTheSameRun(self):
+        getter = FlakyGetter(failures_per_url = 2)
+        results = list(getter.fetchFrontier(self.frontier))
+        self.assertEqual(len(results), 9)
+        self.assertEqual(self.frontier.counts(), {Frontier.DONE: 3})
+
+    def testFetchFrontierStopsAtMaxAttempts(self):
+        getter = FlakyGetter(failures_per_url = 10)
+        results = list(getter.fetchFrontier(self.frontier))
+        self.assertEqual(len(results), 9)
+        self.assertEqual(self.frontier.counts(), {Frontier.FAILED: 3})
+
+    def testFetchFrontierDoesntRetryRejections(self):
+        getter = FlakyGetter(error = ContentTypeRejected("Content-Type image/png isn't allowed"))
+        results = list(getter.fetchFrontier(self.frontier))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.frontier.counts(), {Frontier.FAILED: 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from types import SimpleNamespace
+
+from stem import CircStatus, StreamStatus
+from stem.control import EventType
+
+import Metrics
+from StreamTracker import StreamTracker
+
+
+EXIT = 'A' * 40
+
+
+class EventController():
+    """Just enough of a stem Controller for a StreamTracker, with events fed in by the test"""
+
+    def __init__(self):
+        self.listeners = {}
+
+    def add_event_listener(self, listener, event_type):
+        self.listeners[event_type] = listener
+
+    def remove_event_listener(self, listener):
+        pass
+
+    def get_circuits(self):
+        return []
+
+    def emit(self, event_type, **fields):
+        self.listeners[event_type](SimpleNamespace(**fields))
+
+
+def streamEvent(status, stream_id = '7', circ_id = '1', source_address = None, source_port = None):
+    return dict(id = stream_id, status = status, circ_id = circ_id, target_address = 'example.com',
+                source_address = source_address, source_port = source_port, keyword_args = {})
+
+
+class StreamTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = EventController()
+        self.tracker = StreamTracker(self.controller, Metrics.MetricsRegistry(), '9050')
+        self.controller.emit(EventType.CIRC, id = '1', status = CircStatus.BUILT, path = [('B' * 40, 'b'), (EXIT, 'x')])
+
+    def testSourceFromNewEvent(self):
+        # tor only reports SOURCE_ADDR on NEW, not on the SUCCEEDED event that names the circuit
+        self.controller.emit(EventType.STREAM, **streamEvent(StreamStatus.NEW, circ_id = None,
+                                                             source_address = '127.0.0.1', source_port = 51000))
+        self.assertIsNone(self.tracker.exitForSource('127.0.0.1:51000'))
+        self.controller.emit(EventType.STREAM, **streamEvent(StreamStatus.SUCCEEDED))
+
+        self.assertEqual(self.tracker.exitForSource('127.0.0.1:51000'), EXIT)
+        self.assertEqual(self.tracker.exitForStream('7'), EXIT)
+        self.assertEqual(self.tracker.exitForTarget('example.com'), EXIT)
+        self.assertNotIn('7', self.tracker.new_sources)
+
+    def testFailedStreamHasNoSource(self):
+        self.controller.emit(EventType.STREAM, **streamEvent(StreamStatus.NEW, circ_id = None,
+                                                             source_address = '127.0.0.1', source_port = 51001))
+        self.controller.emit(EventType.STREAM, **streamEvent(StreamStatus.FAILED))
+
+        self.assertIsNone(self.tracker.exitForSource('127.0.0.1:51001'))
+        self.assertNotIn('7', self.tracker.new_sources)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+import urllib3
+
+import TorGetter
+from TorGetter import BodyBuffer, BodyTooLarge, ContentTypeRejected, TooSlow
+
+
+class Clock():
+    """Stands in for monotonic(), moved on by the test"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class BodyBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(TorGetter, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testCollectsChunks(self):
+        buffer = BodyBuffer(max_size = 10)
+        buffer.add(b'hello ')
+        buffer.add(b'you')
+        self.assertEqual(buffer.getvalue(), b'hello you')
+
+    def testTooLarge(self):
+        buffer = BodyBuffer(max_size = 10)
+        buffer.add(b'x' * 10)
+        with self.assertRaises(BodyTooLarge):
+            buffer.add(b'x')
+        self.assertFalse(BodyTooLarge.client_fault)
+
+    def testNoSizeLimit(self):
+        buffer = BodyBuffer(max_size = None)
+        buffer.add(b'x' * 1000)
+        self.assertEqual(len(buffer.getvalue()), 1000)
+
+    def testTooSlow(self):
+        buffer = BodyBuffer(min_throughput = 100, window = 10)
+        for _ in range(10):
+            self.clock.now += 1
+            buffer.add(b'x' * 200)      # 200 bytes/sec
+        for _ in range(9):
+            self.clock.now += 1
+            buffer.add(b'x' * 50)
+        self.clock.now += 1
+        with self.assertRaises(TooSlow):
+            buffer.add(b'x' * 50)       # 50 bytes/sec over the window
+        self.assertTrue(TooSlow.client_fault)
+
+    def testNoThroughputFloor(self):
+        buffer = BodyBuffer(min_throughput = 0, window = 10)
+        self.clock.now += 60
+        buffer.add(b'x')
+        self.assertEqual(buffer.getvalue(), b'x')
+
+
+class CheckHeadersTest(unittest.TestCase):
+
+    def check(self, headers, content_types = None, max_body_size = 1000):
+        getter = SimpleNamespace(content_types = content_types, max_body_size = max_body_size)
+        TorGetter.TorGetter.checkHeaders(getter, headers)
+
+    def testContentTypes(self):
+        allowed = ('text/html', 'text/*')
+        self.check({'Content-Type': 'text/html; charset=utf-8'}, allowed)
+        self.check({'Content-Type': 'TEXT/plain'}, allowed)
+        self.check({}, allowed)         # nothing to go by, read it
+        with self.assertRaises(ContentTypeRejected):
+            self.check({'Content-Type': 'image/png'}, allowed)
+        self.check({'Content-Type': 'image/png'})
+
+    def testContentLength(self):
+        self.check({'Content-Length': '1000'})
+        self.check({'Content-Length': 'bogus'})
+        with self.assertRaises(BodyTooLarge):
+            self.check({'Content-Length': '1001'})
+        self.check({'Content-Length': '1001'}, max_body_size = None)
+
+
+class IsTimeoutTest(unittest.TestCase):
+
+    def testTimeouts(self):
+        read_timeout = urllib3.exceptions.ReadTimeoutError(None, 'http://a.com/', "Read timed out.")
+        self.assertTrue(TorGetter.isTimeout(requests.exceptions.ReadTimeout()))
+        self.assertTrue(TorGetter.isTimeout(requests.exceptions.ConnectTimeout()))
+        # a read timing out while the body streams in
+        self.assertTrue(TorGetter.isTimeout(requests.exceptions.ConnectionError(read_timeout)))
+        self.assertTrue(TorGetter.isTimeout(read_timeout))
+        self.assertTrue(TorGetter.isTimeout(asyncio.TimeoutError()))
+
+    def testOtherErrors(self):
+        self.assertFalse(TorGetter.isTimeout(None))
+        self.assertFalse(TorGetter.isTimeout(requests.exceptions.ConnectionError("Connection refused")))
+        self.assertFalse(TorGetter.isTimeout(TooSlow("Body arrived at 10 bytes/sec")))
+
+
+if __name__ == '__main__':
+    unittest.main()